@@ -1,10 +1,36 @@
 from ._conversions import _one_hot_to_atom_type as one_hot_to_atom_type
+from ._conversions import _bohr_to_angstrom as bohr_to_angstrom
+from ._system_topology import SystemTopology
 from ._verlet_coords import _verlet_coords as verlet_coords 
 from ._verlet_velo import _verlet_velo as verlet_velo 
 from ._ml_energies_forces import _ml_energies_forces as ml_energies_forces
+from ._ml_energies_forces import _check_gap_window as check_gap_window
+from ._ml_energies_forces import EnergiesForces
+from ._precision import _precision_policy as precision_policy
+from ._precision import PrecisionPolicy, PRECISION_POLICIES
+from ._inference_broker import InferenceBroker, BrokerStats
 from ._kinetic_energy import _kinetic_energy as kinetic_energy
-from ._surface_hopping import _surface_hopping as surface_hopping
+from ._velocity_verlet import _velocity_verlet as velocity_verlet
+from ._neighbor_list import NeighborList, NeighborListStats
+from ._wigner import _wigner_sample as wigner_sample
+from ._wigner import NormalModes, WignerSample
+from ._step_kernels import _step_mode as step_mode
+from ._step_kernels import STEP_MODES
 from ._internal_conversion import _internal_conversion as internal_conversion
+from ._internal_conversion import ScreenCounters, zn_screen_counters
 from ._intersystem_crossing import _intersystem_crossing as intersystem_crossing
+from ._zn_hopping import _zn_hopping as zn_hopping
 from ._adjust_velo_after_hop import _adjust_velo_after_hop as adjust_velo_after_hop
 from ._is_valid_surface_hop import _is_valid_surface_hop as is_valid_surface_hop 
+from ._surface_hopping import _surface_hopping as surface_hopping
+from ._surface_hopping import HOP_TYPES, SurfaceHoppingMetrics
+from ._termination import _termination_reasons as termination_reasons
+from ._termination import _bonds as find_bonds
+from ._termination import _total_energy as total_energy
+from ._termination import TerminationCriteria, TERMINATION_REASONS
+from ._time_step import _adaptive_delta_t as adaptive_delta_t
+from ._time_step import TimeStepPolicy
+from ._profiler import _profile as profile
+from ._profiler import _phase as profile_phase
+from ._profiler import _record_steps as profile_steps
+from ._profiler import Profiler, PhaseStats
@@ -0,0 +1,29 @@
+"""
+STATUS: SYNTAX PASS
+
+"""
+
+import torch
+
+from typing import Union
+
+
+def _active_forces(forces: torch.Tensor, state: Union[int, torch.Tensor]) -> torch.Tensor:
+    """
+    Selects the forces of the populated electronic state.
+
+    Args:
+        forces (torch.Tensor): Atomic forces of size (K, N, 3), or (B, K, N, 3)
+            for a batch of B trajectories, where K is the number of electronic
+            states and N is the number of atoms.
+        state (int | torch.Tensor): The populated electronic state, or a tensor
+            of size (B) with one state per trajectory.
+
+    Returns:
+        forces (torch.Tensor): Atomic forces of size (N, 3), or (B, N, 3).
+
+    """
+    if isinstance(state, int) or state.dim() == 0:
+        return forces[..., int(state), :, :]
+    batch_idx = torch.arange(forces.size(dim=0), device=forces.device)
+    return forces[batch_idx, state]
@@ -5,7 +5,52 @@ STATUS: DEV
 
 import torch
 
+from solvent_dynamics.computer._is_valid_surface_hop import _nac_projection
+from solvent_dynamics.computer._system_topology import SystemTopology
+
 
 def _adjust_velo_after_hop(
-        ) -> torch.Tensor:
-    NotImplemented()
+        topology: SystemTopology,
+        velo: torch.Tensor,
+        nacs: torch.Tensor,
+        delta_e: torch.Tensor,
+        hop: torch.Tensor,
+        frustrated: torch.Tensor,
+        reflect: bool=False
+    ) -> torch.Tensor:
+    """
+    Rescales velocities along the coupling vector so that the total energy is
+    conserved by a hop, v' = v - gamma * d / m with the smaller root gamma.
+    The total energy is KE + E, the quantity kept by the Verlet steps.
+    Trajectories are selected by masks, every trajectory of a batch is
+    rescaled at once.
+
+    Args:
+        topology (SystemTopology): Topology of the molecular system.
+        velo (torch.Tensor): Atomic velocities of size (N, 3), or (B, N, 3)
+            for a batch.
+        nacs (torch.Tensor): Coupling vector towards the target state of size
+            (N, 3), or (B, N, 3).
+        delta_e (torch.Tensor): Potential energy of the target state minus
+            that of the current state, a scalar or of size (B).
+        hop (torch.Tensor): Boolean mask of the trajectories that hop.
+        frustrated (torch.Tensor): Boolean mask of the trajectories whose hop
+            is frustrated.
+        reflect (bool): Reverse the velocity component along the coupling
+            vector on frustrated hops, otherwise they keep their velocities.
+
+    Returns:
+        velo (torch.Tensor): Adjusted velocities of the size of ``velo``.
+
+    """
+    a, b = _nac_projection(topology, velo, nacs)
+    disc = (b.pow(2) - 4 * a * delta_e).clamp(min=0.0)
+    # the root closest to 0 is the smallest change of the velocities
+    sign = torch.where(b >= 0, 1.0, -1.0)
+    gamma = (b - sign * disc.sqrt()) / (2 * a)
+    gamma = torch.where(hop, gamma, torch.zeros_like(gamma))
+    if reflect:
+        gamma = torch.where(frustrated, b / a, gamma)
+    gamma = gamma.nan_to_num(0.0)
+
+    return velo - gamma.view(*gamma.shape, 1, 1) * nacs * topology.inv_mass_col
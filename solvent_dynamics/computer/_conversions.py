@@ -1,19 +1,46 @@
 """
-STATUS: DEV
-
-- better way to convert one hot to atom type
+STATUS: SYNTAX PASS
 
 """
 
 import torch
 
+from solvent_dynamics import constants
+
 from typing import Dict, List
 
 
+def _one_hot_to_type_idx(one_hot: torch.Tensor, key: Dict[str, torch.Tensor]) -> torch.Tensor:
+    """
+    Decodes a one-hot atom type tensor into indices of the key.
+
+    Args:
+        one_hot (torch.Tensor): A one-hot tensor of size (N, T), or (N) for
+            scalar codes, where N is the number of atoms.
+        key (dict(str, torch.Tensor)): Atom symbol to its one-hot row.
+
+    Returns:
+        idxs (torch.Tensor): Index into ``key`` of every atom, of size (N).
+
+    """
+    natoms = one_hot.size(dim=0)
+    codes = torch.stack([torch.as_tensor(v, dtype=one_hot.dtype) for v in key.values()], dim=0)
+    match = (one_hot.reshape(natoms, 1, -1) == codes.reshape(1, len(key), -1)).all(dim=-1)
+    if not match.any(dim=-1).all():
+        raise ValueError('one-hot tensor contains atoms that are not in the key')
+
+    return match.int().argmax(dim=-1)
+
+
 def _one_hot_to_atom_type(one_hot: torch.Tensor, key: Dict[str, torch.Tensor]) -> List[str]:
-    atom_types = []
-    for atom_tensor in one_hot:
-        for k, v in key.items():
-            if atom_tensor == v:
-                atom_types.append(k)
-    return atom_types
+    symbols = list(key.keys())
+    return [symbols[i] for i in _one_hot_to_type_idx(one_hot, key).tolist()]
+
+
+def _bohr_to_angstrom(length: torch.Tensor) -> torch.Tensor:
+    """
+    Converts lengths, or velocities per atomic unit of time, from bohr to
+    angstrom.
+
+    """
+    return length * constants.BOHR_ANGSTROM
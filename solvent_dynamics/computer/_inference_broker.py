@@ -0,0 +1,383 @@
+"""
+STATUS: DEV
+
+Micro-batching of model evaluations requested by concurrently running
+trajectories, e.g. threads or asyncio tasks of the same process.
+
+Requests are queued and collected by a single broker thread until a batch is
+full or the oldest request has waited for the latency deadline. Every batch
+costs one forward and one backward pass, structures of different sizes are
+evaluated in one batch per size.
+
+"""
+
+import time
+import queue
+import torch
+import asyncio
+import threading
+from concurrent.futures import Future
+from torch_geometric.data import Batch
+from torch_geometric.data.data import Data
+
+from solvent_dynamics.computer._ml_energies_forces import EnergiesForces, _check_gap_window, _ml_energies_forces
+from solvent_dynamics.computer._profiler import _phase
+
+from typing import Dict, List, NamedTuple, Optional, Union
+
+
+class BrokerStats(NamedTuple):
+    """
+    requests: the number of evaluated structures
+    batches: the number of model evaluations
+    max_batch: the largest batch
+    mean_wait: mean time in seconds from a request to the start of its batch
+    max_wait: longest time in seconds from a request to the start of its
+        batch
+    mean_latency: mean time in seconds from a request to its result
+
+    """
+    requests: int
+    batches: int
+    max_batch: int
+    mean_wait: float
+    max_wait: float
+    mean_latency: float
+
+    @property
+    def mean_batch(self) -> float:
+        return self.requests / self.batches if self.batches else 0.0
+
+
+class _Request(NamedTuple):
+    structure: Data
+    state: Optional[int]
+    future: Future
+    submitted: float
+
+
+class InferenceBroker:
+    """
+    Serves energies and forces to concurrent callers from batched model
+    evaluations.
+
+    """
+    def __init__(
+            self,
+            model: torch.nn.Module,
+            res_model: Optional[torch.nn.Module],
+            u_energy_evs: float,
+            rms_force_evs: float,
+            max_batch: int=32,
+            max_latency: float=2e-3,
+            force_mode: str='SINGLE_PASS',
+            gap_window: Optional[float]=None,
+            out_dtype: Optional[torch.dtype]=None
+        ) -> None:
+        """
+        Starts a broker thread.
+
+        Args:
+            model (torch.nn.Module): A trained and loaded neural network
+                model that returns energies of size (B, K) for a batch.
+            res_model (torch.nn.Module | None): An optional residual block
+                placed on top of the outputs of the standard model.
+            u_energy_evs (float): Energy normalization offset.
+            rms_force_evs (float): Energy and force normalization scale.
+            max_batch (int): The max number of structures per evaluation.
+            max_latency (float): The max time in seconds a request waits for
+                more requests before its batch is evaluated.
+            force_mode (str): one of "SINGLE_PASS" | "PER_STATE", see
+                ml_energies_forces.
+            gap_window (float | None): If given, only the forces of the
+                requested state and of states within this gap of it are
+                computed, every request has to give its state. It has to
+                cover the hopping thresholds, see check_gap_window.
+            out_dtype (torch.dtype | None): An optional floating point type of
+                the energies and forces, see ml_energies_forces.
+
+        Returns:
+            None
+
+        """
+        if gap_window is not None:
+            _check_gap_window(gap_window)
+        self._model = model
+        self._res_model = res_model
+        self._u_energy_evs = u_energy_evs
+        self._rms_force_evs = rms_force_evs
+        self._max_batch = max_batch
+        self._max_latency = max_latency
+        self._force_mode = force_mode
+        self._gap_window = gap_window
+        self._out_dtype = out_dtype
+
+        self._queue: 'queue.Queue[Optional[_Request]]' = queue.Queue()
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def submit(self, structure: Data, state: Optional[Union[int, torch.Tensor]]=None) -> 'Future[EnergiesForces]':
+        """
+        Queues a structure for evaluation.
+
+        Args:
+            structure (Data): A single structure, it must not be modified
+                until the result is set.
+            state (int | torch.Tensor | None): The populated electronic state,
+                required with a gap window.
+
+        Returns:
+            (Future[EnergiesForces]): Energies of size (K) and forces of size
+                (K, N, 3) of the structure.
+
+        """
+        if self._closed:
+            raise RuntimeError('submit to a closed inference broker')
+        if self._gap_window is not None and state is None:
+            raise ValueError('a gap window requires the populated state')
+        future: 'Future[EnergiesForces]' = Future()
+        state = int(state) if state is not None else None
+        self._queue.put(_Request(structure, state, future, time.perf_counter()))
+
+        return future
+
+    def energies_forces(
+            self,
+            structure: Data,
+            state: Optional[Union[int, torch.Tensor]]=None
+        ) -> EnergiesForces:
+        """
+        Evaluates a structure, blocking until its batch is done.
+
+        """
+        with _phase('broker_wait'):
+            return self.submit(structure, state).result()
+
+    async def async_energies_forces(
+            self,
+            structure: Data,
+            state: Optional[Union[int, torch.Tensor]]=None
+        ) -> EnergiesForces:
+        """
+        Evaluates a structure, awaiting its batch.
+
+        """
+        return await asyncio.wrap_future(self.submit(structure, state))
+
+    def stats(self) -> BrokerStats:
+        with self._lock:
+            return BrokerStats(
+                requests=self._requests,
+                batches=self._batches,
+                max_batch=self._max_batch_seen,
+                mean_wait=self._wait / self._requests if self._requests else 0.0,
+                max_wait=self._max_wait,
+                mean_latency=self._latency / self._requests if self._requests else 0.0
+            )
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._requests = 0
+            self._batches = 0
+            self._max_batch_seen = 0
+            self._wait = 0.0
+            self._max_wait = 0.0
+            self._latency = 0.0
+
+    def close(self) -> None:
+        """
+        Evaluates every queued request and stops the broker thread.
+
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self) -> 'InferenceBroker':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _serve(self) -> None:
+        stop = False
+        while not stop:
+            request = self._queue.get()
+            if request is None:
+                break
+            requests = [request]
+            deadline = request.submitted + self._max_latency
+            while len(requests) < self._max_batch:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.perf_counter(), 0.0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                requests.append(request)
+            self._evaluate(requests)
+
+        # requests that raced with close
+        while not self._queue.empty():
+            request = self._queue.get()
+            if request is not None:
+                self._evaluate([request])
+
+    def _evaluate(self, requests: List[_Request]) -> None:
+        start = time.perf_counter()
+        # one batch per structure size, forces are split by equal sizes
+        groups: Dict[int, List[_Request]] = {}
+        for request in requests:
+            groups.setdefault(request.structure.num_nodes, []).append(request)
+        for group in groups.values():
+            try:
+                ef = self._evaluate_batch(group)
+                for i, request in enumerate(group):
+                    request.future.set_result(EnergiesForces(ef.energies[i], ef.forces[i]))
+            except Exception as e:
+                for request in group:
+                    request.future.set_exception(e)
+
+        end = time.perf_counter()
+        with self._lock:
+            self._requests += len(requests)
+            self._batches += len(groups)
+            self._max_batch_seen = max(self._max_batch_seen, *[len(g) for g in groups.values()])
+            waits = [start - r.submitted for r in requests]
+            self._wait += sum(waits)
+            self._max_wait = max(self._max_wait, *waits)
+            self._latency += sum(end - r.submitted for r in requests)
+
+    def _evaluate_batch(self, requests: List[_Request]) -> EnergiesForces:
+        structure = Batch.from_data_list([r.structure for r in requests])
+        state = None
+        if self._gap_window is not None:
+            state = torch.tensor([r.state for r in requests], device=structure.pos.device)
+
+        return _ml_energies_forces(
+            model=self._model,
+            res_model=self._res_model,
+            structure=structure,
+            u_energy_evs=self._u_energy_evs,
+            rms_force_evs=self._rms_force_evs,
+            force_mode=self._force_mode,
+            state=state,
+            gap_window=self._gap_window,
+            out_dtype=self._out_dtype
+        )
+
+
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+
+    ntests = 4
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NSTATES = 3
+    _NTRAJ = 16
+    _NSTEPS = 20
+
+    class _ToyModel(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, _NSTATES)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = torch.tanh(self._lin(structure.pos)) * structure.pos.pow(2).sum(dim=-1, keepdim=True)
+            if structure.batch is None:
+                return e.sum(dim=0)
+            return torch.zeros(structure.num_graphs, _NSTATES).index_add(0, structure.batch, e)
+
+    torch.manual_seed(0)
+    model = _ToyModel()
+    x = torch.ones(_NATOMS, 1)
+    coords = torch.rand(_NTRAJ, _NSTEPS, _NATOMS, 3)
+
+    def _single(c: torch.Tensor) -> EnergiesForces:
+        return _ml_energies_forces(model, None, Data(x=x, pos=c.clone()), 0.0, 1.0)
+
+    def _trajectory(broker: InferenceBroker, traj: int) -> List[EnergiesForces]:
+        return [broker.energies_forces(Data(x=x, pos=c.clone())) for c in coords[traj]]
+
+    # concurrent threads are served from shared batches with their own results
+    with InferenceBroker(model, None, 0.0, 1.0, max_batch=_NTRAJ, max_latency=0.05) as broker:
+        with ThreadPoolExecutor(max_workers=_NTRAJ) as pool:
+            results = list(pool.map(lambda t: _trajectory(broker, t), range(_NTRAJ)))
+        stats = broker.stats()
+    for traj in [0, 7, 15]:
+        for step in [0, _NSTEPS - 1]:
+            ref = _single(coords[traj, step])
+            ef = results[traj][step]
+            assert torch.allclose(ef.energies, ref.energies) and torch.allclose(ef.forces, ref.forces, atol=1e-5)
+    assert stats.requests == _NTRAJ * _NSTEPS and stats.batches < stats.requests and stats.mean_batch > 1
+    ntests_passed += 1
+
+    # asyncio tasks, structures of different sizes and errors
+    async def _tasks(broker: InferenceBroker) -> List[EnergiesForces]:
+        return await asyncio.gather(*[
+            broker.async_energies_forces(Data(x=x[:n], pos=coords[0, 0, :n].clone())) for n in [10, 20, 10, 51]
+        ])
+
+    with InferenceBroker(model, None, 0.0, 1.0, max_latency=0.05) as broker:
+        mixed = asyncio.run(_tasks(broker))
+        failed = broker.submit(Data(x=x, pos=torch.rand(_NATOMS, 2)))
+    assert [ef.forces.size(dim=-2) for ef in mixed] == [10, 20, 10, 51]
+    assert torch.allclose(mixed[1].forces, _single(coords[0, 0, :20]).forces, atol=1e-5)
+    assert failed.exception() is not None
+    ntests_passed += 1
+
+    # selective forces per request state, the energies are scaled up to spread
+    # the states past the narrowest window allowed by the hopping thresholds
+    with InferenceBroker(model, None, 0.0, 1e3, gap_window=0.05) as broker:
+        ef = broker.energies_forces(Data(x=x, pos=coords[0, 0].clone()), state=1)
+    assert (ef.energies - ef.energies[1]).abs()[0] > 0.05
+    assert not ef.forces[1].isnan().any() and ef.forces[0].isnan().all()
+    try:
+        InferenceBroker(model, None, 0.0, 1.0, gap_window=1e-9)
+        assert False
+    except ValueError:
+        pass
+    ntests_passed += 1
+
+    # threaded trajectories follow their unbrokered twins
+    from solvent_dynamics import constants
+    from solvent_dynamics.computer import SystemTopology
+    from solvent_dynamics.trajectory import TrajectoryPropagator
+
+    topology = SystemTopology.build(torch.rand(_NATOMS) + 1.0, x, {'C': torch.ones(1)})
+
+    def _propagator(traj: int, broker: Optional[InferenceBroker]) -> TrajectoryPropagator:
+        ef = _single(coords[traj, 0])
+        zeros = torch.zeros(_NSTATES, _NSTATES)
+        return TrajectoryPropagator(
+            model, None, 0, topology, coords[traj, 0].clone(), 0.01 * coords[traj, 1], ef.forces, ef.energies,
+            zeros, zeros, zeros, 0.05, broker=broker, seed=traj
+        )
+
+    def _run(propagator: TrajectoryPropagator) -> TrajectoryPropagator:
+        for _ in range(_NSTEPS):
+            propagator.propagate()
+        return propagator
+
+    # the propagators normalize energies and forces by the constants
+    with InferenceBroker(model, None, constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS, max_latency=0.05) as broker:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            brokered = list(pool.map(_run, [_propagator(t, broker) for t in range(4)]))
+        traj_stats = broker.stats()
+    for traj, propagator in enumerate(brokered):
+        ref = _run(_propagator(traj, None))
+        assert torch.allclose(propagator._coords.cur, ref._coords.cur, atol=1e-5)
+    assert traj_stats.mean_batch > 1
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+    print(
+        f'{_NTRAJ} threads x {_NSTEPS} steps: {stats.batches} batches, {stats.mean_batch:.1f} mean batch, '
+        f'{stats.mean_wait * 1e3:.2f}ms mean wait, {stats.mean_latency * 1e3:.2f}ms mean latency'
+    )
@@ -11,30 +11,87 @@ http://www.rsc.org/suppdata/c8/cp/c8cp02651c/c8cp02651c1.pdf
 import math
 import torch
 
-from typing import NamedTuple
+from solvent_dynamics.computer._step_kernels import _step_kernel
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import NamedTuple, Optional, Tuple, Union
 
 
 def _delta_e(
-        cur_state: int,
-        other_state: int,
+        state: Union[int, torch.Tensor],
         energies: torch.Tensor,
         energies_prev: torch.Tensor,
         energies_prev_prev: torch.Tensor
     ) -> torch.Tensor:
     """
-    Computes an energy gap tensor of size (3) between the current
-    state and the state in question.
-        - [0] current energy gap
-        - [1] prev energy gap
-        - [2] prev prev energy gap
+    Computes the energy gaps between the current state and every state over
+    the last three steps.
+
+    Args:
+        state (int | torch.Tensor): The current electronic state, or a tensor
+            of size (B) with one state per trajectory.
+        energies (torch.Tensor): Energies of size (K), or (B, K) for a batch.
+        energies_prev (torch.Tensor): Energies of the previous step.
+        energies_prev_prev (torch.Tensor): Energies of the step before.
+
+    Returns:
+        delta_e (torch.Tensor): Absolute energy gaps of size (3, K), or
+            (B, 3, K) for a batch.
+            - [0] current energy gaps
+            - [1] prev energy gaps
+            - [2] prev prev energy gaps
+
+    """
+    e = torch.stack([energies, energies_prev, energies_prev_prev], dim=-2)
+    idx = torch.as_tensor(state, device=e.device).view(*e.shape[:-2], 1, 1).expand(*e.shape[:-1], 1)
+    return (e - e.gather(-1, idx)).abs()
+
+
+def _gap_screen(delta_e: torch.Tensor, e_thresh: float) -> torch.Tensor:
+    """
+    Selects the state pairs worth a Zhu-Nakamura evaluation: pairs whose
+    energy gap has a local minimum below ``e_thresh`` at the previous step,
+    the crossing point. The current state never passes.
+
+    Args:
+        delta_e (torch.Tensor): Gap history of size (..., 3, K), see _delta_e.
+        e_thresh (float): Energy gap threshold.
+
+    Returns:
+        mask (torch.Tensor): A boolean tensor of size (..., K).
+
+    """
+    gap, gap_prev, gap_prev_prev = delta_e.unbind(dim=-2)
+    return (gap_prev < gap) & (gap_prev <= gap_prev_prev) & (gap_prev <= e_thresh)
+
+
+class ScreenCounters:
+    """
+    Running counts of the state pairs seen by the gap pre-screen and of the
+    pairs passed on to the Zhu-Nakamura evaluation, kept per process.
 
     """
-    d_E = [
-        energies[other_state] - energies[cur_state],
-        energies_prev[other_state] - energies_prev[cur_state],
-        energies_prev_prev[other_state] - energies_prev_prev[cur_state]
-    ]
-    return torch.stack(d_E, dim=0).abs()
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.pairs = 0
+        self.evaluated = 0
+
+    def update(self, pairs: int, evaluated: int) -> None:
+        self.pairs += pairs
+        self.evaluated += evaluated
+
+    @property
+    def skipped(self) -> int:
+        return self.pairs - self.evaluated
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.skipped / self.pairs if self.pairs else 0.0
+
+
+zn_screen_counters = ScreenCounters()
 
 
 class P_NACS(NamedTuple):
@@ -42,188 +99,469 @@ class P_NACS(NamedTuple):
     nacs: torch.Tensor
 
 
+class ZNForces(NamedTuple):
+    f_ia_1: torch.Tensor
+    f_ia_2: torch.Tensor
+
+
+def _zn_forces(
+        other_is_high: torch.Tensor,
+        f_state: torch.Tensor,
+        f_other: torch.Tensor,
+        f_pp_state: torch.Tensor,
+        f_pp_other: torch.Tensor,
+        coord: torch.Tensor,
+        coord_prev: torch.Tensor,
+        coord_prev_prev: torch.Tensor
+    ) -> ZNForces:
+    """
+    Computes the diabatic forces of eq. 7 of P state pairs, every pair one
+    row of the inputs.
+
+    Args:
+        other_is_high (torch.Tensor): Whether the other state of a pair is
+            the higher state, of size (P).
+        f_state (torch.Tensor): Current forces of the current state of size
+            (P, N, 3).
+        f_other (torch.Tensor): Current forces of the other state.
+        f_pp_state (torch.Tensor): Prev prev step forces of the current state.
+        f_pp_other (torch.Tensor): Prev prev step forces of the other state.
+        coord (torch.Tensor): Current coordinates of size (P, N, 3).
+        coord_prev (torch.Tensor): Prev coordinates of size (P, N, 3).
+        coord_prev_prev (torch.Tensor): Prev prev coordinates of size (P, N, 3).
+
+    Returns:
+        f_ia_1, f_ia_2 (torch.Tensor, torch.Tensor): Diabatic forces of the
+            lower and higher state of every pair, of size (P, N, 3).
+
+    """
+    is_high = other_is_high.view(-1, 1, 1)
+    f_low = torch.where(is_high, f_state, f_other)
+    f_high = torch.where(is_high, f_other, f_state)
+    f_pp_low = torch.where(is_high, f_pp_state, f_pp_other)
+    f_pp_high = torch.where(is_high, f_pp_other, f_pp_state)
+
+    bt = (coord_prev_prev - coord).reciprocal()
+    dr_pp = coord_prev - coord_prev_prev
+    dr = coord_prev - coord
+    f_ia_1 = bt * (f_low * dr_pp - f_pp_high * dr)
+    f_ia_2 = bt * (f_high * dr_pp - f_pp_low * dr)
+
+    return ZNForces(f_ia_1, f_ia_2)
+
+
+def _zn_probability(
+        topology: SystemTopology,
+        zn_forces: ZNForces,
+        gap: torch.Tensor,
+        excess_e: torch.Tensor
+    ) -> torch.Tensor:
+    """
+    Computes the Zhu-Nakamura hopping probability of every pair.
+
+    Args:
+        topology (SystemTopology): Topology of the molecular system.
+        zn_forces (ZNForces): Diabatic forces of every pair, see _zn_forces.
+        gap (torch.Tensor): Energy gap of every pair at the crossing point, of
+            size (P).
+        excess_e (torch.Tensor): Total energy above the average energy of
+            every pair at the crossing point, of size (P).
+
+    Returns:
+        p (torch.Tensor): Hopping probabilities of size (P), 0 for pairs
+            without enough energy to reach the crossing point.
+
+    """
+    f_ia_1, f_ia_2 = zn_forces
+    f_a = ((f_ia_2 - f_ia_1).pow(2) * topology.inv_mass_col).sum(dim=(-2, -1)).sqrt()
+    f_b = (f_ia_1 * f_ia_2 * topology.inv_mass_col).sum(dim=(-2, -1)).abs().sqrt()
+    a_2 = (f_a * f_b) / (2 * gap.pow(3))
+    b_2 = excess_e * f_a / (f_b * gap)
+    s = (f_ia_1 * f_ia_2).sum(dim=(-2, -1)).sign()
+
+    n = math.pi / (4 * a_2.sqrt())
+    m = (2 / (b_2 + (b_2.pow(2) + s).abs().sqrt())).sqrt()
+    p = torch.exp(-n * m)
+
+    return torch.where(b_2 >= 0, p, torch.zeros_like(p)).nan_to_num(0.0)
+
+
+@_step_kernel(dynamic=True)
+def _zn_rows(
+        topology: SystemTopology,
+        zn_forces: ZNForces,
+        gap: torch.Tensor,
+        excess_e: torch.Tensor
+    ) -> P_NACS:
+    """
+    Computes the hopping probabilities and the normalized coupling vectors
+    of P state pairs, see _zn_probability.
+
+    """
+    p = _zn_probability(topology, zn_forces, gap, excess_e)
+    nacs = (zn_forces.f_ia_2 - zn_forces.f_ia_1) * topology.inv_mass_sq_col
+    norm = nacs.pow(2).sum(dim=(-2, -1), keepdim=True).sqrt()
+
+    return P_NACS(p, (nacs / norm).nan_to_num(0.0))
+
+
+class ZNPairs(NamedTuple):
+    """
+    State pairs gathered into rows, P rows in total.
+
+    traj: flat trajectory index of every pair of size (P)
+    state: current state of every pair of size (P)
+    other: other state of every pair of size (P)
+    forces: ZNForces of every pair
+    gap: adiabatic energy gap at the crossing point of size (P)
+    excess_e: total energy above the average pair energy of size (P)
+
+    """
+    traj: torch.Tensor
+    state: torch.Tensor
+    other: torch.Tensor
+    forces: ZNForces
+    gap: torch.Tensor
+    excess_e: torch.Tensor
+
+
+def _zn_pairs(
+        mask: torch.Tensor,
+        state: torch.Tensor,
+        coord: torch.Tensor,
+        coord_prev: torch.Tensor,
+        coord_prev_prev: torch.Tensor,
+        energies_prev: torch.Tensor,
+        forces: torch.Tensor,
+        forces_prev_prev: torch.Tensor,
+        gap: torch.Tensor,
+        ke: torch.Tensor
+    ) -> ZNPairs:
+    """
+    Gathers the terms shared by internal conversion and intersystem crossing
+    for the pairs selected by ``mask``, with every leading dimension of the
+    inputs flattened into one trajectory dimension.
+
+    """
+    nstates = mask.size(dim=-1)
+    traj, other = mask.reshape(-1, nstates).nonzero(as_tuple=True)
+    s = state.reshape(-1)[traj]
+    forces = forces.reshape(-1, *forces.shape[-3:])
+    forces_prev_prev = forces_prev_prev.reshape(-1, *forces.shape[-3:])
+    coords = [c.reshape(-1, *c.shape[-2:])[traj] for c in [coord, coord_prev, coord_prev_prev]]
+
+    zn_forces = _zn_forces(
+        other > s,
+        forces[traj, s],
+        forces[traj, other],
+        forces_prev_prev[traj, s],
+        forces_prev_prev[traj, other],
+        *coords
+    )
+    e_prev = energies_prev.reshape(-1, nstates)
+    e_s, e_o = e_prev[traj, s], e_prev[traj, other]
+    excess_e = e_s + ke.reshape(-1)[traj] - (e_s + e_o) / 2
+
+    return ZNPairs(traj, s, other, zn_forces, gap.reshape(-1, nstates)[traj, other], excess_e)
+
+
+def _batch_state_ke(
+        state: Union[int, torch.Tensor],
+        ke: torch.Tensor,
+        energies: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Broadcasts the current state to the batch shape of ``energies`` and
+    flattens the kinetic energy to one value per trajectory.
+
+    """
+    batch_shape = energies.shape[:-1]
+    state = torch.as_tensor(state, device=energies.device).expand(batch_shape)
+    ke = torch.as_tensor(ke, device=energies.device).reshape(-1).expand(batch_shape.numel())
+
+    return state, ke
+
+
+def _zn_evaluate(
+        screen: torch.Tensor,
+        gap: torch.Tensor,
+        state: torch.Tensor,
+        topology: SystemTopology,
+        coord: torch.Tensor,
+        coord_prev: torch.Tensor,
+        coord_prev_prev: torch.Tensor,
+        energies_prev: torch.Tensor,
+        forces: torch.Tensor,
+        forces_prev_prev: torch.Tensor,
+        ke: torch.Tensor
+    ) -> P_NACS:
+    """
+    Evaluates the Zhu-Nakamura probabilities and coupling vectors of the pairs
+    that passed the screen, every other pair is 0. Raises a RuntimeError if
+    the forces of a screened pair are missing, i.e. left out by a force gap
+    window, rather than suppressing its hop.
+
+    Args:
+        screen (torch.Tensor): Pairs to evaluate, of size (..., K).
+        gap (torch.Tensor): Adiabatic gap at the crossing point of every pair,
+            of size (..., K).
+        state (torch.Tensor): The current state, of the batch shape.
+        ke (torch.Tensor): Kinetic energies, flattened, see _batch_state_ke.
+
+    Returns:
+        (P_NACS)
+
+    """
+    nstates = screen.size(dim=-1)
+    p = energies_prev.new_zeros(screen.shape)
+    nacs = forces.new_zeros(forces.shape)
+    npairs = int(screen.sum())
+    zn_screen_counters.update(pairs=screen[..., 0].numel() * (nstates - 1), evaluated=npairs)
+    if npairs == 0:
+        return P_NACS(p, nacs)
+
+    pairs = _zn_pairs(
+        screen, state, coord, coord_prev, coord_prev_prev, energies_prev, forces, forces_prev_prev, gap, ke
+    )
+    for f in [forces, forces_prev_prev]:
+        f = f.reshape(-1, *forces.shape[-3:])
+        if not (f[pairs.traj, pairs.state].isfinite().all() and f[pairs.traj, pairs.other].isfinite().all()):
+            raise RuntimeError(
+                'forces of a state pair screened for surface hopping are missing, widen the force gap window'
+            )
+    p_rows, nacs_rows = _zn_rows(topology, pairs.forces, pairs.gap, pairs.excess_e)
+    p.view(-1, nstates)[pairs.traj, pairs.other] = p_rows
+    nacs.view(-1, *forces.shape[-3:])[pairs.traj, pairs.other] = nacs_rows
+
+    return P_NACS(p, nacs)
+
+
 def _internal_conversion(
-        cur_state: int,
-        other_state: int,
-        mass: torch.Tensor,
+        state: Union[int, torch.Tensor],
+        topology: SystemTopology,
         coord: torch.Tensor,
         coord_prev: torch.Tensor,
         coord_prev_prev: torch.Tensor,
-        velo: torch.Tensor,
         energies: torch.Tensor,
         energies_prev: torch.Tensor,
         energies_prev_prev: torch.Tensor,
         forces: torch.Tensor,
-        forces_prev: torch.Tensor,
         forces_prev_prev: torch.Tensor,
         ke: torch.Tensor,
-        ic_e_thresh: float
+        ic_e_thresh: float,
+        mask: Optional[torch.Tensor]=None
     ) -> P_NACS:
     """
-    Computes a tensor of internal conversion hopping probabilities between
-    the current electronic state and every other state.
+    Computes the internal conversion hopping probabilities and non-adiabatic
+    coupling vectors between the current electronic state and every state in
+    one vectorized call.
+
+    A cheap pre-screen on the gap history selects the pairs whose gap has a
+    local minimum below ``ic_e_thresh`` at the previous step, the Zhu-Nakamura
+    formula only runs for those, see _gap_screen and zn_screen_counters.
+
+    Every tensor may carry a leading batch dimension B, with one state and
+    one kinetic energy per trajectory.
 
     Args:
-        cur_state (int): Electronic energy state of which this molecular system is
-            populating.
-        other_state (int): Electronic energy state of the other electronic
-            state in question
-        mass (torch.Tensor): Atomic mass tensor of size (N) where N is the
-            number of atoms.
-        coords (torch.Tensor): Coordinate positions of size (N, 3) where N is
+        state (int | torch.Tensor): Electronic energy state of which this
+            molecular system is populating, or a tensor of size (B).
+        topology (SystemTopology): Topology of the molecular system.
+        coord (torch.Tensor): Coordinate positions of size (N, 3) where N is
             the number of atoms and 3 corresponds to x, y, and z positions in
             Angstroms.
             *current coordinates
-        coords_prev (torch.Tensor): Coordinate positions of size (N, 3) where
-            N is the number of atoms and 3 corresponds to x, y, and z positions
-            in Angstroms.
+        coord_prev (torch.Tensor): Coordinate positions of size (N, 3).
             *prev coordinates
-        coords_prev_prev (torch.Tensor): Coordinate positions of size (N, 3)
-            where N is the number of atoms and 3 corresponds to x, y, and z
-            positions in Angstroms.
+        coord_prev_prev (torch.Tensor): Coordinate positions of size (N, 3).
             *prev prev coordinates
-        velo (torch.Tensor): Atomic velocities with respect to the x, y, and z
-            axis given by a tensor of size (N, 3) where N is the number of
-            atoms.
         energies (torch.Tensor): A potential energy tensor of size K where K
             is the number of electronic states.
             *current energies
-        energies_prev (torch.Tensor): A potential energy tensor of size K where
-            K is the number of electronic states.
+        energies_prev (torch.Tensor): A potential energy tensor of size K.
             *prev step energies
-        energies_prev_prev (torch.Tensor): A potential energy tensor of size K
-            where K is the number of electronic states.
+        energies_prev_prev (torch.Tensor): A potential energy tensor of size K.
             *prev prev step energies
-        forces (torch.Tensor): An atomic force tensor with respect to the x, y,
-            and z axis given by a tensor of size (K, N, 3), where K is the
-            number of electronic states and N is the number of atoms.
+        forces (torch.Tensor): An atomic force tensor of size (K, N, 3).
             *current forces
-        forces_prev (torch.Tensor): An atomic force tensor with respect to the
-            x, y, and z axis given by a tensor of size (K, N, 3), where K is
-            the number of electronic states and N is the number of atoms.
-            *prev step forces
-        forces_prev_prev (torch.Tensor): An atomic force tensor with respect to
-            the x, y, and z axis given by a tensor of size (K, N, 3), where K
-            is the number of electronic states and N is the number of atoms.
+        forces_prev_prev (torch.Tensor): An atomic force tensor of size
+            (K, N, 3).
             *prev prev step forces
         ke (torch.Tensor): A scalar value representing the total kinetic
-            energy of the molecular system.
+            energy of the molecular system, or a tensor of size (B).
         ic_e_thresh (torch.Tensor): energy gap threshold to compute Zhu-
             Nakamura surface hopping between the same spin states
+        mask (torch.Tensor | None): An optional boolean tensor of size (K) or
+            (B, K) restricting the pairs, e.g. to states of the same spin.
          
     Returns:
-        p, nacs (torch.Tensor, torch.Tensor): The hopping probability between
-            the two given electronic states and the non-adiabatic matrix.
+        p, nacs (torch.Tensor, torch.Tensor): The hopping probabilities of
+            size (K) and the normalized non-adiabatic coupling vectors of size
+            (K, N, 3) between the current state and every state, with a
+            leading B for a batch. Pairs that do not pass the pre-screen and
+            the current state are 0.
 
     """
-
-    delta_e = _delta_e(cur_state, other_state, energies, energies_prev, energies_prev_prev)
-    e = energies_prev[cur_state] + ke
-    avg_e = (energies_prev[other_state] + energies_prev[cur_state]) / 2
-
-    # check hop condition
-
-    low_state = min(other_state, cur_state)
-    high_state = max(other_state, cur_state)
-
-    bt = -1 / (coord - coord_prev_prev) # (51, 3)
-    tf1_1 = forces[low_state] * (coord_prev - coord_prev_prev) # (51, 3)
-    tf2_1 = forces_prev_prev[high_state] * (coord_prev - coord) # (51, 3)
-    f_ia_1 = bt * (tf1_1 - tf2_1) # (51, 3)
-
-    tf1_2 = forces[high_state] * (coord_prev - coord_prev_prev) # (51, 3)
-    tf2_2 = forces_prev_prev[low_state] * (coord_prev - coord) # (51, 3)
-    f_ia_2 = bt * (tf1_2 - tf2_2) # (51, 3)
-
-    f_a = torch.sum((f_ia_2 - f_ia_1) ** 2 / mass) ** 0.5
-    f_b = torch.sum(f_ia_1 * f_ia_2 / mass).abs() ** 0.5
-    a_2 = (f_a * f_b) / (2 * delta_e ** 3)
-    n = math.pi / (4 * a_2 ** 0.5)
-
-    b_2 = (e - avg_e) * f_a / (f_b * delta_e)
-    s = torch.sum(f_ia_1 * f_ia_2).sign()
-    m = 2 / ((b_2 + torch.abs(b_2 ** 2 + s)) ** 0.5)
-
-    p = torch.exp(-n * m)
-
-    pnacs = (f_ia_2 - f_ia_1) / mass.pow(2)
-    nacs = pnacs / torch.sum(pnacs ** 2).pow(0.5)
-    
-    return P_NACS(p, nacs)
-
-
-if __name__ == '__main__':
-    ntests = 1
-    ntests_passed = 0
-
-    _NATOMS = 51
-    _NSTATES = 3
-
-    cur_state = 0
-    other_state = 1
-    mass = torch.rand(_NATOMS)
-    coord = torch.rand(_NATOMS, 3)
-    coord_prev = torch.rand(_NATOMS, 3)
-    coord_prev_prev = torch.rand(_NATOMS, 3)
-    velo = torch.rand(_NATOMS, 3)
-    energies = torch.rand(_NSTATES)
-    energies_prev = torch.rand(_NSTATES)
-    energies_prev_prev = torch.rand(_NSTATES)
-    forces = torch.rand(_NSTATES, _NATOMS, 3)
-    forces_prev = torch.rand(_NSTATES, _NATOMS, 3)
-    forces_prev_prev = torch.rand(_NSTATES, _NATOMS, 3)
-    ke = torch.rand(1)
-    ic_e_thresh = 0.3 
-
-    d_e = _delta_e(
-        cur_state=cur_state,
-        other_state=other_state,
-        energies=energies,
-        energies_prev=energies_prev,
-        energies_prev_prev=energies_prev_prev
-    )
-
-    assert d_e.size() == torch.Size([3])
-    ntests_passed += 1
-
-    p, nacs = _internal_conversion(
-        cur_state=cur_state,
-        other_state=other_state,
-        mass=mass,
+    state, ke = _batch_state_ke(state, ke, energies)
+    delta_e = _delta_e(state, energies, energies_prev, energies_prev_prev)
+    screen = _gap_screen(delta_e, ic_e_thresh)
+    if mask is not None:
+        screen &= mask
+
+    return _zn_evaluate(
+        screen=screen,
+        gap=delta_e[..., 1, :],
+        state=state,
+        topology=topology,
         coord=coord,
         coord_prev=coord_prev,
         coord_prev_prev=coord_prev_prev,
-        velo=velo,
-        energies=energies,
         energies_prev=energies_prev,
-        energies_prev_prev=energies_prev_prev,
         forces=forces,
-        forces_prev=forces_prev,
         forces_prev_prev=forces_prev_prev,
-        ke=ke,
-        ic_e_thresh=ic_e_thresh
-    ) 
-
-    print('p:', p)
-    print('nacs:', nacs)
-    # assert p.size == torch.Size([]) and nacs.size() == torch.Size([])
-    ntests_passed += 1
-
-    print(f'Passes {ntests_passed}/{ntests} tests!')
-
-
-
-
-
-
+        ke=ke
+    )
 
 
+if __name__ == '__main__':
+    import time
 
+    ntests = 6
+    ntests_passed = 0
 
+    _NATOMS = 51
+    _NSTATES = 4
+    _NTRAJ = 8
+
+    def _pair(state, other, topology, coord, coord_prev, coord_prev_prev, energies, energies_prev, forces, forces_prev_prev, ke):
+        # one pair at a time, as surface hopping used to loop over states
+        gap = (energies_prev[other] - energies_prev[state]).abs()
+        e = energies_prev[state] + ke
+        avg_e = (energies_prev[other] + energies_prev[state]) / 2
+        low, high = min(other, state), max(other, state)
+        bt = -1 / (coord - coord_prev_prev)
+        f_ia_1 = bt * (forces[low] * (coord_prev - coord_prev_prev) - forces_prev_prev[high] * (coord_prev - coord))
+        f_ia_2 = bt * (forces[high] * (coord_prev - coord_prev_prev) - forces_prev_prev[low] * (coord_prev - coord))
+        f_a = torch.sum((f_ia_2 - f_ia_1) ** 2 * topology.inv_mass_col) ** 0.5
+        f_b = torch.sum(f_ia_1 * f_ia_2 * topology.inv_mass_col).abs() ** 0.5
+        a_2 = (f_a * f_b) / (2 * gap ** 3)
+        b_2 = (e - avg_e) * f_a / (f_b * gap)
+        s = torch.sum(f_ia_1 * f_ia_2).sign()
+        p = torch.exp(-math.pi / (4 * a_2 ** 0.5) * (2 / (b_2 + torch.abs(b_2 ** 2 + s) ** 0.5)) ** 0.5)
+        pnacs = (f_ia_2 - f_ia_1) * topology.inv_mass_sq_col
+        return p if b_2 >= 0 else torch.zeros_like(p), pnacs / torch.sum(pnacs ** 2).pow(0.5)
+
+    torch.manual_seed(0)
+    topology = SystemTopology.build(torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    coord = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev = coord + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev_prev = coord_prev + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    energies, energies_prev_prev = torch.rand(2, _NTRAJ, _NSTATES, dtype=torch.float64).mul(0.5).unbind(0)
+    energies_prev = torch.rand(_NTRAJ, _NSTATES, dtype=torch.float64).mul(0.1)
+    forces = 0.01 * torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    forces_prev_prev = 0.01 * torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    ke = 0.1 * torch.rand(_NTRAJ, dtype=torch.float64)
+    state = torch.randint(_NSTATES, (_NTRAJ,))
+
+    d_e = _delta_e(state, energies, energies_prev, energies_prev_prev)
+    assert d_e.size() == torch.Size([_NTRAJ, 3, _NSTATES])
+    assert torch.allclose(d_e[3, 2, 1], (energies_prev_prev[3, 1] - energies_prev_prev[3, state[3]]).abs())
+    ntests_passed += 1
 
+    # every screened pair matches the single-pair formula, the rest are 0
+    _IC_E_THRESH = 0.06
+    screen = _gap_screen(d_e, _IC_E_THRESH)
+    assert not screen.gather(-1, state.unsqueeze(-1)).any()
+    assert 0 < screen.sum() < _NTRAJ * (_NSTATES - 1)
+    for b in range(_NTRAJ):
+        s = int(state[b])
+        p, nacs = _internal_conversion(
+            s, topology, coord[b], coord_prev[b], coord_prev_prev[b], energies[b], energies_prev[b],
+            energies_prev_prev[b], forces[b], forces_prev_prev[b], ke[b], _IC_E_THRESH
+        )
+        assert p.size() == torch.Size([_NSTATES]) and nacs.size() == torch.Size([_NSTATES, _NATOMS, 3])
+        assert (p[~screen[b]] == 0.0).all() and (nacs[~screen[b]] == 0.0).all()
+        for k in screen[b].nonzero().flatten().tolist():
+            p_k, nacs_k = _pair(
+                s, k, topology, coord[b], coord_prev[b], coord_prev_prev[b], energies[b], energies_prev[b],
+                forces[b], forces_prev_prev[b], ke[b]
+            )
+            assert torch.allclose(p[k], p_k) and torch.allclose(nacs[k], nacs_k)
+    ntests_passed += 1
 
+    # a batch of trajectories matches one call per trajectory
+    args = (topology, coord, coord_prev, coord_prev_prev, energies, energies_prev, energies_prev_prev, forces, forces_prev_prev, ke, _IC_E_THRESH)
+    p_b, nacs_b = _internal_conversion(state, *args)
+    assert p_b.size() == torch.Size([_NTRAJ, _NSTATES]) and (p_b > 0).any()
+    for b in range(_NTRAJ):
+        p, nacs = _internal_conversion(int(state[b]), *[a[b] if isinstance(a, torch.Tensor) else a for a in args])
+        assert torch.allclose(p_b[b], p) and torch.allclose(nacs_b[b], nacs)
+    ntests_passed += 1
 
+    # the counters see every pair once per call
+    zn_screen_counters.reset()
+    _internal_conversion(state, *args)
+    assert zn_screen_counters.pairs == _NTRAJ * (_NSTATES - 1)
+    assert zn_screen_counters.evaluated == int(screen.sum())
+    ntests_passed += 1
 
+    # forces left out by a gap window are fine unless their pair is screened
+    b, k = screen.nonzero()[0].tolist()
+    missing = forces.clone()
+    missing[~screen & (torch.arange(_NSTATES) != state.unsqueeze(-1))] = float('nan')
+    p_m, _ = _internal_conversion(state, *args[:7], missing, *args[8:])
+    assert torch.equal(p_m, p_b)
+    missing[b, k] = float('nan')
+    try:
+        _internal_conversion(state, *args[:7], missing, *args[8:])
+        assert False
+    except RuntimeError:
+        pass
+    ntests_passed += 1
 
+    # the three-point window interpolates in coordinates, the crossing point
+    # estimate does not depend on the time spacing of the steps around it
+    start = torch.rand(1, _NATOMS, 3, dtype=torch.float64)
+    direction = torch.randn(1, _NATOMS, 3, dtype=torch.float64)
+    f_0, f_1 = (0.01 * torch.randn(2, 2, _NATOMS, 3, dtype=torch.float64)).unbind(0)
+
+    def _adiabatic(s: float) -> torch.Tensor:
+        # two diabats with forces linear along a straight path cross at s = 0.5,
+        # the lower adiabatic state follows the other diabat past the crossing
+        f = f_0 + s * f_1
+        return f if s < 0.5 else f.flip(0)
+
+    estimates = []
+    for s_pp, s in [(0.0, 1.0), (0.2, 1.0), (0.45, 0.6)]:
+        f_s, f_pp = _adiabatic(s).unsqueeze(1), _adiabatic(s_pp).unsqueeze(1)
+        estimates.append(_zn_forces(
+            torch.tensor([True]), f_s[0], f_s[1], f_pp[0], f_pp[1],
+            start + s * direction, start + 0.5 * direction, start + s_pp * direction
+        ))
+    for f_ia_1, f_ia_2 in estimates[1:]:
+        assert torch.allclose(f_ia_1, estimates[0].f_ia_1) and torch.allclose(f_ia_2, estimates[0].f_ia_2)
+    ntests_passed += 1
 
+    print(f'Passes {ntests_passed}/{ntests} tests!')
 
+    _NREPEATS = 50
+    t = time.perf_counter()
+    for _ in range(_NREPEATS):
+        for b in range(_NTRAJ):
+            for k in range(_NSTATES):
+                if k != int(state[b]):
+                    _pair(int(state[b]), k, topology, coord[b], coord_prev[b], coord_prev_prev[b], energies[b],
+                          energies_prev[b], forces[b], forces_prev_prev[b], ke[b])
+    elapsed_pairs = (time.perf_counter() - t) / _NREPEATS
+    t = time.perf_counter()
+    for _ in range(_NREPEATS):
+        _internal_conversion(state, *args[:-1], float('inf'))
+    elapsed_batched = (time.perf_counter() - t) / _NREPEATS
+    zn_screen_counters.reset()
+    t = time.perf_counter()
+    for _ in range(_NREPEATS):
+        _internal_conversion(state, *args)
+    elapsed_screened = (time.perf_counter() - t) / _NREPEATS
+    print(f'{_NTRAJ} trajectories x {_NSTATES} states: pairwise {elapsed_pairs * 1e3:.2f}ms, '
+          f'batched without threshold {elapsed_batched * 1e3:.2f}ms, screened {elapsed_screened * 1e3:.2f}ms '
+          f'({zn_screen_counters.skip_ratio:.0%} of pairs skipped)')
@@ -1,14 +1,173 @@
 """
 STATUS: DEV
 
-"""
+Intersystem crossing probability by the Zhu-Nakamura Theory.
+
+States of different spin multiplicity cross, the adiabatic gap at the
+crossing point is twice the spin-orbit coupling between them. The gap
+history screen, the diabatic forces and the probability formula are shared
+with internal conversion.
 
+"""
 
 import torch
 
+from solvent_dynamics.computer._internal_conversion import (
+    P_NACS,
+    _batch_state_ke,
+    _delta_e,
+    _gap_screen,
+    _zn_evaluate
+)
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import Union
+
+
+def _other_spin(state: torch.Tensor, state_mult: torch.Tensor) -> torch.Tensor:
+    """
+    Selects the states of a different spin multiplicity than the current
+    state, of size (..., K).
+
+    """
+    return state_mult != state_mult[state].unsqueeze(-1)
+
+
+def _soc_gap(state: torch.Tensor, soc: torch.Tensor) -> torch.Tensor:
+    """
+    Gathers the adiabatic gap 2 |H_so| between the current state and every
+    state at the crossing point.
+
+    Args:
+        state (torch.Tensor): The current state, of the batch shape.
+        soc (torch.Tensor): Spin-orbit couplings of size (K, K), or of size
+            (B, K, K) for a batch.
+
+    Returns:
+        gap (torch.Tensor): Gaps of size (..., K).
+
+    """
+    nstates = soc.size(dim=-1)
+    soc = soc.expand(*state.shape, nstates, nstates)
+    idx = state.view(*state.shape, 1, 1).expand(*state.shape, 1, nstates)
+
+    return 2 * soc.gather(-2, idx).squeeze(-2).abs()
+
 
 def _intersystem_crossing(
-        ) -> None:
-    NotImplemented()
+        state: Union[int, torch.Tensor],
+        state_mult: torch.Tensor,
+        topology: SystemTopology,
+        coord: torch.Tensor,
+        coord_prev: torch.Tensor,
+        coord_prev_prev: torch.Tensor,
+        energies: torch.Tensor,
+        energies_prev: torch.Tensor,
+        energies_prev_prev: torch.Tensor,
+        forces: torch.Tensor,
+        forces_prev_prev: torch.Tensor,
+        soc: torch.Tensor,
+        ke: torch.Tensor,
+        isc_e_thresh: float
+    ) -> P_NACS:
+    """
+    Computes the intersystem crossing hopping probabilities between the
+    current electronic state and every state of a different spin
+    multiplicity in one vectorized call.
+
+    Every tensor may carry a leading batch dimension B, see
+    _internal_conversion for the shapes of the shared arguments.
+
+    Args:
+        state (int | torch.Tensor): Electronic energy state of which this
+            molecular system is populating, or a tensor of size (B).
+        state_mult (torch.Tensor): Spin multiplicity of size (K) for every
+            electronic state.
+        soc (torch.Tensor): Spin-orbit couplings between every two states of
+            size (K, K), or (B, K, K) for a batch, in the units of the
+            energies.
+        isc_e_thresh (float): energy gap threshold to compute Zhu-Nakamura
+            surface hopping between different spin states
+
+    Returns:
+        p, nacs (torch.Tensor, torch.Tensor): The hopping probabilities of
+            size (K) and the normalized coupling vectors of size (K, N, 3),
+            with a leading B for a batch. Pairs of the same spin, pairs
+            without coupling and pairs that do not pass the pre-screen are 0.
+
+    """
+    state, ke = _batch_state_ke(state, ke, energies)
+    delta_e = _delta_e(state, energies, energies_prev, energies_prev_prev)
+    gap = _soc_gap(state, soc)
+    screen = _gap_screen(delta_e, isc_e_thresh) & _other_spin(state, state_mult) & (gap > 0)
+
+    return _zn_evaluate(
+        screen=screen,
+        gap=gap,
+        state=state,
+        topology=topology,
+        coord=coord,
+        coord_prev=coord_prev,
+        coord_prev_prev=coord_prev_prev,
+        energies_prev=energies_prev,
+        forces=forces,
+        forces_prev_prev=forces_prev_prev,
+        ke=ke
+    )
+
+
+if __name__ == '__main__':
+    from solvent_dynamics.computer._internal_conversion import _zn_pairs, _zn_probability
+
+    ntests = 2
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NSTATES = 5
+    _NTRAJ = 8
+    _ISC_E_THRESH = 0.06
+
+    torch.manual_seed(0)
+    topology = SystemTopology.build(torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    state_mult = torch.tensor([1, 1, 3, 3, 3])
+    coord = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev = coord + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev_prev = coord_prev + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    energies, energies_prev_prev = torch.rand(2, _NTRAJ, _NSTATES, dtype=torch.float64).mul(0.5).unbind(0)
+    energies_prev = torch.rand(_NTRAJ, _NSTATES, dtype=torch.float64).mul(0.1)
+    forces = 0.01 * torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    forces_prev_prev = 0.01 * torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    soc = torch.rand(_NSTATES, _NSTATES, dtype=torch.float64).mul(1e-3)
+    soc = (soc + soc.T) * (state_mult.unsqueeze(0) != state_mult.unsqueeze(1))
+    ke = 0.1 * torch.rand(_NTRAJ, dtype=torch.float64)
+    state = torch.randint(_NSTATES, (_NTRAJ,))
+    args = (
+        state_mult, topology, coord, coord_prev, coord_prev_prev, energies, energies_prev, energies_prev_prev,
+        forces, forces_prev_prev, soc, ke, _ISC_E_THRESH
+    )
+
+    # only singlet-triplet pairs, every pair with the gap of its coupling
+    p, nacs = _intersystem_crossing(state, *args)
+    screen = _gap_screen(_delta_e(state, energies, energies_prev, energies_prev_prev), _ISC_E_THRESH)
+    other_spin = state_mult != state_mult[state].unsqueeze(-1)
+    assert (p[~(screen & other_spin)] == 0.0).all() and (p > 0).any()
+    for b, k in (screen & other_spin).nonzero().tolist():
+        mask = torch.zeros(_NTRAJ, _NSTATES, dtype=torch.bool)
+        mask[b, k] = True
+        pairs = _zn_pairs(
+            mask, state, coord, coord_prev, coord_prev_prev, energies_prev, forces, forces_prev_prev,
+            torch.full((_NTRAJ, _NSTATES), 2 * float(soc[state[b], k]), dtype=torch.float64), ke
+        )
+        assert torch.allclose(p[b, k], _zn_probability(topology, pairs.forces, pairs.gap, pairs.excess_e)[0])
+    ntests_passed += 1
 
+    # a batch of trajectories matches one call per trajectory
+    for b in range(_NTRAJ):
+        p_b, nacs_b = _intersystem_crossing(
+            int(state[b]), state_mult, topology, coord[b], coord_prev[b], coord_prev_prev[b], energies[b],
+            energies_prev[b], energies_prev_prev[b], forces[b], forces_prev_prev[b], soc, ke[b], _ISC_E_THRESH
+        )
+        assert torch.allclose(p_b, p[b]) and torch.allclose(nacs_b, nacs[b])
+    ntests_passed += 1
 
+    print(f'Passes {ntests_passed}/{ntests} tests!')
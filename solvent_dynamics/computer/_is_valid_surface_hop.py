@@ -5,8 +5,63 @@ STATUS: DEV
 
 import torch
 
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import NamedTuple
+
+
+class NacProjection(NamedTuple):
+    """
+    Terms of the kinetic energy after a velocity change along a coupling
+    vector d, v' = v - gamma * d / m, which reads
+    KE' = KE - gamma * b + gamma ** 2 * a.
+
+    a: 0.5 * sum(d ** 2 / m)
+    b: sum(v * d)
+
+    """
+    a: torch.Tensor
+    b: torch.Tensor
+
+
+def _nac_projection(
+        topology: SystemTopology,
+        velo: torch.Tensor,
+        nacs: torch.Tensor
+    ) -> NacProjection:
+    a = 0.5 * (nacs.pow(2) * topology.inv_mass_col).sum(dim=(-2, -1))
+    b = (velo * nacs).sum(dim=(-2, -1))
+
+    return NacProjection(a, b)
+
 
 def _is_valid_surface_hop(
-        ) -> torch.Tensor:
-    NotImplemented()
+        topology: SystemTopology,
+        velo: torch.Tensor,
+        nacs: torch.Tensor,
+        delta_e: torch.Tensor
+    ) -> torch.Tensor:
+    """
+    Checks energy conservation of hops: the kinetic energy along the coupling
+    vector must cover the potential energy gained by the hop, so that KE + E
+    is kept as by the Verlet steps.
+
+    Velocities may carry a leading batch dimension B, one hop is checked per
+    trajectory.
+
+    Args:
+        topology (SystemTopology): Topology of the molecular system.
+        velo (torch.Tensor): Atomic velocities of size (N, 3).
+        nacs (torch.Tensor): Coupling vector towards the target state of size
+            (N, 3).
+        delta_e (torch.Tensor): Potential energy of the target state minus
+            that of the current state, a scalar.
+
+    Returns:
+        valid (torch.Tensor): A boolean scalar, or of size (B), False for
+            frustrated hops.
+
+    """
+    a, b = _nac_projection(topology, velo, nacs)
 
+    return b.pow(2) - 4 * a * delta_e >= 0
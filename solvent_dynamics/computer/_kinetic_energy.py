@@ -1,36 +1,32 @@
 """
 STATUS: SYNTAX PASS
 
-# optimizations:
-    - vmap or dimensional multiplication to avoid for loop
-
 """
 
 import torch
 
+from solvent_dynamics.computer._system_topology import SystemTopology
+
 
-def _kinetic_energy(mass: torch.Tensor, velo: torch.Tensor) -> torch.Tensor:
+def _kinetic_energy(topology: SystemTopology, velo: torch.Tensor) -> torch.Tensor:
     """
     Computes the total kinetic energy of a molecular system.
 
+    Velocities may carry a leading batch dimension B, in which case one
+    kinetic energy is returned per trajectory.
+
     Args:
-        mass (torch.Tensor): Atomic masses of size (N) where N is the number
-            of atoms in the molecular system.
+        topology (SystemTopology): Topology of the molecular system.
         velo (torch.Tensor): Atomic velocities of size (N, 3) where N is the
             number of atoms in the molecular system and 3 corresponds to
             velocities in the x, y, and z directions.
 
     Returns:
         ke (torch.Tensor): A scalar value representing the total kinetic
-            energy of the molecular system.
+            energy of the molecular system, or a tensor of size (B).
 
     """
-    natoms = velo.size(dim=0)
-    ke_c = []
-    for i in range(natoms):
-        ke_c.append(torch.sum(0.5 * mass[i] * velo[i].pow(2)))
-
-    ke = torch.stack(ke_c, dim=0).sum()
+    ke = 0.5 * torch.sum(topology.mass_col * velo.pow(2), dim=(-2, -1))
 
     return ke
 
@@ -39,11 +35,11 @@ if __name__ == '__main__':
     ntests = 1
     ntests_passed = 0
 
-    mass = torch.rand(51)
+    topology = SystemTopology.build(torch.rand(51), torch.ones(51), {'C': torch.tensor(1.)})
     velo = torch.rand(51, 3)
 
     ke = _kinetic_energy(
-        mass=mass,
+        topology=topology,
         velo=velo
     )
 
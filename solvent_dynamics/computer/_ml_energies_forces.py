@@ -1,26 +1,150 @@
 """
-STATUS: NOT TESTED
+STATUS: DEV
 
 """
 
 import torch
+import weakref
+import warnings
 
 from torch_geometric.data.data import Data
-from typing import NamedTuple, Optional
+
+from solvent_dynamics import constants
+from solvent_dynamics.computer._profiler import _phase
+
+from typing import NamedTuple, Optional, Union
 
 
 class EnergiesForces(NamedTuple):
     energies: torch.Tensor
     forces: torch.Tensor
 
-def _ml_forces(energies: torch.Tensor, pos: torch.Tensor) -> torch.Tensor:
-    pos.requires_grad = True
-    nstates = energies.size(dim=0)
-    forces = []
-    for i in range(nstates):
-        f = torch.autograd.grad(-energies[i], pos, create_graph=True, retain_graph=True)[0]
-        forces.append(f)
-    forces = torch.stack(forces, dim=0)
+
+# models whose backward failed under batched gradients, e.g. custom autograd
+# ops without a batching rule, differentiated per state from then on
+_no_batched_grads: 'weakref.WeakSet[torch.nn.Module]' = weakref.WeakSet()
+
+def _force_mask(
+        state: Union[int, torch.Tensor],
+        energies: torch.Tensor,
+        gap_window: float
+    ) -> torch.Tensor:
+    """
+    Selects the electronic states whose forces are needed: the populated state
+    and every state within ``gap_window`` of it.
+
+    Args:
+        state (int | torch.Tensor): The populated electronic state, or a tensor
+            of size (B) with one state per structure.
+        energies (torch.Tensor): Energies of size (K), or (B, K) for a batch.
+        gap_window (float): Max energy gap to the populated state, in the
+            units of ``energies``.
+
+    Returns:
+        mask (torch.Tensor): A boolean tensor of the same size as ``energies``.
+
+    """
+    state = torch.as_tensor(state, device=energies.device).unsqueeze(-1)
+    gap = (energies - energies.gather(-1, state)).abs()
+    mask = gap < gap_window
+    mask.scatter_(-1, state, True)
+
+    return mask
+
+def _check_gap_window(
+        gap_window: float,
+        ic_e_thresh: float=constants.INTERNAL_CONVERSION_ENERGY_GAP,
+        isc_e_thresh: float=constants.INTERSYSTEM_CROSSING_ENERGY_GAP,
+        margin: float=constants.FORCE_GAP_WINDOW_MARGIN
+    ) -> None:
+    """
+    Raises a ValueError if a force gap window is too narrow for the state
+    pairs screened by surface hopping, whose forces would be missing.
+
+    Args:
+        gap_window (float): Max energy gap to the populated state, see
+            _force_mask.
+        ic_e_thresh (float): Energy gap threshold of internal conversion.
+        isc_e_thresh (float): Energy gap threshold of intersystem crossing.
+        margin (float): How far past the thresholds gaps may open between the
+            crossing point and the steps whose forces are read.
+
+    Returns:
+        None
+
+    """
+    min_window = max(ic_e_thresh, isc_e_thresh) + margin
+    if gap_window < min_window:
+        raise ValueError(f'force gap window {gap_window} is below {min_window}, the hopping thresholds plus a margin')
+
+def _ml_forces(
+        energies: torch.Tensor,
+        pos: torch.Tensor,
+        force_mode: str='SINGLE_PASS',
+        create_graph: bool=False,
+        force_mask: Optional[torch.Tensor]=None
+    ) -> torch.Tensor:
+    """
+    Differentiates the energies of every electronic state with respect to
+    the atomic positions.
+
+    Args:
+        energies (torch.Tensor): Energies of size (K) for a single structure
+            or (B, K) for a batch of B structures of equal size, where K is
+            the number of electronic states.
+        pos (torch.Tensor): Atomic positions of size (N, 3), or (B * N, 3)
+            for a batch, from which ``energies`` were computed.
+        force_mode (str): one of "SINGLE_PASS" | "PER_STATE". "SINGLE_PASS"
+            runs one batched backward pass for all K states, "PER_STATE" runs
+            K backward passes for models whose backward does not support
+            batched gradients.
+        create_graph (bool): Whether to build the graph of the derivative,
+            only needed to differentiate the forces again.
+        force_mask (torch.Tensor | None): An optional boolean tensor of the
+            same size as ``energies`` selecting the forces to compute.
+
+    Returns:
+        forces (torch.Tensor): Forces of size (K, N, 3), or (B, K, N, 3) for
+            a batch. Forces of states excluded by ``force_mask`` are NaN.
+
+    """
+    nstates = energies.size(dim=-1)
+    if force_mask is None:
+        idxs = torch.arange(nstates)
+    else:
+        idxs = force_mask.reshape(-1, nstates).any(dim=0).nonzero().flatten().cpu()
+    if force_mode == 'SINGLE_PASS':
+        # row k of the batched grad_outputs selects state k of every structure
+        grad_outputs = -torch.eye(nstates, dtype=energies.dtype, device=energies.device)[idxs]
+        grad_outputs = grad_outputs.view(idxs.numel(), *[1] * (energies.dim() - 1), nstates)
+        forces = torch.autograd.grad(
+            energies,
+            pos,
+            grad_outputs=grad_outputs.expand(idxs.numel(), *energies.shape),
+            create_graph=create_graph,
+            # kept for a per-state retry if the batched backward fails
+            retain_graph=True,
+            is_grads_batched=True
+        )[0]
+    elif force_mode == 'PER_STATE':
+        forces = []
+        for i in idxs.tolist():
+            # structures in a batch are independent, so the gradient of the summed
+            # energies gives every structure its own forces in a single pass
+            f = torch.autograd.grad(-energies[..., i].sum(), pos, create_graph=create_graph, retain_graph=True)[0]
+            forces.append(f)
+        forces = torch.stack(forces, dim=0)
+    else:
+        raise ValueError(f'invalid force mode: {force_mode}')
+    if force_mask is not None:
+        # skipped states are NaN so that nothing downstream reads stale forces
+        all_forces = forces.new_full((nstates, *pos.shape), float('nan'))
+        all_forces[idxs.to(forces.device)] = forces
+        forces = all_forces
+    if energies.dim() == 2:
+        forces = forces.view(nstates, energies.size(dim=0), -1, 3).transpose(0, 1)
+    if force_mask is not None:
+        forces = forces.masked_fill(~force_mask.view(*force_mask.shape, 1, 1), float('nan'))
 
     return forces
 
@@ -29,18 +153,93 @@ def _ml_energies_forces(
         res_model: Optional[torch.nn.Module],
         structure: Data,
         u_energy_evs: float,
-        rms_force_evs: float
+        rms_force_evs: float,
+        force_mode: str='SINGLE_PASS',
+        create_graph: bool=False,
+        state: Optional[Union[int, torch.Tensor]]=None,
+        gap_window: Optional[float]=None,
+        out_dtype: Optional[torch.dtype]=None
     ) -> EnergiesForces:
-    y = model(structure)
-    if res_model:
-        y = res_model(y)
-    e = y * rms_force_evs + u_energy_evs
-    f = _ml_forces(y, structure.pos) * rms_force_evs
+    """
+    Infers the energies and forces of every electronic state.
+
+    Args:
+        model (torch.nn.Module): A trained and loaded neural network model.
+        res_model (torch.nn.Module | None): An optional residual block placed
+            on top of the outputs of the standard model.
+        structure (Data | Batch): A single structure, or a batch of B
+            structures with an equal number of atoms, for which the model
+            returns energies of size (K) or (B, K) respectively.
+        u_energy_evs (float): Energy normalization offset.
+        rms_force_evs (float): Energy and force normalization scale.
+        force_mode (str): one of "SINGLE_PASS" | "PER_STATE", see _ml_forces.
+            A model whose backward fails under "SINGLE_PASS" falls back to
+            "PER_STATE" with a warning, for every later call as well.
+        create_graph (bool): Whether to keep the returned energies and forces
+            attached to the autograd graph of the model.
+        state (int | torch.Tensor | None): The populated electronic state, or
+            one state per structure, required by ``gap_window``.
+        gap_window (float | None): If given, only the forces of ``state`` and
+            of states within this energy gap of it are computed, see
+            _force_mask. Forces of every other state are NaN.
+        out_dtype (torch.dtype | None): An optional floating point type of
+            the energies and forces, the normalization is applied in this
+            type, e.g. float64 for a float32 model, see PrecisionPolicy.
+
+    Returns:
+        energies, forces (torch.Tensor, torch.Tensor): Energies of size (K)
+            and forces of size (K, N, 3), or (B, K) and (B, K, N, 3) for a
+            batch.
+
+    """
+    pos = structure.pos
+    if not (pos.requires_grad and (pos.is_leaf or create_graph)):
+        # an alias of the positions, the autograd state of the caller's
+        # tensor is left untouched
+        structure.pos = pos.detach().requires_grad_(True)
+    with _phase('forward'):
+        y = model(structure)
+        if res_model:
+            y = res_model(y)
+    # the offset is large against energy differences, added in the output type
+    e = (y if out_dtype is None else y.to(out_dtype)) * rms_force_evs + u_energy_evs
+    force_mask = None
+    if gap_window is not None:
+        assert state is not None, 'a gap window requires the populated state'
+        force_mask = _force_mask(state, e.detach(), gap_window)
+    if force_mode == 'SINGLE_PASS' and model in _no_batched_grads:
+        force_mode = 'PER_STATE'
+    with _phase('backward'):
+        try:
+            f = _ml_forces(
+                y,
+                structure.pos,
+                force_mode=force_mode,
+                create_graph=create_graph,
+                force_mask=force_mask
+            )
+        except RuntimeError as err:
+            if force_mode != 'SINGLE_PASS':
+                raise
+            warnings.warn(f'batched gradients failed, falling back to the PER_STATE force mode: {err}')
+            _no_batched_grads.add(model)
+            f = _ml_forces(
+                y,
+                structure.pos,
+                force_mode='PER_STATE',
+                create_graph=create_graph,
+                force_mask=force_mask
+            )
+    f = (f if out_dtype is None else f.to(out_dtype)) * rms_force_evs
+    if not create_graph:
+        return EnergiesForces(e.detach(), f)
 
     return EnergiesForces(e.clone(), f.clone())
 
 
 if __name__ == '__main__':
+    import time
+
     _MODEL_FILE = '../_testing_utils/148.pt'
     _PRELOAD_FILE = '../_testing_utils/_preloaded-1.pkl'
     _NATOM_TYPES = 3
@@ -53,10 +252,120 @@ if __name__ == '__main__':
     _NEIGHBOR_RADIUS = 4.6
     _REDUCE_OUTPUT = False
 
-    ntests = 2
+    class _ToyModel(torch.nn.Module):
+        """
+        Smooth pairwise model standing in for the trained network.
+
+        """
+        def __init__(self, nstates: int) -> None:
+            super().__init__()
+            self._centers = torch.linspace(0.0, _NEIGHBOR_RADIUS, _NUMBER_OF_BASIS)
+            self._mlp = torch.nn.Sequential(
+                torch.nn.Linear(_NUMBER_OF_BASIS, _RADIAL_NEURONS),
+                torch.nn.SiLU(),
+                torch.nn.Linear(_RADIAL_NEURONS, nstates)
+            )
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            pos = structure.pos
+            d = (pos.unsqueeze(0) - pos.unsqueeze(1)).pow(2).sum(dim=-1).add(1e-6).sqrt()
+            rbf = torch.exp(-(d.unsqueeze(-1) - self._centers).pow(2))
+            if structure.batch is None:
+                return self._mlp(rbf.sum(dim=1)).sum(dim=0)
+            same_graph = structure.batch.unsqueeze(0) == structure.batch.unsqueeze(1)
+            e = self._mlp((rbf * same_graph.unsqueeze(-1)).sum(dim=1))
+            return torch.zeros(structure.num_graphs, e.size(dim=-1)).index_add(0, structure.batch, e)
+
+    ntests = 4
     ntests_passed = 0
 
-    assert ...
+    _NATOMS = 51
+    torch.manual_seed(0)
+    pos = torch.rand(_NATOMS, 3) * 5.0
+    x = torch.eye(_NATOM_TYPES)[torch.randint(_NATOM_TYPES, (_NATOMS,))]
+
+    def _run(model: torch.nn.Module, force_mode: str, create_graph: bool=False) -> EnergiesForces:
+        return _ml_energies_forces(
+            model=model,
+            res_model=None,
+            structure=Data(x=x, pos=pos.clone(), z=torch.ones(_NATOMS)),
+            u_energy_evs=-36152.6796875,
+            rms_force_evs=0.7182231545448303,
+            force_mode=force_mode,
+            create_graph=create_graph
+        )
+
+    # both modes agree, single-pass builds no higher-order graph
+    model = _ToyModel(nstates=4)
+    e_1, f_1 = _run(model, 'SINGLE_PASS')
+    e_2, f_2 = _run(model, 'PER_STATE')
+    assert f_1.size() == torch.Size([4, _NATOMS, 3])
+    assert torch.allclose(e_1, e_2) and torch.allclose(f_1, f_2, atol=1e-5)
+    assert f_1.grad_fn is None and e_1.grad_fn is None
+    assert _run(model, 'SINGLE_PASS', create_graph=True).forces.grad_fn is not None
+    ntests_passed += 1
+
+    # batched structures
+    from torch_geometric.data import Batch
+    batch = Batch.from_data_list([Data(x=x, pos=pos + i, z=torch.ones(_NATOMS)) for i in range(3)])
+    _, f_b = _ml_energies_forces(model, None, batch, 0.0, 1.0)
+    assert f_b.size() == torch.Size([3, 4, _NATOMS, 3])
+    assert torch.allclose(f_b[1], _ml_energies_forces(model, None, Data(x=x, pos=pos + 1), 0.0, 1.0).forces, atol=1e-5)
+    ntests_passed += 1
+
+    # selective forces: the populated state and states inside the gap window
+    e_b, _ = _ml_energies_forces(model, None, batch, 0.0, 1.0)
+    state = torch.tensor([0, 2, 3])
+    gap_window = (e_b[0, 1] - e_b[0, 0]).abs().item() + 1e-4
+    mask = _force_mask(state, e_b, gap_window)
+    for force_mode in ['SINGLE_PASS', 'PER_STATE']:
+        _, f_s = _ml_energies_forces(
+            model, None, batch, 0.0, 1.0, force_mode=force_mode, state=state, gap_window=gap_window
+        )
+        assert mask[0, 0] and mask[0, 1] and mask[1, 2] and mask[2, 3]
+        assert torch.allclose(f_s[mask], f_b[mask], atol=1e-5)
+        assert f_s[~mask].isnan().all()
+    ntests_passed += 1
+
+    # a custom autograd op without a batching rule falls back to per-state
+    # backward passes, with a single warning
+    class _Checked(torch.autograd.Function):
+        @staticmethod
+        def forward(ctx, x: torch.Tensor) -> torch.Tensor:
+            return x
+
+        @staticmethod
+        def backward(ctx, grad: torch.Tensor) -> torch.Tensor:
+            assert grad.isfinite().all().item()
+            return grad
+
+    class _CustomOpModel(_ToyModel):
+        def forward(self, structure: Data) -> torch.Tensor:
+            return _Checked.apply(super().forward(structure))
+
+    custom = _CustomOpModel(nstates=4)
+    custom.load_state_dict(model.state_dict())
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        e_c, f_c = _run(custom, 'SINGLE_PASS')
+        _run(custom, 'SINGLE_PASS')
+    assert len(caught) == 1 and 'PER_STATE' in str(caught[0].message)
+    assert torch.allclose(e_c, e_1) and torch.allclose(f_c, f_1, atol=1e-5)
     ntests_passed += 1
 
     print(f'Passes {ntests_passed}/{ntests} tests!')
+
+    # benchmark: step cost against the number of electronic states
+    _NREPEATS = 20
+    print('')
+    print('{:<8}  {:>16}  {:>16}'.format('K', 'PER_STATE (ms)', 'SINGLE_PASS (ms)'))
+    for nstates in [1, 2, 4, 8, 16]:
+        model = _ToyModel(nstates=nstates)
+        timings = []
+        for force_mode in ['PER_STATE', 'SINGLE_PASS']:
+            _run(model, force_mode)
+            t = time.perf_counter()
+            for _ in range(_NREPEATS):
+                _run(model, force_mode)
+            timings.append((time.perf_counter() - t) / _NREPEATS * 1e3)
+        print('{:<8}  {:>16.2f}  {:>16.2f}'.format(nstates, *timings))
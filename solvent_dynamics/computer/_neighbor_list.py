@@ -0,0 +1,206 @@
+"""
+STATUS: DEV
+
+Neighbor list with a Verlet skin for the model input graphs.
+
+Candidate pairs within ``cutoff + skin`` are searched once, the edges of every
+step are the candidates within ``cutoff``. Candidates are searched again only
+once an atom has moved more than half the skin since the last search, before
+that no pair can have entered the cutoff from outside the candidates.
+https://en.wikipedia.org/wiki/Verlet_list
+
+"""
+
+import torch
+
+from typing import NamedTuple, Optional
+
+
+class NeighborListStats(NamedTuple):
+    """
+    updates: the number of edge lists served
+    rebuilds: the number of candidate searches
+    edges: the number of edges of the last update
+    candidates: the number of candidate pairs of the last search
+
+    """
+    updates: int
+    rebuilds: int
+    edges: int
+    candidates: int
+
+    @property
+    def rebuild_ratio(self) -> float:
+        return self.rebuilds / self.updates if self.updates else 0.0
+
+
+def _radius_pairs(pos: torch.Tensor, radius: float) -> torch.Tensor:
+    """
+    Searches every ordered pair of distinct atoms within ``radius`` of each
+    other.
+
+    Args:
+        pos (torch.Tensor): Positions of size (N, 3), or (B, N, 3) for a batch
+            of structures with the same number of atoms.
+        radius (float): The search radius.
+
+    Returns:
+        edge_index (torch.Tensor): Pairs of size (2, E) indexing the
+            flattened atoms, structure b owns atoms b * N to (b + 1) * N.
+
+    """
+    pos = pos.reshape(-1, *pos.shape[-2:])
+    natoms = pos.size(dim=-2)
+    within = torch.cdist(pos, pos) < radius
+    within.diagonal(dim1=-2, dim2=-1).fill_(False)
+    b, i, j = within.nonzero(as_tuple=True)
+
+    return torch.stack([b * natoms + j, b * natoms + i], dim=0)
+
+
+class NeighborList:
+    """
+    Keeps the edges of a structure, or of a batch of structures, within a
+    cutoff across steps.
+
+    """
+    def __init__(self, cutoff: float, skin: float) -> None:
+        """
+        Initializes an empty neighbor list.
+
+        Args:
+            cutoff (float): The radius of the model input graph, in the units
+                of the coordinates.
+            skin (float): The margin searched beyond the cutoff. A larger skin
+                rebuilds less often but filters more candidates every step.
+
+        Returns:
+            None
+
+        """
+        self._cutoff = cutoff
+        self._skin = skin
+        self._ref_pos: Optional[torch.Tensor] = None
+        self._candidates: Optional[torch.Tensor] = None
+        self._updates = 0
+        self._rebuilds = 0
+        self._edges = 0
+
+    @property
+    def cutoff(self) -> float:
+        return self._cutoff
+
+    @property
+    def skin(self) -> float:
+        return self._skin
+
+    def update(self, pos: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the edges within the cutoff at the given positions, searching
+        the candidates again if needed.
+
+        Args:
+            pos (torch.Tensor): Positions of size (N, 3), or (B, N, 3).
+
+        Returns:
+            edge_index (torch.Tensor): Edges of size (2, E) in both directions,
+                see _radius_pairs.
+
+        """
+        with torch.no_grad():
+            pos = pos.detach()
+            if self._needs_rebuild(pos):
+                self._candidates = _radius_pairs(pos, self._cutoff + self._skin)
+                self._ref_pos = pos.clone()
+                self._rebuilds += 1
+            assert self._candidates is not None
+            flat = pos.reshape(-1, 3)
+            src, dst = self._candidates
+            within = (flat[src] - flat[dst]).pow(2).sum(dim=-1) < self._cutoff ** 2
+            edge_index = self._candidates[:, within]
+
+        self._updates += 1
+        self._edges = edge_index.size(dim=1)
+
+        return edge_index
+
+    def stats(self) -> NeighborListStats:
+        return NeighborListStats(
+            updates=self._updates,
+            rebuilds=self._rebuilds,
+            edges=self._edges,
+            candidates=self._candidates.size(dim=1) if self._candidates is not None else 0
+        )
+
+    def reset_stats(self) -> None:
+        self._updates = 0
+        self._rebuilds = 0
+
+    def _needs_rebuild(self, pos: torch.Tensor) -> bool:
+        if self._ref_pos is None or self._ref_pos.shape != pos.shape:
+            return True
+        # every pair closes in by at most twice the largest displacement
+        max_disp_sq = (pos - self._ref_pos).pow(2).sum(dim=-1).max()
+        return bool(max_disp_sq > (0.5 * self._skin) ** 2)
+
+
+if __name__ == '__main__':
+    import time
+
+    ntests = 2
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NTRAJ = 8
+    _NSTEPS = 200
+    _CUTOFF = 4.6
+    _SKIN = 1.0
+
+    def _edge_set(edge_index: torch.Tensor) -> set:
+        return set(map(tuple, edge_index.t().tolist()))
+
+    torch.manual_seed(0)
+
+    # the edges of every step are those of a full search
+    pos = torch.rand(_NATOMS, 3, dtype=torch.float64) * 10.0
+    neighbors = NeighborList(_CUTOFF, _SKIN)
+    for _ in range(_NSTEPS):
+        pos += 0.02 * torch.randn(_NATOMS, 3, dtype=torch.float64)
+        assert _edge_set(neighbors.update(pos)) == _edge_set(_radius_pairs(pos, _CUTOFF))
+    stats = neighbors.stats()
+    assert stats.updates == _NSTEPS and 1 < stats.rebuilds < _NSTEPS // 4
+    assert stats.edges < stats.candidates
+    ntests_passed += 1
+
+    # batched structures never share edges
+    pos = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64) * 10.0
+    neighbors = NeighborList(_CUTOFF, _SKIN)
+    for _ in range(20):
+        pos += 0.02 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+        edge_index = neighbors.update(pos)
+        assert _edge_set(edge_index) == _edge_set(_radius_pairs(pos, _CUTOFF))
+        assert torch.equal(edge_index[0] // _NATOMS, edge_index[1] // _NATOMS)
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+
+    # benchmark: full search every step against the skinned list, the list
+    # pays off once the pairwise search outgrows the candidate filter
+    print('')
+    print('{:<12}  {:>16}  {:>16}  {:>10}'.format('B x N', 'full search (ms)', 'skin (ms)', 'rebuilds'))
+    for ntraj, natoms in [(_NTRAJ, _NATOMS), (4, 300), (1, 1000)]:
+        # constant density, every atom keeps about the same number of neighbors
+        pos = torch.rand(ntraj, natoms, 3) * 10.0 * (natoms / _NATOMS) ** (1 / 3)
+        steps = (0.02 * torch.randn(_NSTEPS // 2, ntraj, natoms, 3)).cumsum(dim=0)
+        t = time.perf_counter()
+        for step in steps:
+            _radius_pairs(pos + step, _CUTOFF)
+        elapsed_full = (time.perf_counter() - t) / steps.size(dim=0)
+        neighbors = NeighborList(_CUTOFF, _SKIN)
+        t = time.perf_counter()
+        for step in steps:
+            neighbors.update(pos + step)
+        elapsed_skin = (time.perf_counter() - t) / steps.size(dim=0)
+        print('{:<12}  {:>16.3f}  {:>16.3f}  {:>10.0%}'.format(
+            f'{ntraj} x {natoms}', elapsed_full * 1e3, elapsed_skin * 1e3, neighbors.stats().rebuild_ratio
+        ))
@@ -0,0 +1,208 @@
+"""
+STATUS: DEV
+
+Precision policies of a propagation.
+
+Energies are normalized model outputs shifted by a large offset, see
+constants.U_ENERGY_EVS, so that total energy differences are tiny against
+the absolute energies. The offset, the Verlet accumulation, the kinetic
+energies and the Zhu-Nakamura gap arithmetic need double precision, the
+normalized model outputs do not. A mixed policy runs the model forward and
+backward pass in single precision and everything else in double precision.
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import NamedTuple, Optional, Union
+
+
+class PrecisionPolicy(NamedTuple):
+    """
+    model: floating point type of the model forward and backward pass, the
+        model parameters must be of this type
+    integration: floating point type of the propagator windows and of every
+        quantity computed from them, energies are normalized in this type
+
+    """
+    model: torch.dtype
+    integration: torch.dtype
+
+    def cast(self, tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        """
+        Casts a floating point tensor to the integration type, other tensors
+        are returned as they are.
+
+        """
+        if tensor is None or not tensor.is_floating_point():
+            return tensor
+        return tensor.to(self.integration)
+
+    def cast_topology(self, topology: SystemTopology) -> SystemTopology:
+        """
+        Casts the masses of a topology to the integration type, the one-hot
+        atom types are cast with the model input.
+
+        """
+        return topology._replace(**{
+            k: getattr(topology, k).to(self.integration) for k in ['mass', 'mass_col', 'inv_mass_col', 'inv_mass_sq_col']
+        })
+
+
+PRECISION_POLICIES = {
+    'FP64': PrecisionPolicy(model=torch.float64, integration=torch.float64),
+    'FP32': PrecisionPolicy(model=torch.float32, integration=torch.float32),
+    'MIXED': PrecisionPolicy(model=torch.float32, integration=torch.float64)
+}
+
+
+def _precision_policy(precision: Union[str, PrecisionPolicy]) -> PrecisionPolicy:
+    """
+    Resolves one of "FP64" | "FP32" | "MIXED" to its policy, policies are
+    returned as they are.
+
+    """
+    if isinstance(precision, PrecisionPolicy):
+        return precision
+    if precision not in PRECISION_POLICIES:
+        raise ValueError(f'invalid precision: {precision}')
+
+    return PRECISION_POLICIES[precision]
+
+
+if __name__ == '__main__':
+    import copy
+    import time
+
+    from torch_geometric.data import Batch
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import constants
+    from solvent_dynamics.computer._ml_energies_forces import _ml_energies_forces
+    from solvent_dynamics.trajectory import EnsemblePropagator
+
+    class _ToyModel(torch.nn.Module):
+        """
+        A harmonic well with a learned correction, the states are far apart
+        so that no trajectory hops.
+
+        """
+        def __init__(self, nstates: int, nhidden: int) -> None:
+            super().__init__()
+            self._mlp = torch.nn.Sequential(
+                torch.nn.Linear(3, nhidden),
+                torch.nn.SiLU(),
+                torch.nn.Linear(nhidden, nhidden),
+                torch.nn.SiLU(),
+                torch.nn.Linear(nhidden, nstates)
+            )
+            self.register_buffer('_offsets', 10.0 * torch.arange(nstates))
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            pos = structure.pos
+            e = 0.1 * torch.tanh(self._mlp(pos)) + 0.5 * pos.pow(2).sum(dim=-1, keepdim=True)
+            e = e.new_zeros(structure.num_graphs, e.size(dim=-1)).index_add(0, structure.batch, e)
+            return e + self._offsets
+
+    ntests = 3
+    ntests_passed = 0
+
+    _NTRAJ = 8
+    _NATOMS = 20
+    _NSTATES = 2
+    _NSTEPS = 400
+    _DELTA_T = 0.02
+
+    torch.manual_seed(0)
+    model = _ToyModel(_NSTATES, 32).double()
+
+    def _ensemble(model: torch.nn.Module, ntraj: int, natoms: int, precision: str) -> EnsemblePropagator:
+        topology = SystemTopology.build(
+            torch.rand(natoms, dtype=torch.float64) + 1.0, torch.ones(natoms, 1), {'C': torch.tensor([1.])}
+        )
+        coords = torch.randn(ntraj, natoms, 3, dtype=torch.float64)
+        velo = 0.1 * torch.randn(ntraj, natoms, 3, dtype=torch.float64)
+        energies, forces = _ml_energies_forces(
+            model=model,
+            res_model=None,
+            structure=Batch.from_data_list([Data(pos=c.clone()) for c in coords]),
+            u_energy_evs=constants.U_ENERGY_EVS,
+            rms_force_evs=constants.RMS_FORCE_EVS
+        )
+        zeros = torch.zeros(ntraj, _NSTATES, _NSTATES, dtype=torch.float64)
+        return EnsemblePropagator(
+            copy.deepcopy(model).to(PRECISION_POLICIES[precision].model), None, 0, topology, coords, velo,
+            forces, energies, zeros.clone(), zeros.clone(), zeros.clone(), delta_t=_DELTA_T, precision=precision
+        )
+
+    def _invariant(ensemble: EnsemblePropagator) -> torch.Tensor:
+        # the kinetic plus the potential energy of the populated state
+        e = ensemble._energies.cur.gather(1, ensemble._cur_state.unsqueeze(-1)).squeeze(-1)
+        return ensemble._kinetic_energy.double() + e.double()
+
+    # the mixed policy keeps the total energy as well as double precision,
+    # single precision loses it to the rounding of the energy offset
+    invariants = {}
+    for precision in PRECISION_POLICIES:
+        torch.manual_seed(1)
+        ensemble = _ensemble(model, _NTRAJ, _NATOMS, precision)
+        invariant = []
+        for _ in range(_NSTEPS):
+            ensemble.propagate()
+            invariant.append(_invariant(ensemble))
+        # bound in the well, no trajectory hops
+        assert not ensemble._cur_state.any() and ensemble._coords.cur.abs().max() < 10.0
+        invariants[precision] = torch.stack(invariant[1:], dim=0)
+    drift = {k: (v - v[0]).abs().max().item() for k, v in invariants.items()}
+    error = {k: (v - invariants['FP64']).abs().max().item() for k, v in invariants.items()}
+    assert error['MIXED'] < 1e-4 and drift['MIXED'] < drift['FP64'] + 1e-4
+    assert error['FP32'] > 100 * error['MIXED'] and drift['FP32'] > drift['MIXED']
+    ntests_passed += 1
+
+    # the windows and the history stay in the integration type, the model
+    # input is built in the model type
+    torch.manual_seed(1)
+    ensemble = _ensemble(model, _NTRAJ, _NATOMS, 'MIXED')
+    for _ in range(3):
+        ensemble.propagate()
+    assert ensemble._coords.cur.dtype == ensemble._energies.cur.dtype == torch.float64
+    assert ensemble._topology.inv_mass_col.dtype == torch.float64
+    assert ensemble._model_input.update(ensemble._coords.cur).pos.dtype == torch.float32
+    assert ensemble.history(0).all_info().energies.dtype == torch.float64
+    ntests_passed += 1
+
+    # policies are named or given as they are
+    assert _precision_policy('MIXED') == PrecisionPolicy(torch.float32, torch.float64)
+    assert _precision_policy(PRECISION_POLICIES['FP32']) is PRECISION_POLICIES['FP32']
+    try:
+        _precision_policy('FP16')
+        assert False
+    except ValueError:
+        pass
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+
+    print('')
+    print('{:<8}  {:>16}  {:>16}'.format('policy', 'drift (eV)', 'error (eV)'))
+    for precision in PRECISION_POLICIES:
+        print('{:<8}  {:>16.2e}  {:>16.2e}'.format(precision, drift[precision], error[precision]))
+
+    # benchmark: step throughput of a wider model on a larger ensemble
+    _NREPEATS = 20
+    print('')
+    print('{:<8}  {:>16}  {:>16}'.format('policy', 'step (ms)', 'speedup'))
+    model = _ToyModel(_NSTATES, 256).double()
+    elapsed = {}
+    for precision in PRECISION_POLICIES:
+        torch.manual_seed(1)
+        ensemble = _ensemble(model, 32, 51, precision)
+        for _ in range(3):
+            ensemble.propagate()
+        t = time.perf_counter()
+        for _ in range(_NREPEATS):
+            ensemble.propagate()
+        elapsed[precision] = (time.perf_counter() - t) / _NREPEATS
+        print('{:<8}  {:>16.2f}  {:>15.2f}x'.format(precision, elapsed[precision] * 1e3, elapsed['FP64'] / elapsed[precision]))
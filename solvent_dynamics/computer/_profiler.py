@@ -0,0 +1,409 @@
+"""
+STATUS: DEV
+
+Per-phase timing of propagation steps, switched on per run with the profile
+context.
+
+The step code marks its phases, e.g. the model forward and backward pass or
+the surface hopping, with _phase and reports finished steps with
+_record_steps. Without an active profiler both return at once, so the hooks
+stay in the step code for good. Phase durations are kept per phase for
+counts and percentiles, the first ``max_trace_events`` spans are also kept as
+events of a Chrome trace, viewable in chrome://tracing or Perfetto.
+
+"""
+
+import os
+import json
+import time
+import array
+import torch
+import threading
+import contextlib
+
+from solvent_dynamics import constants
+
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+
+class PhaseStats(NamedTuple):
+    """
+    count: the number of spans of the phase
+    total: the total time in seconds
+    mean, p50, p90, p99, max: span durations in seconds
+    share: the fraction of the step time spent in the phase, spans of
+        nested phases count towards every enclosing phase
+
+    """
+    count: int
+    total: float
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+    max: float
+    share: float
+
+
+class _Span:
+    __slots__ = ('_profiler', '_name', '_start')
+
+    def __init__(self, profiler: 'Profiler', name: str) -> None:
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc: Any) -> None:
+        self._profiler._add(self._name, self._start, time.perf_counter())
+
+
+class Profiler:
+    """
+    Collects phase spans and step counts of every thread of the process.
+    Profilers are not shared across processes, profile runs without worker
+    processes.
+
+    """
+    def __init__(self, max_trace_events: int=100_000) -> None:
+        """
+        Initializes an empty profiler.
+
+        Args:
+            max_trace_events (int): The max number of spans kept for the
+                Chrome trace, the statistics cover every span.
+
+        Returns:
+            None
+
+        """
+        self._max_trace_events = max_trace_events
+        self._lock = threading.Lock()
+        self._durations: Dict[str, 'array.array[float]'] = {}
+        self._events: List[Tuple[str, float, float, int]] = []
+        self._steps: Dict[int, List[float]] = {}
+        self._origin = time.perf_counter()
+        self._start: Optional[float] = None
+        self._end: Optional[float] = None
+
+    def phase_stats(self) -> Dict[str, PhaseStats]:
+        """
+        Returns the statistics of every phase, in the order in which their
+        first span ended.
+
+        """
+        with self._lock:
+            durations = {k: torch.tensor(v, dtype=torch.float64) for k, v in self._durations.items()}
+        step_total = float(durations['step'].sum()) if 'step' in durations else 0.0
+        stats = {}
+        for name, d in durations.items():
+            p50, p90, p99 = torch.quantile(d, torch.tensor([0.5, 0.9, 0.99], dtype=torch.float64)).tolist()
+            total = float(d.sum())
+            stats[name] = PhaseStats(
+                count=d.numel(),
+                total=total,
+                mean=total / d.numel(),
+                p50=p50,
+                p90=p90,
+                p99=p99,
+                max=float(d.max()),
+                share=total / step_total if step_total else 0.0
+            )
+
+        return stats
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarizes the run: phase statistics, and the throughput of every
+        trajectory and of the whole ensemble in steps per second and in
+        simulated femtoseconds per day.
+
+        The throughput of a trajectory is taken over the time spent in its
+        own steps, that of the ensemble over the wall time of the run.
+
+        """
+        with self._lock:
+            steps = {k: list(v) for k, v in self._steps.items()}
+            start = self._start if self._start is not None else self._origin
+            end = self._end if self._end is not None else time.perf_counter()
+
+        def throughput(nsteps: float, sim_time: float, wall_time: float) -> Dict[str, float]:
+            sim_time_fs = sim_time * constants.AU_TIME_FS
+            return {
+                'steps': nsteps,
+                'sim_time_fs': sim_time_fs,
+                'wall_time': wall_time,
+                'steps_per_s': nsteps / wall_time if wall_time else 0.0,
+                'fs_per_day': sim_time_fs / wall_time * 86400.0 if wall_time else 0.0
+            }
+
+        trajs = {traj: throughput(*s) for traj, s in sorted(steps.items())}
+        ensemble = throughput(
+            sum(s[0] for s in steps.values()),
+            sum(s[1] for s in steps.values()),
+            end - start
+        )
+        ensemble['trajectories'] = len(steps)
+
+        return {
+            'phases': {k: v._asdict() for k, v in self.phase_stats().items()},
+            'trajectories': trajs,
+            'ensemble': ensemble
+        }
+
+    def to_json(self, path: str) -> None:
+        """
+        Writes the report to a JSON file.
+
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def to_chrome_trace(self, path: str) -> None:
+        """
+        Writes the kept spans to a Chrome trace file, one track per thread.
+
+        """
+        with self._lock:
+            events = list(self._events)
+        pid = os.getpid()
+        trace = [
+            {
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': pid,
+                'tid': tid
+            } for name, start, end, tid in events
+        ]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._durations = {}
+            self._events = []
+            self._steps = {}
+            self._origin = time.perf_counter()
+            self._start = self._end = None
+
+    def _add(self, name: str, start: float, end: float) -> None:
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = array.array('d')
+            durations.append(end - start)
+            if len(self._events) < self._max_trace_events:
+                self._events.append((name, start, end, threading.get_ident()))
+
+    def _add_steps(self, trajs: Iterable[int], sim_time: float, wall_time: float) -> None:
+        with self._lock:
+            for traj in trajs:
+                s = self._steps.get(traj)
+                if s is None:
+                    s = self._steps[traj] = [0, 0.0, 0.0]
+                s[0] += 1
+                s[1] += sim_time
+                s[2] += wall_time
+
+
+_active: Optional[Profiler] = None
+_null = contextlib.nullcontext()
+
+
+def _phase(name: str) -> ContextManager[None]:
+    """
+    Times the enclosed block as a span of the named phase, nothing without
+    an active profiler.
+
+    """
+    if _active is None:
+        return _null
+    return _Span(_active, name)
+
+
+def _record_steps(trajs: Union[int, Iterable[int]], sim_time: float, start: float) -> None:
+    """
+    Records one finished step of every given trajectory, also a span of the
+    "step" phase. Nothing without an active profiler.
+
+    Args:
+        trajs (int | Iterable[int]): Index of the trajectory, or indices of
+            every trajectory of an ensemble step.
+        sim_time (float): The simulated time of the step in atomic units of
+            time, au.
+        start (float): The time.perf_counter() at the start of the step.
+
+    Returns:
+        None
+
+    """
+    profiler = _active
+    if profiler is None:
+        return
+    end = time.perf_counter()
+    profiler._add('step', start, end)
+    profiler._add_steps([trajs] if isinstance(trajs, int) else trajs, sim_time, end - start)
+
+
+@contextlib.contextmanager
+def _profile(profiler: Profiler) -> Iterator[Profiler]:
+    """
+    Activates a profiler for the enclosed block, in every thread of the
+    process.
+
+    Args:
+        profiler (Profiler): The profiler to collect into, its wall time
+            spans the blocks it was active in.
+
+    Returns:
+        (Iterator[Profiler]): The active profiler.
+
+    """
+    global _active
+
+    prev, _active = _active, profiler
+    now = time.perf_counter()
+    if profiler._start is None:
+        profiler._start = now
+    elif profiler._end is not None:
+        # inactive time between two blocks does not count
+        profiler._start += now - profiler._end
+    try:
+        yield profiler
+    finally:
+        profiler._end = time.perf_counter()
+        _active = prev
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import computer
+    from solvent_dynamics.trajectory import EnsemblePropagator, TrajectoryPropagator
+
+    ntests = 3
+    ntests_passed = 0
+
+    _NATOMS = 20
+    _NSTATES = 3
+    _NTRAJ = 4
+    _NSTEPS = 10
+
+    class _ToyModel(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, _NSTATES)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = torch.tanh(self._lin(structure.pos))
+            if structure.batch is None:
+                return e.sum(dim=0)
+            return e.new_zeros(structure.num_graphs, _NSTATES).index_add(0, structure.batch, e)
+
+    torch.manual_seed(0)
+    from solvent_dynamics.computer._ml_energies_forces import _ml_energies_forces
+    from solvent_dynamics.computer._system_topology import SystemTopology
+
+    model = _ToyModel()
+    topology = SystemTopology.build(torch.rand(_NATOMS) + 1.0, torch.ones(_NATOMS, 1), {'C': torch.tensor([1.])})
+    coords = torch.rand(_NTRAJ, _NATOMS, 3)
+    velo = 0.01 * torch.rand(_NTRAJ, _NATOMS, 3)
+    zeros = torch.zeros(_NTRAJ, _NSTATES, _NSTATES)
+
+    def _trajectory(b: int) -> TrajectoryPropagator:
+        energies, forces = _ml_energies_forces(
+            model, None, Data(pos=coords[b].clone()), constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS
+        )
+        return TrajectoryPropagator(
+            model, None, 0, topology, coords[b].clone(), velo[b].clone(), forces, energies,
+            zeros[b].clone(), zeros[b].clone(), zeros[b].clone(), delta_t=0.5
+        )
+
+    # every phase of every step is timed, throughput is kept per trajectory,
+    # trajectories without a store index get their own ids
+    profiler = Profiler()
+    trajs = [_trajectory(b) for b in range(2)]
+    with computer.profile(profiler):
+        for _ in range(_NSTEPS):
+            for traj in trajs:
+                traj.propagate()
+    stats = profiler.phase_stats()
+    assert sorted(stats) == sorted([
+        'save_snapshot', 'shift', 'nuclear', 'verlet_coords', 'model_input', 'forward', 'backward',
+        'verlet_velo', 'kinetic_energy', 'surface_hopping', 'step'
+    ])
+    assert stats['step'].count == stats['nuclear'].count == 2 * _NSTEPS and stats['shift'].count == 4 * _NSTEPS
+    # the first step only sets up the windows
+    assert stats['forward'].count == stats['backward'].count == 2 * (_NSTEPS - 1)
+    assert stats['verlet_coords'].count == stats['verlet_velo'].count == stats['kinetic_energy'].count == 2 * (_NSTEPS - 1)
+    assert stats['step'].share == 1.0 and 0.0 < stats['forward'].share < 1.0
+    s = stats['step']
+    assert s.p50 <= s.p90 <= s.p99 <= s.max and abs(s.mean * s.count - s.total) < 1e-12
+    report = profiler.report()
+    assert sorted(report['trajectories']) == sorted(traj._store_idx for traj in trajs)
+    assert report['trajectories'][trajs[1]._store_idx]['steps'] == _NSTEPS
+    assert abs(report['trajectories'][trajs[1]._store_idx]['sim_time_fs'] - (_NSTEPS - 1) * 0.5 * constants.AU_TIME_FS) < 1e-9
+    assert report['ensemble']['steps'] == 2 * _NSTEPS and report['ensemble']['fs_per_day'] > 0.0
+    ntests_passed += 1
+
+    # both exports parse, the trace keeps the first spans only
+    profiler = Profiler(max_trace_events=50)
+    ensemble = EnsemblePropagator(
+        model, None, 0, topology, coords.clone(), velo.clone(),
+        torch.stack([_trajectory(b)._forces.cur for b in range(_NTRAJ)]),
+        torch.stack([_trajectory(b)._energies.cur for b in range(_NTRAJ)]),
+        zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.5
+    )
+    with computer.profile(profiler):
+        for _ in range(_NSTEPS):
+            ensemble.propagate()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        profiler.to_json(os.path.join(tmp_dir, 'profile.json'))
+        profiler.to_chrome_trace(os.path.join(tmp_dir, 'trace.json'))
+        with open(os.path.join(tmp_dir, 'profile.json')) as f:
+            report = json.load(f)
+        with open(os.path.join(tmp_dir, 'trace.json')) as f:
+            trace = json.load(f)
+    assert report['ensemble']['trajectories'] == _NTRAJ and report['ensemble']['steps'] == _NTRAJ * _NSTEPS
+    assert report['phases']['step']['count'] == _NSTEPS
+    assert len(trace['traceEvents']) == 50 and all(e['ph'] == 'X' and e['dur'] >= 0 for e in trace['traceEvents'])
+    ntests_passed += 1
+
+    # nothing is recorded outside the profile block
+    for traj in trajs:
+        traj.propagate()
+    ensemble.propagate()
+    assert profiler.phase_stats()['step'].count == _NSTEPS
+    assert computer._profiler._active is None
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+
+    # benchmark: cost of the hooks with and without an active profiler
+    _NREPEATS = 100_000
+    t = time.perf_counter()
+    for _ in range(_NREPEATS):
+        with computer.profile_phase('forward'):
+            pass
+    elapsed_off = (time.perf_counter() - t) / _NREPEATS
+    with computer.profile(Profiler(max_trace_events=0)):
+        t = time.perf_counter()
+        for _ in range(_NREPEATS):
+            with computer.profile_phase('forward'):
+                pass
+        elapsed_on = (time.perf_counter() - t) / _NREPEATS
+    traj = trajs[0]
+    t = time.perf_counter()
+    for _ in range(50):
+        traj.propagate()
+    elapsed_step = (time.perf_counter() - t) / 50
+    nphases = sum(v.count for k, v in stats.items() if k != 'step') / stats['step'].count + 1
+    print('')
+    print(f'phase hook: {elapsed_off * 1e9:.0f}ns off, {elapsed_on * 1e9:.0f}ns on')
+    print(f'{nphases:.1f} hooks per step: {nphases * elapsed_off / elapsed_step:.3%} of a '
+          f'{elapsed_step * 1e3:.2f}ms step off, {nphases * elapsed_on / elapsed_step:.3%} on')
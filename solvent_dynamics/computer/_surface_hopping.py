@@ -7,24 +7,26 @@ J. Chem. Phys. 102, 7448 (1995); https://doi.org/10.1063/1.469057
 Formulas given in supporting information below:
 http://www.rsc.org/suppdata/c8/cp/c8cp02651c/c8cp02651c1.pdf
 
-# HERE
-    - fix named tuple type error
-    - intersystem_crossing call
-    - check if is valid surface hop
-    - reflect, adjust velocities
+Every tensor may carry a leading batch dimension B, hops of every trajectory
+are selected, checked and applied with masks in one call.
 
 """
 
 import torch
 
 from solvent_dynamics.computer import (
-    internal_conversion,
-    intersystem_crossing,
+    zn_hopping,
     is_valid_surface_hop,
     adjust_velo_after_hop
 )
+from solvent_dynamics.computer._step_kernels import _step_kernel
+from solvent_dynamics.computer._system_topology import SystemTopology
 
-from typing import NamedTuple
+from typing import NamedTuple, Optional, Union
+
+
+HOP_TYPES = ('NO HOP', 'HOP', 'FRUSTRATED')
+NO_HOP, HOP, FRUSTRATED = range(3)
 
 
 class SurfaceHoppingMetrics(NamedTuple):
@@ -33,22 +35,72 @@ class SurfaceHoppingMetrics(NamedTuple):
     h: energy matrix
     d: non-adiabatic matrix
     velo: velocities
-    hop_type: "NO HOP" | "HOP" | "FRUSTRATED"
+    hop_type: index into HOP_TYPES, "NO HOP" | "HOP" | "FRUSTRATED"
     state: current electronic energy state
+    p: hopping probability from the state before the hop towards every state
 
     """
     a: torch.Tensor
     h: torch.Tensor
     d: torch.Tensor
     velo: torch.Tensor
-    hop_type: str 
-    state: int
+    hop_type: torch.Tensor
+    state: torch.Tensor
+    p: torch.Tensor
+
+
+@_step_kernel()
+def _hop_select(
+        state: torch.Tensor,
+        topology: SystemTopology,
+        velo: torch.Tensor,
+        energies: torch.Tensor,
+        p: torch.Tensor,
+        nacs: torch.Tensor,
+        z: torch.Tensor,
+        max_hop: int,
+        reflect: bool
+    ) -> SurfaceHoppingMetrics:
+    """
+    Selects the hop target of every trajectory from its hopping probabilities
+    and a uniform random number ``z``, validates the hop and rescales the
+    velocities, see _surface_hopping.
+
+    """
+    nstates = energies.size(dim=-1)
+    batch_shape = energies.shape[:-1]
+
+    order = torch.argsort(energies, dim=-1)
+    p_sorted = p.gather(-1, order)
+    nhop = (order - state.unsqueeze(-1)).abs()
+    candidate = (p_sorted.cumsum(dim=-1) > z.unsqueeze(-1)) & (p_sorted > 0) & (nhop > 0) & (nhop <= max_hop)
+    has_target = candidate.any(dim=-1)
+    target = order.gather(-1, candidate.int().argmax(dim=-1, keepdim=True)).squeeze(-1)
+    target = torch.where(has_target, target, state)
+
+    nacs_target = torch.take_along_dim(nacs, target.view(*batch_shape, 1, 1, 1), dim=-3).squeeze(-3)
+    delta_e = energies.gather(-1, target.unsqueeze(-1)).squeeze(-1) - energies.gather(-1, state.unsqueeze(-1)).squeeze(-1)
+    valid = is_valid_surface_hop(topology, velo, nacs_target, delta_e)
+    hop = has_target & valid
+    frustrated = has_target & ~valid
+    v = adjust_velo_after_hop(topology, velo, nacs_target, delta_e, hop, frustrated, reflect=reflect)
+
+    new_state = torch.where(hop, target, state)
+    hop_type = torch.full(batch_shape, NO_HOP, dtype=torch.long, device=p.device)
+    hop_type = hop_type.masked_fill(hop, HOP).masked_fill(frustrated, FRUSTRATED)
+
+    a = torch.diag_embed(torch.nn.functional.one_hot(new_state, nstates).to(energies.dtype))
+    h = torch.diag_embed(energies)
+    # Zhu-Nakamura hops need no coupling matrix, kept for the propagator windows
+    d = torch.zeros_like(h)
+
+    return SurfaceHoppingMetrics(a, h, d, v, hop_type, new_state, p)
 
 
 def _surface_hopping(
-        state: int,
+        state: Union[int, torch.Tensor],
         state_mult: torch.Tensor,
-        mass: torch.Tensor,
+        topology: SystemTopology,
         coord: torch.Tensor,
         coord_prev: torch.Tensor,
         coord_prev_prev: torch.Tensor,
@@ -62,76 +114,151 @@ def _surface_hopping(
         ke: torch.Tensor,
         ic_e_thresh: float,
         isc_e_thresh: float,
-        max_hop: int
+        max_hop: int,
+        soc: Optional[torch.Tensor]=None,
+        generator: Optional[torch.Generator]=None,
+        reflect: bool=False
     ) -> SurfaceHoppingMetrics:
     """
-    ...
+    Hops between electronic states by the Zhu-Nakamura probabilities.
+
+    States are visited in order of energy and the hopping probabilities are
+    accumulated, the first state at which the sum exceeds a uniform random
+    number, within ``max_hop`` states of the current state, is the target.
+    A hop is frustrated if the kinetic energy along the coupling vector
+    cannot pay for it, otherwise velocities are rescaled along the coupling
+    vector to conserve the total energy.
 
     Args:
+        state (int | torch.Tensor): The current electronic state, or a tensor
+            of size (B).
+        state_mult (torch.Tensor): Spin multiplicity of size (K) for every
+            electronic state.
+        topology (SystemTopology): Topology of the molecular system.
+        coord, coord_prev, coord_prev_prev (torch.Tensor): Coordinates of
+            size (N, 3) of the last three steps.
+        velo (torch.Tensor): Current velocities of size (N, 3).
+        energies, energies_prev, energies_prev_prev (torch.Tensor): Energies
+            of size (K) of the last three steps.
+        forces, forces_prev, forces_prev_prev (torch.Tensor): Forces of size
+            (K, N, 3) of the last three steps.
+        ke (torch.Tensor): Kinetic energy, a scalar or of size (B).
+        ic_e_thresh (float): Energy gap threshold of internal conversion.
+        isc_e_thresh (float): Energy gap threshold of intersystem crossing.
+        max_hop (int): The max number of states a single hop may cross.
+        soc (torch.Tensor | None): Spin-orbit couplings of size (K, K), no
+            intersystem crossing if not given.
+        generator (torch.Generator | None): Generator of the random numbers.
+        reflect (bool): Reverse the velocity component along the coupling
+            vector on frustrated hops.
 
     Returns:
+        (SurfaceHoppingMetrics): With a leading B for a batch.
 
     """
-    nstates = energies.size(dim=0)
-    new_state = state
-    v = velo
-    g_c = torch.zeros(nstates)  # hopping probabilties
-    g = 0.0  # acc hopping probability
-    target_mult = state_mult[state]
-    state_idxs = torch.argsort(energies)
-    z = torch.rand(1)
-
-    for i in range(nstates):
-        if i == state:
-            continue
-        
-        state_mult = state_mult[i]
-
-        if state_mult == target_mult:
-            p, nacs = internal_conversion( # type: ignore
-                cur_state=state,
-                other_state=i,
-                mass=mass,
-                coord=coord,
-                coord_prev=coord_prev,
-                coord_prev_prev=coord_prev_prev,
-                velo=velo,
-                energies=energies,
-                energies_prev=energies_prev,
-                energies_prev_prev=energies_prev_prev,
-                forces=forces,
-                forces_prev=forces_prev,
-                forces_prev_prev=forces_prev_prev,
-                ke=ke,
-                ic_e_thresh=ic_e_thresh
-            )
-        else:
-            p = intersystem_crossing(*args, **kwargs) # type: ignore
-        g_c[i] += p
-    
-    for i in range(nstates):
-        g += g_c[state_idxs[i]]
-        nhop = torch.abs(state_idxs[i] - state)
-        if g > z and 0 < nhop <= max_hop:
-            if is_valid_surface_hop(*args, **kwargs): # type: ignore
-                new_state = state_idxs[i]
-                v = adjust_velo_after_hop(*args, **kwargs) # type: ignore
-            else:
-                v = velo
-    
-
-    return SurfaceHoppingMetrics(a, h, d, v, hop_type, new_state)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    batch_shape = energies.shape[:-1]
+    state = torch.as_tensor(state, device=energies.device).expand(batch_shape)
+
+    # internal conversion and intersystem crossing towards every state in one call
+    p, nacs = zn_hopping(
+        state=state,
+        state_mult=state_mult,
+        topology=topology,
+        coord=coord,
+        coord_prev=coord_prev,
+        coord_prev_prev=coord_prev_prev,
+        energies=energies,
+        energies_prev=energies_prev,
+        energies_prev_prev=energies_prev_prev,
+        forces=forces,
+        forces_prev_prev=forces_prev_prev,
+        soc=soc,
+        ke=ke,
+        ic_e_thresh=ic_e_thresh,
+        isc_e_thresh=isc_e_thresh
+    )
+
+    # first state in energy order at which the accumulated probability passes z
+    z = torch.rand(batch_shape, dtype=p.dtype, device=p.device, generator=generator)
+
+    return _hop_select(state, topology, velo, energies, p, nacs, z, max_hop, reflect)
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+
+    from solvent_dynamics.computer import kinetic_energy
+    from solvent_dynamics.computer._step_kernels import _step_mode
+
+    ntests = 3
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NSTATES = 5
+    _NTRAJ = 64
+
+    torch.manual_seed(0)
+    topology = SystemTopology.build(torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    state_mult = torch.tensor([1, 1, 3, 3, 3])
+    coord = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev = coord + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev_prev = coord_prev + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    velo = 0.1 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    energies, energies_prev_prev = torch.rand(2, _NTRAJ, _NSTATES, dtype=torch.float64).mul(0.5).unbind(0)
+    energies_prev = torch.rand(_NTRAJ, _NSTATES, dtype=torch.float64).mul(0.1)
+    forces, forces_prev, forces_prev_prev = (0.01 * torch.randn(3, _NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)).unbind(0)
+    soc = torch.rand(_NSTATES, _NSTATES, dtype=torch.float64).mul(1e-3)
+    soc = (soc + soc.T) * (state_mult.unsqueeze(0) != state_mult.unsqueeze(1))
+    ke = kinetic_energy(topology, velo)
+    state = torch.randint(_NSTATES, (_NTRAJ,))
+
+    def _hop(b, generator):
+        idx = slice(None) if b is None else b
+        return _surface_hopping(
+            state=state[idx], state_mult=state_mult, topology=topology, coord=coord[idx],
+            coord_prev=coord_prev[idx], coord_prev_prev=coord_prev_prev[idx], velo=velo[idx],
+            energies=energies[idx], energies_prev=energies_prev[idx], energies_prev_prev=energies_prev_prev[idx],
+            forces=forces[idx], forces_prev=forces_prev[idx], forces_prev_prev=forces_prev_prev[idx],
+            ke=ke[idx], ic_e_thresh=0.06, isc_e_thresh=0.04, max_hop=4, soc=soc, generator=generator
+        )
+
+    # hops conserve the total energy, frustrated and rejected hops keep it all
+    out = _hop(None, torch.Generator().manual_seed(1))
+    hop, frustrated = out.hop_type == HOP, out.hop_type == FRUSTRATED
+    assert hop.any() and frustrated.any() and (out.hop_type == NO_HOP).any()
+    e_old = energies.gather(-1, state.unsqueeze(-1)).squeeze(-1)
+    e_new = energies.gather(-1, out.state.unsqueeze(-1)).squeeze(-1)
+    assert torch.allclose(kinetic_energy(topology, out.velo) + e_new, ke + e_old)
+    assert torch.equal(out.velo[~hop], velo[~hop]) and torch.equal(out.state[~hop], state[~hop])
+    assert (out.state[hop] != state[hop]).all()
+    assert torch.equal(out.a.diagonal(dim1=-2, dim2=-1).argmax(dim=-1), out.state)
+    ntests_passed += 1
+
+    # a batch of trajectories matches one call per trajectory
+    g = torch.Generator().manual_seed(1)
+    for b in range(_NTRAJ):
+        single = _hop(b, g)
+        assert int(single.state) == int(out.state[b]) and int(single.hop_type) == int(out.hop_type[b])
+        assert torch.allclose(single.velo, out.velo[b])
+    ntests_passed += 1
+
+    # compiled step kernels agree with the eager ones
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with _step_mode('COMPILED') as mode:
+            compiled = _hop(None, torch.Generator().manual_seed(1))
+            t = time.perf_counter()
+            for _ in range(100):
+                _hop(None, torch.Generator().manual_seed(1))
+            elapsed_compiled = (time.perf_counter() - t) / 100
+    assert all(torch.allclose(a, b) for a, b in zip(compiled, out))
+    t = time.perf_counter()
+    for _ in range(100):
+        _hop(None, torch.Generator().manual_seed(1))
+    elapsed_eager = (time.perf_counter() - t) / 100
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+    print(f'{_NTRAJ} trajectories: {int(hop.sum())} hops, {int(frustrated.sum())} frustrated')
+    print(f'step kernels: eager {elapsed_eager * 1e3:.2f}ms, {mode.lower()} {elapsed_compiled * 1e3:.2f}ms')
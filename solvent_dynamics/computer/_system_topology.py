@@ -0,0 +1,99 @@
+"""
+STATUS: SYNTAX PASS
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._conversions import _one_hot_to_type_idx
+
+from typing import Dict, NamedTuple, Tuple
+
+
+class SystemTopology(NamedTuple):
+    """
+    Quantities of a molecular system that never change during propagation,
+    built once per system and shared by all of its trajectories.
+
+    mass: atomic masses of size (N)
+    mass_col: atomic masses of size (N, 1), broadcasts against (..., N, 3)
+    inv_mass_col: inverse atomic masses of size (N, 1)
+    inv_mass_sq_col: inverse squared atomic masses of size (N, 1)
+    one_hot: one-hot atom types of size (N, T)
+    one_hot_key: atom symbol to its one-hot row
+    atom_type_idxs: index into ``one_hot_key`` of every atom, of size (N)
+    atom_types: atom symbol of every atom
+
+    """
+    mass: torch.Tensor
+    mass_col: torch.Tensor
+    inv_mass_col: torch.Tensor
+    inv_mass_sq_col: torch.Tensor
+    one_hot: torch.Tensor
+    one_hot_key: Dict[str, torch.Tensor]
+    atom_type_idxs: torch.Tensor
+    atom_types: Tuple[str, ...]
+
+    @classmethod
+    def build(
+            cls,
+            mass: torch.Tensor,
+            one_hot: torch.Tensor,
+            one_hot_key: Dict[str, torch.Tensor]
+        ) -> 'SystemTopology':
+        """
+        Builds the topology of a molecular system.
+
+        Args:
+            mass (torch.Tensor): Atomic mass tensor of size (N) where N is the
+                number of atoms.
+            one_hot (torch.Tensor): A one-hot tensor representing atom types.
+            one_hot_key (dict(str, torch.Tensor)): The key to the one-hot
+                tensor.
+
+        Returns:
+            (SystemTopology)
+
+        """
+        mass_col = mass.unsqueeze(-1)
+        inv_mass_col = mass_col.reciprocal()
+        atom_type_idxs = _one_hot_to_type_idx(one_hot, one_hot_key)
+        symbols = list(one_hot_key.keys())
+
+        return cls(
+            mass=mass,
+            mass_col=mass_col,
+            inv_mass_col=inv_mass_col,
+            inv_mass_sq_col=inv_mass_col.pow(2),
+            one_hot=one_hot,
+            one_hot_key=one_hot_key,
+            atom_type_idxs=atom_type_idxs,
+            atom_types=tuple(symbols[i] for i in atom_type_idxs.tolist())
+        )
+
+    @property
+    def natoms(self) -> int:
+        return self.mass.size(dim=0)
+
+    def to(self, device: torch.device) -> 'SystemTopology':
+        return self._replace(**{
+            k: v.to(device) for k, v in self._asdict().items() if isinstance(v, torch.Tensor)
+        })
+
+
+if __name__ == '__main__':
+    ntests = 1
+    ntests_passed = 0
+
+    key = {'H': torch.tensor([1., 0., 0.]), 'C': torch.tensor([0., 1., 0.]), 'O': torch.tensor([0., 0., 1.])}
+    one_hot = torch.stack([key['C'], key['H'], key['O'], key['H']], dim=0)
+    mass = torch.tensor([12.011, 1.008, 15.999, 1.008])
+
+    topology = SystemTopology.build(mass, one_hot, key)
+    assert topology.atom_types == ('C', 'H', 'O', 'H')
+    assert topology.atom_type_idxs.tolist() == [1, 0, 2, 0]
+    assert topology.inv_mass_col.size() == torch.Size([4, 1])
+    assert torch.allclose(topology.inv_mass_sq_col.squeeze(-1), mass.pow(-2))
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
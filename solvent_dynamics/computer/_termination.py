@@ -0,0 +1,277 @@
+"""
+STATUS: DEV
+
+Termination criteria of trajectories that are no longer worth propagating.
+
+Every check is a masked tensor expression over the trajectories of an
+ensemble, a single trajectory is a batch of one. The first failed check in
+the order of TERMINATION_REASONS is the reason of a trajectory.
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._active_forces import _active_forces
+from solvent_dynamics.computer._kinetic_energy import _kinetic_energy
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import NamedTuple, Optional, Union
+
+
+TERMINATION_REASONS = ('NONE', 'NONFINITE', 'ENERGY_DRIFT', 'KINETIC_SPIKE', 'FRAGMENTED', 'GROUND_STATE')
+NONE, NONFINITE, ENERGY_DRIFT, KINETIC_SPIKE, FRAGMENTED, GROUND_STATE = range(6)
+
+
+class TerminationCriteria(NamedTuple):
+    """
+    every: the number of steps between two checks
+    nonfinite: terminate on NaN or Inf coordinates, energies or forces of
+        the populated state
+    max_energy_drift: max change of the total energy since the first step,
+        in the units of the energies
+    max_ke_spike: max gain of kinetic energy within a single step
+    max_bond_length: max length of any bond, in the units of the coordinates
+    bond_cutoff: atoms closer than this in the starting coordinates are
+        bonded
+    ground_state_duration: max time spent in the ground state, in atomic
+        units of time
+
+    Checks left as None are skipped.
+
+    """
+    every: int = 10
+    nonfinite: bool = True
+    max_energy_drift: Optional[float] = None
+    max_ke_spike: Optional[float] = None
+    max_bond_length: Optional[float] = None
+    bond_cutoff: float = 1.6
+    ground_state_duration: Optional[float] = None
+
+
+def _bonds(coords: torch.Tensor, cutoff: float) -> torch.Tensor:
+    """
+    Finds the bonds of a molecular system from its starting coordinates.
+
+    Args:
+        coords (torch.Tensor): Coordinates of size (N, 3), or (B, N, 3) for a
+            batch of starting coordinates of the same system.
+        cutoff (float): Atoms closer than this are bonded.
+
+    Returns:
+        bonds (torch.Tensor): Atom pairs of size (2, M) with the first atom
+            of a pair below the second, bonded in every structure of a batch.
+
+    """
+    coords = coords.reshape(-1, *coords.shape[-2:])
+    bonded = (torch.cdist(coords, coords) < cutoff).all(dim=0).triu(diagonal=1)
+
+    return bonded.nonzero().t()
+
+
+def _total_energy(
+        topology: SystemTopology,
+        state: torch.Tensor,
+        velo: torch.Tensor,
+        energies: torch.Tensor
+    ) -> torch.Tensor:
+    """
+    Computes the potential energy of the populated state plus the kinetic
+    energy of every trajectory of a batch.
+
+    """
+    e = energies.gather(-1, state.unsqueeze(-1)).squeeze(-1)
+    return e + _kinetic_energy(topology, velo)
+
+
+def _termination_reasons(
+        criteria: TerminationCriteria,
+        topology: SystemTopology,
+        state: Union[int, torch.Tensor],
+        coords: torch.Tensor,
+        velo: torch.Tensor,
+        velo_prev: torch.Tensor,
+        energies: torch.Tensor,
+        forces: torch.Tensor,
+        e_total_ref: torch.Tensor,
+        ground_time: Union[float, torch.Tensor],
+        bonds: Optional[torch.Tensor]=None
+    ) -> torch.Tensor:
+    """
+    Checks every trajectory against the termination criteria.
+
+    Args:
+        criteria (TerminationCriteria): The checks to run.
+        topology (SystemTopology): Topology of the molecular system.
+        state (int | torch.Tensor): The populated electronic state, or a
+            tensor of size (B) with one state per trajectory.
+        coords (torch.Tensor): Coordinates of size (N, 3), or (B, N, 3).
+        velo (torch.Tensor): Velocities of the current step of the size of
+            ``coords``.
+        velo_prev (torch.Tensor): Velocities of the previous step.
+        energies (torch.Tensor): Energies of size (K), or (B, K).
+        forces (torch.Tensor): Forces of size (K, N, 3), or (B, K, N, 3),
+            only those of the populated state are read.
+        e_total_ref (torch.Tensor): The total energy of the first step, a
+            scalar or of size (B).
+        ground_time (float | torch.Tensor): The time spent in the ground
+            state since the last hop into it, a scalar or of size (B), in
+            atomic units of time.
+        bonds (torch.Tensor | None): Bonds of size (2, M), see _bonds, needed
+            by ``max_bond_length``.
+
+    Returns:
+        reason (torch.Tensor): Index into TERMINATION_REASONS, a scalar or of
+            size (B), "NONE" for trajectories to propagate further.
+
+    """
+    batched = coords.dim() == 3
+    if not batched:
+        coords, velo, velo_prev = coords.unsqueeze(0), velo.unsqueeze(0), velo_prev.unsqueeze(0)
+        energies, forces = energies.unsqueeze(0), forces.unsqueeze(0)
+    ntraj = coords.size(dim=0)
+    state = torch.as_tensor(state, device=coords.device).reshape(-1).expand(ntraj)
+    e_total_ref = torch.as_tensor(e_total_ref, device=coords.device).reshape(-1)
+    ground_time = torch.as_tensor(ground_time, device=coords.device).reshape(-1)
+
+    checks = []
+    if criteria.nonfinite:
+        finite = (
+            coords.isfinite().all(dim=(-2, -1))
+            & energies.gather(-1, state.unsqueeze(-1)).squeeze(-1).isfinite()
+            & _active_forces(forces, state).isfinite().all(dim=(-2, -1))
+        )
+        checks.append((NONFINITE, ~finite))
+    if criteria.max_energy_drift is not None:
+        drift = (_total_energy(topology, state, velo, energies) - e_total_ref).abs()
+        checks.append((ENERGY_DRIFT, drift > criteria.max_energy_drift))
+    if criteria.max_ke_spike is not None:
+        spike = _kinetic_energy(topology, velo) - _kinetic_energy(topology, velo_prev)
+        checks.append((KINETIC_SPIKE, spike > criteria.max_ke_spike))
+    if criteria.max_bond_length is not None:
+        assert bonds is not None, 'a max bond length requires the bonds'
+        src, dst = bonds
+        length_sq = (coords[:, src] - coords[:, dst]).pow(2).sum(dim=-1)
+        checks.append((FRAGMENTED, (length_sq > criteria.max_bond_length ** 2).any(dim=-1)))
+    if criteria.ground_state_duration is not None:
+        checks.append((GROUND_STATE, ground_time >= criteria.ground_state_duration))
+
+    reason = torch.full((ntraj,), NONE, dtype=torch.long, device=coords.device)
+    # the first failed check wins
+    for code, failed in reversed(checks):
+        reason = torch.where(failed, code, reason)
+
+    return reason if batched else reason[0]
+
+
+if __name__ == '__main__':
+    ntests = 4
+    ntests_passed = 0
+
+    _NTRAJ = 6
+    _NATOMS = 10
+    _NSTATES = 3
+
+    torch.manual_seed(0)
+    topology = SystemTopology.build(torch.rand(_NATOMS) + 1.0, torch.ones(_NATOMS, 1), {'C': torch.tensor([1.])})
+    # a chain of atoms 1.0 apart
+    coords = torch.arange(_NATOMS).float().view(1, _NATOMS, 1) * torch.tensor([1.0, 0.0, 0.0])
+    coords = coords.repeat(_NTRAJ, 1, 1) + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3)
+    bonds = _bonds(coords, 1.2)
+    assert bonds.size(dim=1) == _NATOMS - 1 and bool((bonds[0] < bonds[1]).all())
+
+    velo = 0.01 * torch.randn(_NTRAJ, _NATOMS, 3)
+    energies = torch.randn(_NTRAJ, _NSTATES)
+    forces = torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3)
+    state = torch.tensor([0, 1, 2, 1, 0, 2])
+    e_total_ref = _total_energy(topology, state, velo, energies)
+    ground_time = torch.zeros(_NTRAJ)
+    criteria = TerminationCriteria(
+        max_energy_drift=0.1, max_ke_spike=1.0, max_bond_length=2.0, ground_state_duration=10.0
+    )
+
+    def _reasons(**kwargs) -> torch.Tensor:
+        args = dict(
+            criteria=criteria, topology=topology, state=state, coords=coords, velo=velo, velo_prev=velo,
+            energies=energies, forces=forces, e_total_ref=e_total_ref, ground_time=ground_time,
+            bonds=bonds
+        )
+        args.update(kwargs)
+        return _termination_reasons(**args)
+
+    # every check flags its own trajectory only
+    assert _reasons().tolist() == [NONE] * _NTRAJ
+    bad_forces = forces.clone()
+    bad_forces[0, 0, 3, 1] = float('nan')
+    # NaN forces of a state that is not populated are skipped forces
+    bad_forces[1, 0] = float('nan')
+    bad_energies = energies.clone()
+    bad_energies[1, 1] += 0.5
+    bad_velo = velo.clone()
+    bad_velo[2] += 2.0
+    bad_coords = coords.clone()
+    bad_coords[3, -1] += 5.0
+    bad_ground_time = ground_time.clone()
+    bad_ground_time[4] = 10.0
+    reasons = _reasons(
+        forces=bad_forces, energies=bad_energies, velo=bad_velo, coords=bad_coords, ground_time=bad_ground_time
+    )
+    assert [TERMINATION_REASONS[r] for r in reasons] == [
+        'NONFINITE', 'ENERGY_DRIFT', 'ENERGY_DRIFT', 'FRAGMENTED', 'GROUND_STATE', 'NONE'
+    ]
+    ntests_passed += 1
+
+    # the first failed check wins, skipped checks never fail
+    assert int(_reasons(velo=bad_velo, e_total_ref=_total_energy(topology, state, bad_velo, energies))[2]) == KINETIC_SPIKE
+    assert _reasons(criteria=TerminationCriteria(), velo=bad_velo, coords=bad_coords).tolist() == [NONE] * _NTRAJ
+    both = bad_coords.clone()
+    both[3, 0, 0] = float('inf')
+    assert int(_reasons(coords=both)[3]) == NONFINITE
+    ntests_passed += 1
+
+    # a single trajectory is a batch of one
+    reason = _termination_reasons(
+        criteria, topology, 1, bad_coords[3], velo[3], velo[3], energies[3], forces[3],
+        e_total_ref[3], 0.0, bonds
+    )
+    assert reason.dim() == 0 and int(reason) == FRAGMENTED
+    ntests_passed += 1
+
+    # on a bound potential the total energy of a healthy trajectory holds,
+    # a time step past the stability limit of the Verlet steps drifts
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import constants
+    from solvent_dynamics.computer._ml_energies_forces import _ml_energies_forces
+    from solvent_dynamics.trajectory import TrajectoryPropagator
+
+    class _WellModel(torch.nn.Module):
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = 0.5 * structure.pos.pow(2).sum()
+            return e + torch.arange(_NSTATES, dtype=e.dtype)
+
+    well = _WellModel()
+    well_topology = SystemTopology.build(
+        torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS, 1), {'C': torch.tensor([1.])}
+    )
+    well_coords = 0.35 * torch.randn(_NATOMS, 3, dtype=torch.float64)
+    well_velo = 0.1 * torch.randn(_NATOMS, 3, dtype=torch.float64)
+    e_init, f_init = _ml_energies_forces(
+        well, None, Data(pos=well_coords.clone()), constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS
+    )
+    zeros = torch.zeros(_NSTATES, _NSTATES, dtype=torch.float64)
+    for delta_t, reason in [(0.05, 'NONE'), (3.0, 'ENERGY_DRIFT')]:
+        traj = TrajectoryPropagator(
+            well, None, 0, well_topology, well_coords.clone(), well_velo.clone(), f_init.clone(), e_init.clone(),
+            zeros.clone(), zeros.clone(), zeros.clone(), delta_t=delta_t,
+            termination=TerminationCriteria(every=1, max_energy_drift=0.01)
+        )
+        for _ in range(160):
+            traj.propagate()
+            if not traj.status():
+                break
+        assert traj.termination_reason == reason
+        if reason == 'NONE':
+            assert traj._coords.cur.norm(dim=-1).max() < 2.0
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
@@ -0,0 +1,224 @@
+"""
+STATUS: DEV
+
+Adaptive time steps: small steps near surface crossings, large steps far
+from them.
+
+The next step is the smallest of three limits. Within ``gap_window`` of the
+nearest other state it is the smallest step. While the gap closes, no step
+may go further than a fraction of the time left until the gap enters the
+window at its current rate. No atom may move further than
+``max_displacement`` in a step. Steps grow by at most ``growth`` per step
+and shrink at once.
+
+Zhu-Nakamura hopping reads the three-point window in coordinates, not in
+time, so unequal steps around a crossing are handled as they are.
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._active_forces import _active_forces
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import NamedTuple, Union
+
+
+class TimeStepPolicy(NamedTuple):
+    """
+    min_delta_t: the smallest step, taken near crossings, in atomic units
+        of time
+    max_delta_t: the largest step, in atomic units of time
+    gap_window: the energy gap to the nearest other state below which the
+        smallest step is taken, in the units of the energies. Keep it at or
+        above the hopping gap thresholds.
+    max_displacement: the max distance an atom may move in a step, in the
+        units of the coordinates
+    growth: the max ratio of two consecutive steps
+    lookahead: the min number of steps left before a closing gap enters
+        the window
+
+    """
+    min_delta_t: float
+    max_delta_t: float
+    gap_window: float
+    max_displacement: float = 0.05
+    growth: float = 1.25
+    lookahead: float = 3.0
+
+
+def _nearest_gap(state: torch.Tensor, energies: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the energy gap between the populated state and the nearest
+    other state, inf with a single state.
+
+    """
+    e_state = energies.gather(-1, state.unsqueeze(-1))
+    gap = (energies - e_state).abs()
+    gap = gap.scatter(-1, state.unsqueeze(-1), float('inf'))
+
+    return gap.amin(dim=-1)
+
+
+def _adaptive_delta_t(
+        policy: TimeStepPolicy,
+        topology: SystemTopology,
+        state: Union[int, torch.Tensor],
+        delta_t: Union[float, torch.Tensor],
+        velo: torch.Tensor,
+        forces: torch.Tensor,
+        energies: torch.Tensor,
+        energies_prev: torch.Tensor
+    ) -> torch.Tensor:
+    """
+    Chooses the next time step of every trajectory.
+
+    Args:
+        policy (TimeStepPolicy): The step limits.
+        topology (SystemTopology): Topology of the molecular system.
+        state (int | torch.Tensor): The populated electronic state, or a
+            tensor of size (B) with one state per trajectory.
+        delta_t (float | torch.Tensor): The last time step, a scalar or of
+            size (B), in atomic units of time.
+        velo (torch.Tensor): Velocities of size (N, 3), or (B, N, 3).
+        forces (torch.Tensor): Forces of size (K, N, 3), or (B, K, N, 3),
+            only those of the populated state are read.
+        energies (torch.Tensor): Energies of size (K), or (B, K).
+        energies_prev (torch.Tensor): Energies of the previous step.
+
+    Returns:
+        delta_t (torch.Tensor): The next time step, a scalar or of size (B).
+
+    """
+    state = torch.as_tensor(state, device=energies.device).expand(energies.shape[:-1])
+    delta_t = torch.as_tensor(delta_t, dtype=energies.dtype, device=energies.device)
+
+    # the gap closes into the window in t_window at its current rate
+    gap = _nearest_gap(state, energies)
+    closing = (_nearest_gap(state, energies_prev) - gap) / delta_t
+    t_window = (gap - policy.gap_window) / closing
+    dt_gap = torch.where(closing > 0, t_window / policy.lookahead, policy.max_delta_t)
+    dt_gap = torch.where(gap <= policy.gap_window, policy.min_delta_t, dt_gap)
+
+    # |v| dt + |a| dt^2 / 2 <= d for every atom, the positive root in a form
+    # that stays finite at a = 0
+    v = velo.norm(dim=-1)
+    a = (_active_forces(forces, state) * topology.inv_mass_col).norm(dim=-1)
+    d = policy.max_displacement
+    dt_disp = (2 * d / (v + (v.pow(2) + 2 * a * d).sqrt())).amin(dim=-1)
+
+    dt = torch.minimum(torch.minimum(dt_gap, dt_disp), policy.growth * delta_t)
+    # blown up trajectories take the smallest step until they are terminated
+    return dt.nan_to_num(policy.min_delta_t).clamp(policy.min_delta_t, policy.max_delta_t)
+
+
+if __name__ == '__main__':
+    import time
+
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import constants
+    from solvent_dynamics.computer._ml_energies_forces import _ml_energies_forces
+    from solvent_dynamics.trajectory import TrajectoryPropagator
+
+    ntests = 4
+    ntests_passed = 0
+
+    _NTRAJ = 5
+    _NATOMS = 8
+    _NSTATES = 3
+
+    torch.manual_seed(0)
+    topology = SystemTopology.build(
+        torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS, 1), {'C': torch.tensor([1.])}
+    )
+    policy = TimeStepPolicy(min_delta_t=0.1, max_delta_t=2.0, gap_window=0.05, max_displacement=0.05)
+
+    # every limit binds its own trajectory
+    velo = torch.zeros(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    forces = torch.zeros(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    energies = torch.tensor([0.0, 1.0, 2.0], dtype=torch.float64).repeat(_NTRAJ, 1)
+    energies_prev = energies.clone()
+    state = torch.tensor([0, 1, 0, 0, 0])
+    delta_t = torch.full((_NTRAJ,), 1.0, dtype=torch.float64)
+    # 0: quiet, grows by the growth factor
+    # 1: within the window of state 0
+    energies[1, 0] = 0.96
+    # 2: the gap closes by 0.25 per unit of time, 2.6 units of time left
+    energies_prev[2, 1] = 0.95
+    energies[2, 1] = 0.7
+    # 3: fast atom, 0.05 / 0.5 = 0.1 units of time
+    velo[3, 2, 0] = 0.5
+    # 4: NaN velocities
+    velo[4, 0, 0] = float('nan')
+    dt = _adaptive_delta_t(policy, topology, state, delta_t, velo, forces, energies, energies_prev)
+    assert torch.allclose(dt, torch.tensor([1.25, 0.1, 2.6 / 3.0, 0.1, 0.1], dtype=torch.float64))
+    ntests_passed += 1
+
+    # the displacement limit holds under acceleration, steps stay bounded
+    forces[0, 0] = torch.randn(_NATOMS, 3, dtype=torch.float64)
+    velo[0] = 0.01 * torch.randn(_NATOMS, 3, dtype=torch.float64)
+    dt = _adaptive_delta_t(policy, topology, state, 10.0, velo, forces, energies, energies)
+    accel = forces[0, 0] * topology.inv_mass_col
+    disp = velo[0].norm(dim=-1) * dt[0] + 0.5 * accel.norm(dim=-1) * dt[0] ** 2
+    assert torch.isclose(disp.max(), torch.tensor(policy.max_displacement, dtype=torch.float64))
+    assert (dt >= policy.min_delta_t).all() and (dt <= policy.max_delta_t).all()
+    ntests_passed += 1
+
+    # a single trajectory and a single state
+    dt = _adaptive_delta_t(policy, topology, 0, 1.0, velo[0], forces[0, :1], energies[0, :1], energies[0, :1])
+    assert dt.dim() == 0 and 0.1 <= float(dt) < 1.25
+    ntests_passed += 1
+
+    # an avoided crossing along x: adaptive steps cross it with the smallest
+    # step and spend far fewer model evaluations on the quiet stretches
+    class _CrossingModel(torch.nn.Module):
+        def forward(self, structure: Data) -> torch.Tensor:
+            pos = structure.pos
+            half = ((0.05 * pos[:, 0].mean()).pow(2) + 0.005 ** 2).sqrt()
+            return torch.stack([-half, half])
+
+    _DURATION = 40.0
+    crossing_model = _CrossingModel()
+    coords = torch.randn(_NATOMS, 3, dtype=torch.float64) * 0.1
+    coords[:, 0] -= 2.0
+    velo = torch.zeros(_NATOMS, 3, dtype=torch.float64)
+    velo[:, 0] = 0.1
+    energies, forces = _ml_energies_forces(
+        crossing_model, None, Data(pos=coords.clone()), constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS
+    )
+    policy = TimeStepPolicy(min_delta_t=0.1, max_delta_t=2.0, gap_window=0.02, max_displacement=0.1)
+    zeros = torch.zeros(2, 2, dtype=torch.float64)
+    nevals = {}
+    for time_step in [None, policy]:
+        traj = TrajectoryPropagator(
+            crossing_model, None, 0, topology, coords.clone(), velo.clone(), forces.clone(), energies.clone(),
+            zeros.clone(), zeros.clone(), zeros.clone(), delta_t=policy.min_delta_t, seed=0, time_step=time_step
+        )
+        while traj.time < _DURATION:
+            traj.propagate()
+            if time_step is not None and _nearest_gap(torch.tensor(0), traj._energies.cur) <= policy.gap_window:
+                assert traj.delta_t == policy.min_delta_t
+        nevals['FIXED' if time_step is None else 'ADAPTIVE'] = traj.iteration
+    assert nevals['ADAPTIVE'] < nevals['FIXED'] / 3
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+
+    print('')
+    print('{:<10}  {:>18}'.format('steps', 'evaluations / au'))
+    for k, v in nevals.items():
+        print('{:<10}  {:>18.2f}'.format(k, v / _DURATION))
+
+    # benchmark: cost of choosing a step for a batch of trajectories
+    _NREPEATS = 200
+    print('')
+    velo = torch.randn(64, 51, 3, dtype=torch.float64)
+    forces = torch.randn(64, _NSTATES, 51, 3, dtype=torch.float64)
+    energies = torch.rand(64, _NSTATES, dtype=torch.float64)
+    state = torch.zeros(64, dtype=torch.long)
+    topology = SystemTopology.build(torch.rand(51, dtype=torch.float64) + 1.0, torch.ones(51, 1), {'C': torch.tensor([1.])})
+    t = time.perf_counter()
+    for _ in range(_NREPEATS):
+        _adaptive_delta_t(policy, topology, state, 1.0, velo, forces, energies, energies)
+    print(f'64 trajectories x 51 atoms: {(time.perf_counter() - t) / _NREPEATS * 1e3:.3f}ms per step choice')
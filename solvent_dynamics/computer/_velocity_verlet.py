@@ -0,0 +1,189 @@
+"""
+STATUS: SYNTAX PASS
+
+One full velocity Verlet step: next coordinates, a force evaluation at the
+next coordinates, next velocities and the resulting kinetic energy.
+https://en.wikipedia.org/wiki/Verlet_integration
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._active_forces import _active_forces
+from solvent_dynamics.computer._system_topology import SystemTopology
+from solvent_dynamics.computer._verlet_coords import _verlet_coords
+from solvent_dynamics.computer._ml_energies_forces import EnergiesForces
+from solvent_dynamics.computer._profiler import _phase
+
+from typing import Callable, NamedTuple, Optional, Union
+
+
+class VerletStep(NamedTuple):
+    coords: torch.Tensor
+    velo: torch.Tensor
+    energies: torch.Tensor
+    forces: torch.Tensor
+    ke: torch.Tensor
+
+
+def _velocity_verlet(
+        state: Union[int, torch.Tensor],
+        coords: torch.Tensor,
+        topology: SystemTopology,
+        velo: torch.Tensor,
+        forces: torch.Tensor,
+        delta_t: float,
+        energies_forces: Callable[[torch.Tensor], EnergiesForces],
+        out_coords: Optional[torch.Tensor]=None,
+        out_velo: Optional[torch.Tensor]=None
+    ) -> VerletStep:
+    """
+    Propagates a molecular system by one velocity Verlet step.
+
+    Every tensor may carry a leading batch dimension B, in which case ``state``
+    is a tensor of size (B) with one state per trajectory.
+
+    Args:
+        state (int | torch.Tensor): Electronic energy state of which this
+            molecular system is populating.
+        coords (torch.Tensor): Coordinate positions of size (N, 3) where N is
+            the number of atoms.
+        topology (SystemTopology): Topology of the molecular system.
+        velo (torch.Tensor): Atomic velocities of size (N, 3).
+        forces (torch.Tensor): Current atomic forces of size (K, N, 3), where
+            K is the number of electronic states.
+        delta_t (float): The change in time from the previous snapshot to
+            this snapshot in atomic units of time, au.
+        energies_forces (Callable): Evaluates the energies and forces at the
+            given coordinates, usually a wrapper of ``ml_energies_forces``.
+        out_coords (torch.Tensor | None): An optional buffer of the same size
+            as ``coords`` to write the next coordinates into.
+        out_velo (torch.Tensor | None): An optional buffer of the same size as
+            ``velo`` to write the next velocities into.
+
+    Returns:
+        coords, velo, energies, forces, ke (VerletStep): The next coordinates,
+            velocities, energies, forces and kinetic energy.
+
+    """
+    with _phase('verlet_coords'):
+        next_coords = _verlet_coords(
+            state=state,
+            coords=coords,
+            topology=topology,
+            velo=velo,
+            forces=forces,
+            delta_t=delta_t,
+            out=out_coords
+        )
+    next_energies, next_forces = energies_forces(next_coords)
+
+    # v' = v + dt / 2m * (f + f')
+    with _phase('verlet_velo'):
+        f = _active_forces(forces, state) + _active_forces(next_forces, state)
+        if out_velo is None:
+            next_velo = torch.addcmul(velo, f, topology.inv_mass_col, value=0.5 * delta_t)
+        else:
+            next_velo = torch.addcmul(velo, f, topology.inv_mass_col, value=0.5 * delta_t, out=out_velo)
+    with _phase('kinetic_energy'):
+        ke = 0.5 * torch.sum(topology.mass_col * next_velo.pow(2), dim=(-2, -1))
+
+    return VerletStep(next_coords, next_velo, next_energies, next_forces, ke)
+
+
+if __name__ == '__main__':
+    ntests = 3
+    ntests_passed = 0
+
+    def _loop_verlet_coords(state, coords, mass, velo, forces, delta_t):
+        next_coords = []
+        for i in range(coords.size(dim=0)):
+            delta_pos = (velo[i] * delta_t + 0.5 * forces[state][i] / mass[i] * delta_t ** 2)
+            next_coords.extend([coords[i] + delta_pos])
+        return torch.stack(next_coords, dim=0)
+
+    def _loop_verlet_velo(state, coords, mass, velo, forces, forces_prev, delta_t):
+        next_velo = []
+        for i in range(coords.size(dim=0)):
+            delta_velo = 0.5 * (forces_prev[state][i] + forces[state][i]) / mass[i] * delta_t
+            next_velo.extend([velo[i] + delta_velo])
+        return torch.stack(next_velo, dim=0)
+
+    def _loop_kinetic_energy(mass, velo):
+        ke_c = []
+        for i in range(velo.size(dim=0)):
+            ke_c.append(torch.sum(0.5 * mass[i] * velo[i].pow(2)))
+        return torch.stack(ke_c, dim=0).sum()
+
+    _NTRAJ = 4
+    _NATOMS = 51
+    _NSTATES = 3
+
+    torch.manual_seed(0)
+    state = torch.tensor([2, 0, 1, 2])
+    coords = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    mass = torch.rand(_NATOMS, dtype=torch.float64) + 1.0
+    topology = SystemTopology.build(mass, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    velo = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    forces = torch.rand(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    next_forces = torch.rand(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    next_energies = torch.rand(_NTRAJ, _NSTATES, dtype=torch.float64)
+    delta_t = 0.05
+
+    # single trajectory
+    step = _velocity_verlet(
+        state=int(state[0]),
+        coords=coords[0],
+        topology=topology,
+        velo=velo[0],
+        forces=forces[0],
+        delta_t=delta_t,
+        energies_forces=lambda c: EnergiesForces(next_energies[0], next_forces[0])
+    )
+    ref_coords = _loop_verlet_coords(int(state[0]), coords[0], mass, velo[0], forces[0], delta_t)
+    ref_velo = _loop_verlet_velo(int(state[0]), ref_coords, mass, velo[0], next_forces[0], forces[0], delta_t)
+    assert torch.allclose(step.coords, ref_coords)
+    assert torch.allclose(step.velo, ref_velo)
+    assert torch.allclose(step.ke, _loop_kinetic_energy(mass, ref_velo))
+    ntests_passed += 1
+
+    # batched, in place
+    out_coords = torch.empty_like(coords)
+    out_velo = torch.empty_like(velo)
+    step = _velocity_verlet(
+        state=state,
+        coords=coords,
+        topology=topology,
+        velo=velo,
+        forces=forces,
+        delta_t=delta_t,
+        energies_forces=lambda c: EnergiesForces(next_energies, next_forces),
+        out_coords=out_coords,
+        out_velo=out_velo
+    )
+    assert step.coords.data_ptr() == out_coords.data_ptr()
+    assert step.velo.data_ptr() == out_velo.data_ptr()
+    for b in range(_NTRAJ):
+        s = int(state[b])
+        ref_coords = _loop_verlet_coords(s, coords[b], mass, velo[b], forces[b], delta_t)
+        ref_velo = _loop_verlet_velo(s, ref_coords, mass, velo[b], next_forces[b], forces[b], delta_t)
+        assert torch.allclose(step.coords[b], ref_coords)
+        assert torch.allclose(step.velo[b], ref_velo)
+        assert torch.allclose(step.ke[b], _loop_kinetic_energy(mass, ref_velo))
+    ntests_passed += 1
+
+    # forces are -dE/dx, a harmonic well keeps the trajectory bound and
+    # conserves the kinetic plus the potential energy
+    def _well(c: torch.Tensor) -> EnergiesForces:
+        return EnergiesForces(0.5 * c.pow(2).sum().view(1), -c.unsqueeze(0))
+
+    c, v = coords[0] - 0.5, velo[0] - 0.5
+    e, f = _well(c)
+    total = 0.5 * (mass.unsqueeze(-1) * v.pow(2)).sum() + e[0]
+    for _ in range(2000):
+        c, v, e, f, ke = _velocity_verlet(0, c, topology, v, f, delta_t, _well)
+        assert c.abs().max() < 10.0
+    assert torch.isclose(ke + e[0], total, rtol=1e-4)
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
@@ -4,33 +4,38 @@ STATUS: SYNTAX PASS
 Next coordinate propagation
 https://en.wikipedia.org/wiki/Verlet_integration
 
-# optimizations:
-    - replace loop with vmap
-
 """
 
 import torch
 
+from solvent_dynamics.computer._active_forces import _active_forces
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import Optional, Union
+
 
 def _verlet_coords(
-        state: int,
+        state: Union[int, torch.Tensor],
         coords: torch.Tensor,
-        mass: torch.Tensor,
+        topology: SystemTopology,
         velo: torch.Tensor,
         forces: torch.Tensor,
         delta_t: float,
+        out: Optional[torch.Tensor]=None
     ) -> torch.Tensor:
     """
     Computes the next atomic coordinate positions using Verlet Integration.
 
+    Every tensor may carry a leading batch dimension B, in which case ``state``
+    is a tensor of size (B) with one state per trajectory.
+
     Args:
-        state (int): Electronic energy state of which this molecular system is
-            populating.
+        state (int | torch.Tensor): Electronic energy state of which this
+            molecular system is populating.
         coords (torch.Tensor): Coordinate positions of size (N, 3) where N is
             the number of atoms and 3 corresponds to x, y, and z positions in
             Angstroms.
-        mass (torch.Tensor): Atomic mass tensor of size (N) where N is the
-            number of atoms.
+        topology (SystemTopology): Topology of the molecular system.
         velo (torch.Tensor): Atomic velocities with respect to the x, y, and z
             axis given by a tensor of size (N, 3) where N is the number of
             atoms.
@@ -39,6 +44,8 @@ def _verlet_coords(
             electronic states and N is the number of atoms.
         delta_t (float): The change in time from the previous snapshot to
             this snapshot in atomic units of time, au.
+        out (torch.Tensor | None): An optional buffer of the same size as
+            ``coords`` to write the result into.
 
     Returns:
         next_coords (torch.Tensor): Coordinate positions of size (N, 3) where N is
@@ -46,15 +53,14 @@ def _verlet_coords(
             Angstroms.
 
     """
-    natoms = coords.size(dim=0)
-    next_coords = []
-    for i in range(natoms):
-        delta_pos = (velo[i] * delta_t - 0.5 * forces[state][i] / mass[i] * delta_t ** 2)
-        next_coords.extend([coords[i] + delta_pos])
-    
-    next_coords = torch.stack(next_coords, dim=0)
+    accel = _active_forces(forces, state) * topology.inv_mass_col
+    if out is None:
+        return coords + velo * delta_t + 0.5 * accel * delta_t ** 2
+
+    torch.add(coords, velo, alpha=delta_t, out=out)
+    out.add_(accel, alpha=0.5 * delta_t ** 2)
 
-    return next_coords
+    return out
 
 
 if __name__ == '__main__':
@@ -63,7 +69,7 @@ if __name__ == '__main__':
 
     state = 2
     coords = torch.rand(51, 3)
-    mass = torch.rand(51)
+    topology = SystemTopology.build(torch.rand(51), torch.ones(51), {'C': torch.tensor(1.)})
     velo = torch.rand(51, 3)
     forces = torch.rand(3, 51, 3)
     delta_t = 0.05
@@ -71,7 +77,7 @@ if __name__ == '__main__':
     next_coords = _verlet_coords(
         state=state,
         coords=coords,
-        mass=mass,
+        topology=topology,
         velo=velo,
         forces=forces,
         delta_t=delta_t
@@ -4,34 +4,39 @@ STATUS: SYNTAX PASS
 Next velocity propagation
 https://en.wikipedia.org/wiki/Verlet_integration
 
-# optimizations:
-    - replace loop with vmap
-
 """
 
 import torch
 
+from solvent_dynamics.computer._active_forces import _active_forces
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import Optional, Union
+
 
 def _verlet_velo(
-        state: int,
+        state: Union[int, torch.Tensor],
         coords: torch.Tensor,
-        mass: torch.Tensor,
+        topology: SystemTopology,
         velo: torch.Tensor,
         forces: torch.Tensor,
         forces_prev: torch.Tensor,
         delta_t: float,
+        out: Optional[torch.Tensor]=None
     ) -> torch.Tensor:
     """
-    Computes the next atomic coordinate positions using Verlet Integration.
+    Computes the next atomic velocities using Verlet Integration.
+
+    Every tensor may carry a leading batch dimension B, in which case ``state``
+    is a tensor of size (B) with one state per trajectory.
 
     Args:
-        state (int): Electronic energy state of which this molecular system is
-            populating.
+        state (int | torch.Tensor): Electronic energy state of which this
+            molecular system is populating.
         coords (torch.Tensor): Coordinate positions of size (N, 3) where N is
             the number of atoms and 3 corresponds to x, y, and z positions in
             Angstroms.
-        mass (torch.Tensor): Atomic mass tensor of size (N) where N is the
-            number of atoms.
+        topology (SystemTopology): Topology of the molecular system.
         velo (torch.Tensor): Atomic velocities with respect to the x, y, and z
             axis given by a tensor of size (N, 3) where N is the number of
             atoms.
@@ -43,6 +48,8 @@ def _verlet_velo(
             the number of electronic states and N is the number of atoms.
         delta_t (float): The change in time from the previous snapshot to
             this snapshot in atomic units of time, au.
+        out (torch.Tensor | None): An optional buffer of the same size as
+            ``velo`` to write the result into.
 
     Returns:
         next_velo (torch.Tensor): Atomic velocities with respect to the x, y, and z
@@ -50,15 +57,14 @@ def _verlet_velo(
             atoms.
 
     """
-    natoms = coords.size(dim=0)
-    next_velo = []
-    for i in range(natoms):
-        delta_velo = 0.5 * (forces_prev[state][i] + forces[state][i]) / mass[i] * delta_t
-        next_velo.extend([velo[i] - delta_velo])
+    f = _active_forces(forces_prev, state) + _active_forces(forces, state)
+    accel = f * topology.inv_mass_col
+    if out is None:
+        return velo + 0.5 * accel * delta_t
 
-    next_velo = torch.stack(next_velo, dim=0)
+    torch.add(velo, accel, alpha=0.5 * delta_t, out=out)
 
-    return next_velo
+    return out
 
 
 if __name__ == '__main__':
@@ -67,7 +73,7 @@ if __name__ == '__main__':
 
     state = 2
     coords = torch.rand(51, 3)
-    mass = torch.rand(51)
+    topology = SystemTopology.build(torch.rand(51), torch.ones(51), {'C': torch.tensor(1.)})
     velo = torch.rand(51, 3)
     forces = torch.rand(3, 51, 3)
     forces_prev = torch.rand(3, 51, 3)
@@ -76,7 +82,7 @@ if __name__ == '__main__':
     next_velo = _verlet_velo(
         state=state,
         coords=coords,
-        mass=mass,
+        topology=topology,
         velo=velo,
         forces=forces,
         forces_prev=forces_prev,
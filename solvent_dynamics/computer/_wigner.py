@@ -0,0 +1,120 @@
+"""
+STATUS: DEV
+
+Wigner sampling of harmonic normal modes.
+https://doi.org/10.1103/PhysRev.40.749
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import NamedTuple, Optional
+
+
+class NormalModes(NamedTuple):
+    """
+    Harmonic vibrational normal modes of a molecular system, in atomic units.
+
+    eq_coords: equilibrium coordinates of size (N, 3)
+    freqs: angular frequencies of size (M), translations, rotations and
+        imaginary modes excluded
+    modes: orthonormal mass-weighted displacement vectors of size (M, N, 3)
+
+    """
+    eq_coords: torch.Tensor
+    freqs: torch.Tensor
+    modes: torch.Tensor
+
+
+class WignerSample(NamedTuple):
+    coords: torch.Tensor
+    velo: torch.Tensor
+
+
+def _wigner_sample(
+        topology: SystemTopology,
+        modes: NormalModes,
+        nsamples: int,
+        temp: float,
+        boltzmann: float,
+        generator: Optional[torch.Generator]=None
+    ) -> WignerSample:
+    """
+    Draws coordinates and velocities of many samples at once from the Wigner
+    distribution of uncoupled harmonic oscillators at a temperature.
+
+    Every mode is Gaussian in its mass-weighted coordinate and momentum, with
+    the ground-state widths 1 / (2w) and w / 2 scaled by coth(w / 2kT) for the
+    thermally populated excited states.
+
+    Args:
+        topology (SystemTopology): Topology of the molecular system.
+        modes (NormalModes): Normal modes of the molecular system.
+        nsamples (int): The number of samples S to draw.
+        temp (float): Temperature in Kelvin, 0 samples the ground state.
+        boltzmann (float): The Boltzmann constant in energy units per Kelvin.
+        generator (torch.Generator | None): An optional seeded generator.
+
+    Returns:
+        coords, velo (torch.Tensor, torch.Tensor): Coordinates and velocities
+            of size (S, N, 3), in bohr and bohr per atomic unit of time.
+
+    """
+    freqs = modes.freqs
+    if (freqs <= 0).any():
+        raise ValueError('wigner sampling requires positive frequencies, drop translations, rotations and imaginary modes')
+    nmodes = freqs.size(dim=0)
+
+    # at 0 K the ratio is inf and coth is exactly 1
+    coth = torch.tanh(freqs / (2 * boltzmann * temp)).reciprocal()
+    sigma_q = (coth / (2 * freqs)).sqrt()
+    sigma_p = (coth * freqs / 2).sqrt()
+    qp = torch.randn(2, nsamples, nmodes, dtype=freqs.dtype, device=freqs.device, generator=generator)
+
+    # mass-weighted to cartesian displacements, every sample is a single matmul
+    cart = (modes.modes * topology.inv_mass_col.sqrt()).reshape(nmodes, -1)
+    coords = torch.addmm(modes.eq_coords.reshape(1, -1), qp[0] * sigma_q, cart)
+    velo = torch.mm(qp[1] * sigma_p, cart)
+
+    return WignerSample(coords.view(nsamples, -1, 3), velo.view(nsamples, -1, 3))
+
+
+if __name__ == '__main__':
+    ntests = 2
+    ntests_passed = 0
+
+    _NATOMS = 4
+    _NSAMPLES = 200000
+    _BOLTZMANN = 3.166811563e-06
+
+    torch.manual_seed(0)
+    mass = torch.rand(_NATOMS, dtype=torch.float64) * 20000.0 + 1000.0
+    topology = SystemTopology.build(mass, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    basis, _ = torch.linalg.qr(torch.rand(_NATOMS * 3, _NATOMS * 3, dtype=torch.float64))
+    modes = NormalModes(
+        eq_coords=torch.rand(_NATOMS, 3, dtype=torch.float64),
+        freqs=torch.tensor([0.002, 0.007, 0.015], dtype=torch.float64),
+        modes=basis[:3].reshape(3, _NATOMS, 3)
+    )
+
+    # projected back onto the modes, every coordinate has the analytic variance
+    for temp in [0.0, 300.0]:
+        g = torch.Generator().manual_seed(1)
+        coords, velo = _wigner_sample(topology, modes, _NSAMPLES, temp, _BOLTZMANN, generator=g)
+        mw = topology.mass_col.sqrt()
+        q = torch.einsum('snc,mnc->sm', (coords - modes.eq_coords) * mw, modes.modes)
+        p = torch.einsum('snc,mnc->sm', velo * mw, modes.modes)
+        coth = 1 / torch.tanh(modes.freqs / (2 * _BOLTZMANN * temp))
+        assert torch.allclose(q.var(dim=0), coth / (2 * modes.freqs), rtol=2e-2)
+        assert torch.allclose(p.var(dim=0), coth * modes.freqs / 2, rtol=2e-2)
+    ntests_passed += 1
+
+    try:
+        _wigner_sample(topology, modes._replace(freqs=-modes.freqs), 1, 300.0, _BOLTZMANN)
+        assert False
+    except ValueError:
+        ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
@@ -0,0 +1,151 @@
+"""
+STATUS: DEV
+
+Internal conversion and intersystem crossing hopping probabilities of every
+state pair in a single Zhu-Nakamura evaluation. The gap history is computed
+once, both screens select from it, and the pairs of both kinds are gathered
+into one set of rows.
+
+"""
+
+import torch
+
+from solvent_dynamics.computer._internal_conversion import (
+    P_NACS,
+    _batch_state_ke,
+    _delta_e,
+    _gap_screen,
+    _zn_evaluate
+)
+from solvent_dynamics.computer._intersystem_crossing import _other_spin, _soc_gap
+from solvent_dynamics.computer._step_kernels import _step_kernel
+from solvent_dynamics.computer._system_topology import SystemTopology
+
+from typing import Optional, Tuple, Union
+
+
+@_step_kernel()
+def _zn_screen(
+        state: torch.Tensor,
+        state_mult: torch.Tensor,
+        energies: torch.Tensor,
+        energies_prev: torch.Tensor,
+        energies_prev_prev: torch.Tensor,
+        soc: Optional[torch.Tensor],
+        ic_e_thresh: float,
+        isc_e_thresh: float
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Screens every state pair on the gap history, internal conversion towards
+    states of the same spin and intersystem crossing towards the others.
+
+    Returns:
+        screen, gap (torch.Tensor, torch.Tensor): The pairs to evaluate and
+            the adiabatic gap of every pair at the crossing point, of size
+            (..., K).
+
+    """
+    delta_e = _delta_e(state, energies, energies_prev, energies_prev_prev)
+    other_spin = _other_spin(state, state_mult)
+
+    screen = _gap_screen(delta_e, ic_e_thresh) & ~other_spin
+    gap = delta_e[..., 1, :]
+    if soc is not None:
+        soc_gap = _soc_gap(state, soc)
+        screen |= _gap_screen(delta_e, isc_e_thresh) & other_spin & (soc_gap > 0)
+        gap = torch.where(other_spin, soc_gap, gap)
+
+    return screen, gap
+
+
+def _zn_hopping(
+        state: Union[int, torch.Tensor],
+        state_mult: torch.Tensor,
+        topology: SystemTopology,
+        coord: torch.Tensor,
+        coord_prev: torch.Tensor,
+        coord_prev_prev: torch.Tensor,
+        energies: torch.Tensor,
+        energies_prev: torch.Tensor,
+        energies_prev_prev: torch.Tensor,
+        forces: torch.Tensor,
+        forces_prev_prev: torch.Tensor,
+        soc: Optional[torch.Tensor],
+        ke: torch.Tensor,
+        ic_e_thresh: float,
+        isc_e_thresh: float
+    ) -> P_NACS:
+    """
+    Computes the hopping probabilities and coupling vectors between the
+    current state and every state: internal conversion towards states of the
+    same spin, intersystem crossing towards the others.
+
+    See _internal_conversion and _intersystem_crossing for the arguments.
+
+    Args:
+        soc (torch.Tensor | None): Spin-orbit couplings of size (K, K) or
+            (B, K, K), no intersystem crossing if not given.
+
+    Returns:
+        p, nacs (torch.Tensor, torch.Tensor): The hopping probabilities of
+            size (K) and the normalized coupling vectors of size (K, N, 3),
+            with a leading B for a batch.
+
+    """
+    state, ke = _batch_state_ke(state, ke, energies)
+    screen, gap = _zn_screen(
+        state, state_mult, energies, energies_prev, energies_prev_prev, soc, ic_e_thresh, isc_e_thresh
+    )
+
+    return _zn_evaluate(
+        screen=screen,
+        gap=gap,
+        state=state,
+        topology=topology,
+        coord=coord,
+        coord_prev=coord_prev,
+        coord_prev_prev=coord_prev_prev,
+        energies_prev=energies_prev,
+        forces=forces,
+        forces_prev_prev=forces_prev_prev,
+        ke=ke
+    )
+
+
+if __name__ == '__main__':
+    from solvent_dynamics.computer._internal_conversion import _internal_conversion
+    from solvent_dynamics.computer._intersystem_crossing import _intersystem_crossing
+
+    ntests = 1
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NSTATES = 5
+    _NTRAJ = 16
+
+    torch.manual_seed(0)
+    topology = SystemTopology.build(torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    state_mult = torch.tensor([1, 1, 3, 3, 3])
+    coord = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev = coord + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    coord_prev_prev = coord_prev + 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    energies, energies_prev_prev = torch.rand(2, _NTRAJ, _NSTATES, dtype=torch.float64).mul(0.5).unbind(0)
+    energies_prev = torch.rand(_NTRAJ, _NSTATES, dtype=torch.float64).mul(0.1)
+    forces = 0.01 * torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    forces_prev_prev = 0.01 * torch.randn(_NTRAJ, _NSTATES, _NATOMS, 3, dtype=torch.float64)
+    soc = torch.rand(_NSTATES, _NSTATES, dtype=torch.float64).mul(1e-3)
+    soc = (soc + soc.T) * (state_mult.unsqueeze(0) != state_mult.unsqueeze(1))
+    ke = 0.1 * torch.rand(_NTRAJ, dtype=torch.float64)
+    state = torch.randint(_NSTATES, (_NTRAJ,))
+    shared = (topology, coord, coord_prev, coord_prev_prev, energies, energies_prev, energies_prev_prev, forces, forces_prev_prev)
+
+    # one pass gives the internal conversion and intersystem crossing pairs
+    p, nacs = _zn_hopping(state, state_mult, *shared, soc, ke, 0.06, 0.04)
+    p_ic, nacs_ic = _internal_conversion(state, *shared, ke, 0.06, mask=~_other_spin(state, state_mult))
+    p_isc, nacs_isc = _intersystem_crossing(state, state_mult, *shared, soc, ke, 0.04)
+    assert (p_ic > 0).any() and (p_isc > 0).any()
+    assert torch.allclose(p, p_ic + p_isc) and torch.allclose(nacs, nacs_ic + nacs_isc)
+    assert torch.equal(_zn_hopping(state, state_mult, *shared, None, ke, 0.06, 0.04).p, p_ic)
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
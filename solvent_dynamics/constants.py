@@ -3,3 +3,12 @@ RMS_FORCE_EVS = 0.7182231545448303
 
 INTERNAL_CONVERSION_ENERGY_GAP = 0.0183746544
 INTERSYSTEM_CROSSING_ENERGY_GAP = 0.0110247926
+# surface hopping reads the forces one step either side of a crossing point,
+# where gaps may exceed the hopping thresholds by up to this margin
+FORCE_GAP_WINDOW_MARGIN = 0.0183746544
+
+BOLTZMANN_AU = 3.166811563e-06
+BOHR_ANGSTROM = 0.529177210903
+AU_TIME_FS = 2.418884326585747e-2
+
+NEIGHBOR_RADIUS = 4.6
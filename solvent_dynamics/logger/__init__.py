@@ -0,0 +1,2 @@
+from ._trajectory_logger import TrajectoryLogger, LoggerStats, read_log
+from ._trajectory_logger import LOG_FORMATS, VERBOSITIES
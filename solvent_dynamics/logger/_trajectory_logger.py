@@ -0,0 +1,574 @@
+"""
+STATUS: DEV
+
+Structured per-trajectory step logs. A log directory holds one file per
+trajectory, ``<traj>.jsonl`` with one JSON object per record or ``<traj>.bin``
+with packed fixed-size records, and a ``meta.json`` file with the format,
+the verbosity and the record layout.
+
+Records are collected in memory on the propagating thread and written by a
+background thread in batches. The propagating thread never waits on the
+disk: once ``max_pending`` batches are queued it waits at most ``max_wait``
+seconds for the writer, then the batch is dropped and counted.
+
+"""
+
+import os
+import json
+import time
+import queue
+import torch
+import threading
+import numpy as np
+
+from solvent_dynamics.computer import HOP_TYPES
+
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
+
+
+LOG_FORMATS = ('JSONL', 'BINARY')
+# "HOPS": steps with a hop or a frustrated hop only
+# "STEPS": every ``stride``-th step and every hop, the populated state only
+# "FULL": as "STEPS" with the energies and hopping probabilities of every state
+VERBOSITIES = ('HOPS', 'STEPS', 'FULL')
+
+_EXTENSIONS = {'JSONL': 'jsonl', 'BINARY': 'bin'}
+
+
+class LoggerStats(NamedTuple):
+    """
+    records: the number of records written
+    dropped: the number of records dropped while the writer fell behind
+    batches: the number of batches written
+    max_pending: the largest number of batches queued for the writer
+    write_time: the time in seconds spent writing on the background thread
+
+    """
+    records: int
+    dropped: int
+    batches: int
+    max_pending: int
+    write_time: float
+
+
+def _record_dtype(verbosity: str, nstates: int) -> np.dtype:
+    fields = [
+        ('step', '<i8'),
+        ('time', '<f8'),
+        ('state', '<i8'),
+        ('hop_type', '<i1'),
+        ('kinetic_energy', '<f8')
+    ]
+    if verbosity == 'FULL':
+        fields += [('energies', '<f8', (nstates,)), ('hop_p', '<f8', (nstates,))]
+    else:
+        fields += [('energy', '<f8')]
+
+    return np.dtype(fields)
+
+
+def _copy(value: Any) -> Any:
+    return value.detach().clone() if isinstance(value, torch.Tensor) else value
+
+
+class TrajectoryLogger:
+    """
+    Logs the steps of one or more trajectories asynchronously.
+
+    """
+    def __init__(
+            self,
+            path: str,
+            fmt: str='JSONL',
+            verbosity: str='STEPS',
+            stride: int=1,
+            batch_size: int=256,
+            max_pending: int=16,
+            max_wait: float=0.0
+        ) -> None:
+        """
+        Opens a log directory and starts the writer thread.
+
+        Args:
+            path (str): Directory of the logs, created if missing. Logs of
+                trajectories already in it are appended to.
+            fmt (str): one of "JSONL" | "BINARY", see read_log.
+            verbosity (str): one of "HOPS" | "STEPS" | "FULL", see
+                VERBOSITIES.
+            stride (int): The number of steps between two logged steps, hops
+                are logged at every step.
+            batch_size (int): The number of records collected before they
+                are handed to the writer.
+            max_pending (int): The max number of batches queued for the
+                writer.
+            max_wait (float): The max time in seconds a full queue holds up
+                the propagating thread before a batch is dropped.
+
+        Returns:
+            None
+
+        """
+        if fmt not in LOG_FORMATS:
+            raise ValueError(f'invalid log format: {fmt}')
+        if verbosity not in VERBOSITIES:
+            raise ValueError(f'invalid verbosity: {verbosity}')
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._fmt = fmt
+        self._verbosity = verbosity
+        self._stride = stride
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+
+        self._batch: List[tuple] = []
+        self._nbatch = 0
+        self._queue: 'queue.Queue[Optional[List[tuple]]]' = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._records = 0
+        self._dropped = 0
+        self._batches = 0
+        self._max_pending = 0
+        self._write_time = 0.0
+        self._error: Optional[BaseException] = None
+        self._files = {}
+        self._dtype: Optional[np.dtype] = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='trajectory-logger', daemon=True)
+        self._thread.start()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def log(
+            self,
+            traj: Union[int, Sequence[int]],
+            step: int,
+            time: Union[float, torch.Tensor],
+            state: Union[int, torch.Tensor],
+            energies: torch.Tensor,
+            kinetic_energy: torch.Tensor,
+            hop_type: Union[int, torch.Tensor],
+            hop_p: Optional[torch.Tensor]=None
+        ) -> None:
+        """
+        Logs a step of a trajectory, or of every trajectory of an ensemble.
+        Tensors are copied, the records are formatted and written on the
+        writer thread.
+
+        Args:
+            traj (int | Sequence[int]): Index of the trajectory, or indices
+                of the B trajectories of an ensemble.
+            step (int): The iteration of the step.
+            time (float | torch.Tensor): The simulated time in atomic units
+                of time, a scalar or of size (B).
+            state (int | torch.Tensor): The populated electronic state, a
+                scalar or of size (B).
+            energies (torch.Tensor): Energies of size (K), or (B, K).
+            kinetic_energy (torch.Tensor): Kinetic energy, a scalar or of
+                size (B).
+            hop_type (int | torch.Tensor): Index into HOP_TYPES, a scalar or
+                of size (B).
+            hop_p (torch.Tensor | None): Hopping probabilities of size (K),
+                or (B, K), zeros if not given.
+
+        Returns:
+            None
+
+        """
+        on_stride = self._verbosity != 'HOPS' and step % self._stride == 0
+        if not on_stride and not (hop_type.any() if isinstance(hop_type, torch.Tensor) else hop_type):
+            return
+        # only copies here, the windows are overwritten in place by the next
+        # step, the records are assembled on the writer thread
+        self._batch.append((
+            traj, step, _copy(time), _copy(state), energies.clone(), _copy(kinetic_energy), _copy(hop_type),
+            _copy(hop_p), on_stride
+        ))
+        self._nbatch += 1 if isinstance(traj, int) else len(traj)
+        if self._nbatch >= self._batch_size:
+            self._submit(block=False)
+
+    def flush(self) -> None:
+        """
+        Hands the collected records to the writer and waits until every
+        queued batch is written.
+
+        """
+        self._submit(block=True)
+        self._queue.join()
+        self._raise()
+
+    def close(self) -> None:
+        """
+        Writes the remaining records and stops the writer thread.
+
+        """
+        if self._closed:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._closed = True
+        self._raise()
+
+    def stats(self) -> LoggerStats:
+        with self._lock:
+            return LoggerStats(
+                records=self._records,
+                dropped=self._dropped,
+                batches=self._batches,
+                max_pending=self._max_pending,
+                write_time=self._write_time
+            )
+
+    def _submit(self, block: bool) -> None:
+        if not self._batch:
+            return
+        batch, nrecords = self._batch, self._nbatch
+        self._batch, self._nbatch = [], 0
+        try:
+            if block:
+                self._queue.put(batch)
+            else:
+                self._queue.put(batch, timeout=self._max_wait)
+        except queue.Full:
+            with self._lock:
+                self._dropped += nrecords
+            return
+        with self._lock:
+            self._max_pending = max(self._max_pending, self._queue.qsize())
+
+    def _raise(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self) -> None:
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    for f in self._files.values():
+                        f.close()
+                    self._files = {}
+                    return
+                t = time.perf_counter()
+                nrecords = self._write(batch)
+                with self._lock:
+                    self._records += nrecords
+                    self._batches += 1
+                    self._write_time += time.perf_counter() - t
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, batch: List[tuple]) -> int:
+        """
+        Writes a batch of records to the files of their trajectories on the
+        writer thread.
+
+        """
+        scalars = {k: [] for k in ['traj', 'step', 'time', 'state', 'kinetic_energy', 'hop_type', 'keep']}
+        energies, hop_p = [], []
+        for traj, step, t, state, e, ke, hop_type, p, keep in batch:
+            ntraj = 1 if isinstance(traj, int) else len(traj)
+            for k, v in zip(scalars, [traj, step, t, state, ke, hop_type, keep]):
+                if isinstance(v, torch.Tensor):
+                    v = v.reshape(-1).tolist()
+                elif not isinstance(v, (list, tuple, range)):
+                    v = [v]
+                scalars[k].extend(v if len(v) == ntraj else v * ntraj)
+            energies.append(e.reshape(ntraj, -1))
+            hop_p.append(p.reshape(ntraj, -1) if p is not None else torch.zeros_like(energies[-1]))
+        cols = {k: np.asarray(v) for k, v in scalars.items()}
+        cols['energies'] = torch.cat(energies).double().numpy()
+        cols['hop_p'] = torch.cat(hop_p).double().numpy()
+        # hops are always logged, every other step on the stride only
+        keep = cols.pop('keep') | (cols['hop_type'] != 0)
+        cols = {k: v[keep] for k, v in cols.items()}
+        if self._dtype is None:
+            self._dtype = _record_dtype(self._verbosity, cols['energies'].shape[-1])
+            self._write_meta()
+
+        rows = np.zeros(len(cols['traj']), dtype=self._dtype)
+        for name in self._dtype.names:
+            if name == 'energy':
+                rows[name] = np.take_along_axis(cols['energies'], cols['state'][:, None], axis=1)[:, 0]
+            else:
+                rows[name] = cols[name]
+        # records stay in step order within every trajectory
+        for traj in np.unique(cols['traj']).tolist():
+            self._write_rows(traj, rows[cols['traj'] == traj])
+
+        return len(rows)
+
+    def _write_rows(self, traj: int, rows: np.ndarray) -> None:
+        f = self._files.get(traj)
+        if f is None:
+            mode = 'a' if self._fmt == 'JSONL' else 'ab'
+            f = self._files[traj] = open(os.path.join(self._path, f'{traj}.{_EXTENSIONS[self._fmt]}'), mode)
+        if self._fmt == 'BINARY':
+            f.write(rows.tobytes())
+        else:
+            lines = []
+            for row in rows.tolist():
+                record = dict(zip(self._dtype.names, row))
+                record['hop_type'] = HOP_TYPES[record['hop_type']]
+                for k in ['energies', 'hop_p']:
+                    if k in record:
+                        record[k] = list(record[k])
+                lines.append(json.dumps(record, separators=(',', ':')))
+            f.write('\n'.join(lines) + '\n')
+        f.flush()
+
+    def _write_meta(self) -> None:
+        meta = {
+            'format': self._fmt,
+            'verbosity': self._verbosity,
+            'stride': self._stride,
+            'nstates': self._dtype['energies'].shape[0] if 'energies' in self._dtype.names else None,
+            'fields': list(self._dtype.names),
+            'dtype': self._dtype.descr
+        }
+        # every worker of a run writes the same meta, renamed into place
+        tmp = os.path.join(self._path, f'meta.json.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self._path, 'meta.json'))
+
+
+def read_log(path: str, traj: int) -> Dict[str, torch.Tensor]:
+    """
+    Reads the log of a trajectory.
+
+    Args:
+        path (str): Directory of the logs.
+        traj (int): Index of the trajectory.
+
+    Returns:
+        (Dict[str, torch.Tensor]): One tensor per field of the verbosity of
+            the log, with a leading size of the number of records. Hop types
+            are indices into HOP_TYPES.
+
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    file = os.path.join(path, f'{traj}.{_EXTENSIONS[meta["format"]]}')
+    dtype = np.dtype([tuple(d) for d in meta['dtype']])
+    if meta['format'] == 'BINARY':
+        rows = np.fromfile(file, dtype=dtype)
+    else:
+        with open(file) as f:
+            records = [json.loads(line) for line in f]
+        rows = np.zeros(len(records), dtype=dtype)
+        for name in dtype.names:
+            values = [r[name] for r in records]
+            rows[name] = [HOP_TYPES.index(v) for v in values] if name == 'hop_type' else values
+
+    return {name: torch.from_numpy(np.ascontiguousarray(rows[name])) for name in dtype.names}
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import computer, constants
+    from solvent_dynamics.trajectory import EnsemblePropagator, TrajectoryPropagator
+
+    ntests = 5
+    ntests_passed = 0
+
+    _NSTATES = 3
+    _NSTEPS = 50
+
+    torch.manual_seed(0)
+    hop_types = torch.zeros(_NSTEPS, dtype=torch.long)
+    hop_types[[7, 20, 21]] = torch.tensor([1, 2, 1])
+    energies = torch.rand(_NSTEPS, _NSTATES, dtype=torch.float64)
+    hop_p = torch.rand(_NSTEPS, _NSTATES, dtype=torch.float64)
+    kinetic_energy = torch.rand(_NSTEPS, dtype=torch.float64)
+
+    def _log(logger: TrajectoryLogger, traj: int) -> None:
+        for i in range(_NSTEPS):
+            logger.log(traj, i, 0.5 * i, i % _NSTATES, energies[i], kinetic_energy[i], hop_types[i], hop_p[i])
+
+    # both formats read back the same records, hops are logged off the stride
+    for fmt in LOG_FORMATS:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logger = TrajectoryLogger(tmp_dir, fmt=fmt, verbosity='FULL', stride=5, batch_size=4)
+            _log(logger, 0)
+            _log(logger, 3)
+            logger.close()
+            for traj in [0, 3]:
+                log = read_log(tmp_dir, traj)
+                steps = sorted(set(range(0, _NSTEPS, 5)) | {7, 20, 21})
+                assert log['step'].tolist() == steps
+                assert torch.equal(log['energies'], energies[steps]) and torch.equal(log['hop_p'], hop_p[steps])
+                assert torch.equal(log['hop_type'].long(), hop_types[steps])
+                assert torch.equal(log['time'], 0.5 * torch.tensor(steps, dtype=torch.float64))
+            assert logger.stats().records == 2 * len(steps) and logger.stats().dropped == 0
+    ntests_passed += 1
+
+    # lower verbosities keep fewer fields and records
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = TrajectoryLogger(tmp_dir, fmt='BINARY', verbosity='HOPS')
+        _log(logger, 0)
+        logger.close()
+        log = read_log(tmp_dir, 0)
+        assert log['step'].tolist() == [7, 20, 21] and 'energies' not in log
+        assert torch.equal(log['energy'], energies[[7, 20, 21], [7 % 3, 20 % 3, 21 % 3]])
+    ntests_passed += 1
+
+    # a writer that falls behind drops batches instead of holding up the
+    # propagating thread for longer than max_wait
+    class _SlowLogger(TrajectoryLogger):
+        def _write(self, batch: List[tuple]) -> int:
+            time.sleep(0.05)
+            return super()._write(batch)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = _SlowLogger(tmp_dir, batch_size=1, max_pending=2, max_wait=0.001)
+        t = time.perf_counter()
+        _log(logger, 0)
+        elapsed = time.perf_counter() - t
+        logger.close()
+        stats = logger.stats()
+        assert elapsed < 0.05 * _NSTEPS / 4
+        assert stats.dropped > 0 and stats.records + stats.dropped == _NSTEPS and stats.max_pending <= 2
+        assert len(read_log(tmp_dir, 0)['step']) == stats.records
+    ntests_passed += 1
+
+    # propagators log every step of every trajectory
+    class _ToyModel(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, _NSTATES)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = torch.tanh(self._lin(structure.pos))
+            if structure.batch is None:
+                return e.sum(dim=0)
+            return e.new_zeros(structure.num_graphs, _NSTATES).index_add(0, structure.batch, e)
+
+    _NATOMS = 10
+    _NTRAJ = 4
+    model = _ToyModel()
+    topology = computer.SystemTopology.build(torch.rand(_NATOMS) + 1.0, torch.ones(_NATOMS, 1), {'C': torch.tensor([1.])})
+    coords = torch.rand(_NTRAJ, _NATOMS, 3)
+    velo = 0.01 * torch.rand(_NTRAJ, _NATOMS, 3)
+    zeros = torch.zeros(_NTRAJ, _NSTATES, _NSTATES)
+    e_init, f_init = computer.ml_energies_forces(
+        model, None, Data(pos=coords[0].clone()), constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger = TrajectoryLogger(tmp_dir, verbosity='FULL', stride=2)
+        traj = TrajectoryPropagator(
+            model, None, 0, topology, coords[0].clone(), velo[0].clone(), f_init, e_init,
+            zeros[0].clone(), zeros[0].clone(), zeros[0].clone(), delta_t=0.5, store_idx=7, logger=logger
+        )
+        ensemble = EnsemblePropagator(
+            model, None, 0, topology, coords.clone(), velo.clone(), f_init.expand(_NTRAJ, -1, -1, -1).clone(),
+            e_init.expand(_NTRAJ, -1).clone(), zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.5,
+            store_idx=0, logger=logger
+        )
+        # the last logged step is the current one
+        for _ in range(9):
+            traj.propagate()
+            ensemble.propagate()
+        logger.close()
+        log = read_log(tmp_dir, 7)
+        assert log['step'].tolist() == [0, 2, 4, 6, 8]
+        assert torch.allclose(log['energies'][-1], traj._energies.cur.double())
+        assert log['kinetic_energy'][-1].item() == traj._kinetic_energy.item()
+        for b in range(_NTRAJ):
+            log = read_log(tmp_dir, b)
+            assert log['step'].tolist() == [0, 2, 4, 6, 8]
+            assert torch.allclose(log['time'], torch.tensor([0.0, 1.0, 2.0, 3.0, 4.0], dtype=torch.float64))
+    ntests_passed += 1
+
+    # the logged kinetic energy follows the velocities rescaled by a hop, so
+    # that the total energy of a hop step is that of the state it left, and
+    # the Verlet steps that follow keep that same total energy
+    from solvent_dynamics.computer._surface_hopping import _hop_select
+
+    surface_hopping = computer.surface_hopping
+    before_hop: List[torch.Tensor] = []
+
+    def _downward_hop(**kwargs: Any) -> computer.SurfaceHoppingMetrics:
+        # hops to the lower neighboring state whenever there is one
+        energies = kwargs['energies']
+        state = torch.as_tensor(kwargs['state']).expand(energies.shape[:-1])
+        e_state = energies.gather(-1, state.unsqueeze(-1)).squeeze(-1)
+        neighbor = (torch.arange(_NSTATES) - state.unsqueeze(-1)).abs() == 1
+        target = energies.masked_fill(~neighbor, float('inf')).argmin(dim=-1)
+        target = torch.where(energies.gather(-1, target.unsqueeze(-1)).squeeze(-1) < e_state, target, state)
+        nacs = kwargs['velo'].unsqueeze(-3).expand(*energies.shape, *kwargs['velo'].shape[-2:])
+        p = torch.nn.functional.one_hot(target, _NSTATES).to(energies.dtype)
+        before_hop.append(kwargs['ke'] + e_state)
+        return _hop_select(
+            state, kwargs['topology'], kwargs['velo'], energies, p, nacs,
+            torch.full(energies.shape[:-1], 0.5), kwargs['max_hop'], False
+        )
+
+    state = int(e_init.argmax())
+    computer.surface_hopping = _downward_hop
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logger = TrajectoryLogger(tmp_dir, verbosity='FULL')
+            traj = TrajectoryPropagator(
+                model, None, state, topology, coords[0].clone(), velo[0].clone(), f_init, e_init,
+                zeros[0].clone(), zeros[0].clone(), zeros[0].clone(), delta_t=0.05, store_idx=0,
+                precision='MIXED', logger=logger
+            )
+            ensemble = EnsemblePropagator(
+                model, None, state, topology, coords.clone(), velo.clone(), f_init.expand(_NTRAJ, -1, -1, -1).clone(),
+                e_init.expand(_NTRAJ, -1).clone(), zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.05,
+                store_idx=1, precision='MIXED', logger=logger
+            )
+            for _ in range(_NSTEPS):
+                traj.propagate()
+                ensemble.propagate()
+            logger.close()
+            # traj 0 and the ensemble hop in turns, one row per step
+            totals = torch.cat([torch.stack(before_hop[0::2]).unsqueeze(-1), torch.stack(before_hop[1::2])], dim=-1)
+            for b in range(_NTRAJ + 1):
+                log = read_log(tmp_dir, b)
+                hops = log['hop_type'] == 1
+                assert hops.any()
+                e_state = log['energies'].gather(-1, log['state'].long().unsqueeze(-1)).squeeze(-1)
+                total = log['kinetic_energy'] + e_state
+                assert torch.allclose(total[hops], totals[hops, b].double(), atol=1e-5)
+                # the ensemble starts from the energies of coords[0], the
+                # first step to compare with is the first Verlet step
+                assert (total[1:] - total[1]).abs().max() < 1e-3
+    finally:
+        computer.surface_hopping = surface_hopping
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+
+    # benchmark: step cost of a logged trajectory, writes included
+    _NREPEATS = 500
+    print('')
+    print('{:<8}  {:>16}  {:>16}'.format('format', 'step (ms)', 'written / s'))
+    for fmt in [None, *LOG_FORMATS]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logger = TrajectoryLogger(tmp_dir, fmt=fmt, verbosity='FULL') if fmt is not None else None
+            traj = TrajectoryPropagator(
+                model, None, 0, topology, coords[0].clone(), velo[0].clone(), f_init, e_init,
+                zeros[0].clone(), zeros[0].clone(), zeros[0].clone(), delta_t=0.5, logger=logger
+            )
+            t = time.perf_counter()
+            for _ in range(_NREPEATS):
+                traj.propagate()
+            if logger is not None:
+                logger.close()
+            elapsed = (time.perf_counter() - t) / _NREPEATS
+            stats = logger.stats() if logger is not None else None
+            print('{:<8}  {:>16.3f}  {:>16}'.format(
+                fmt or 'off', elapsed * 1e3, f'{stats.records / stats.write_time:.0f}' if stats else '-'
+            ))
@@ -13,9 +13,15 @@ STATUS: DEV
 
 import torch
 
-from trajectory import TrajectoryPropagator
+from solvent_dynamics import computer
+from solvent_dynamics.trajectory import (
+    EnsembleRunner,
+    InitialConditions,
+    TrajectoryResult,
+    TrajectoryStore
+)
 
-from typing import Optional
+from typing import Dict, Optional
 
 
 _TITLE = 'solvated-cyp'
@@ -32,9 +38,19 @@ class NAMD():
             self,
             model: torch.nn.Module,
             res_model: Optional[torch.nn.Module],
+            topology: computer.SystemTopology,
+            init: InitialConditions,
             ntraj: int,
             prop_duration: float,
-            delta_t: float
+            delta_t: float,
+            nworkers: int=0,
+            nthreads: int=1,
+            store: Optional[TrajectoryStore]=None,
+            seed: int=_GL_SEED,
+            checkpoint_dir: Optional[str]=None,
+            checkpoint_every: int=100,
+            batch_size: int=1,
+            **propagator_kwargs
         ) -> None:
         """
         Manages all trajectory propagations.
@@ -44,25 +60,85 @@ class NAMD():
                 model.
             res_model (torch.nn.Module): A trained and loaded residual
                 block placed on top of the outputs of the standard model.
+            topology (SystemTopology): Topology of the molecular system.
+            init (InitialConditions): Initial conditions of every trajectory.
             ntraj (int): The number of trajectories to propagate.
-            prop_duration (float): The max duration of a trajectory.
-            delta_t (float): The duration between steps in a trajectory.
+            prop_duration (float): The simulated time budget of a trajectory
+                in atomic units of time, au. Trajectories propagate until
+                their time reaches it, however many steps that takes.
+            delta_t (float): The duration between steps in a trajectory, the
+                first step with an adaptive ``time_step`` policy.
+            nworkers (int): The number of worker processes, 0 propagates
+                every trajectory in the calling process.
+            nthreads (int): The torch intra-op thread budget of every worker.
+            store (TrajectoryStore | None): An optional on-disk store that
+                every trajectory is streamed into, with room for max_steps
+                steps per trajectory.
+            seed (int): Seed of the ensemble.
+            checkpoint_dir (str | None): An optional directory to checkpoint
+                every trajectory into, required to resume a run.
+            checkpoint_every (int): The number of steps between two
+                checkpoints of a trajectory.
+            batch_size (int): The max number of trajectories propagated
+                together by one EnsemblePropagator, see EnsembleRunner.
+            **propagator_kwargs: Further arguments of TrajectoryPropagator.
             
         """
         self._model = model
         self._res_model = res_model
+        self._topology = topology
+        self._init = init
         self._ntraj = ntraj
         self._prop_duration = prop_duration
         self._delta_t = delta_t
-        self._nsteps = int(prop_duration / delta_t)
-
-        self._model = ...
-        self._res_model = ...
-
-    def run(self) -> None:
-        for i in range(self._ntraj):
-            traj = ...
-            for step in range(self._nsteps):
-                traj.propagate() # type: ignore
-                if not traj.status(): # type: ignore
-                    break
+        self._store = store
+        self._results: Dict[int, TrajectoryResult] = {}
+
+        self._runner = EnsembleRunner(
+            model=model,
+            res_model=res_model,
+            topology=topology,
+            delta_t=delta_t,
+            nworkers=nworkers,
+            nthreads=nthreads,
+            seed=seed,
+            checkpoint_dir=checkpoint_dir,
+            checkpoint_every=checkpoint_every,
+            batch_size=batch_size,
+            **propagator_kwargs
+        )
+
+    def max_steps(self) -> int:
+        """
+        Bounds the number of steps of a trajectory within the time budget,
+        the number of steps per trajectory to size the store with.
+
+        """
+        return self._runner.max_steps(duration=self._prop_duration)
+
+    def run(self, resume: bool=False) -> Dict[int, TrajectoryResult]:
+        """
+        Propagates every trajectory.
+
+        Args:
+            resume (bool): Resume an interrupted run from the latest
+                checkpoints, trajectories that already finished are not
+                propagated again. Pass the store of the interrupted run,
+                opened with TrajectoryStore.open.
+
+        Returns:
+            (dict(int, TrajectoryResult)): The result of every trajectory.
+
+        """
+        for result in self._runner.run(
+                init=self._init,
+                duration=self._prop_duration,
+                trajs=list(range(self._ntraj)),
+                store=self._store,
+                resume=resume
+            ):
+            self._results[result.traj] = result
+        if self._store is not None:
+            self._store.close()
+
+        return self._results
@@ -1,3 +1,9 @@
 from ._snapshot import Snapshot
+from ._initial_conditions import InitialConditions, wigner_initial_conditions
 from ._trajectory_history import TrajectoryHistory
+from ._trajectory_store import TrajectoryStore, TrajectoryStoreReader
+from ._xyz_writer import XYZWriter
+from ._checkpointer import Checkpointer
 from ._trajectory_propagator import TrajectoryPropagator
+from ._ensemble_propagator import EnsemblePropagator
+from ._ensemble_runner import EnsembleRunner, TrajectoryResult
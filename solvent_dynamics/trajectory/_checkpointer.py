@@ -0,0 +1,275 @@
+"""
+STATUS: DEV
+
+Periodic checkpoints of trajectory propagation. A checkpoint directory holds
+one ``<traj>.ckpt`` file with the latest propagator state of every running
+trajectory and one ``<traj>.done`` file with the result of every finished
+trajectory. The history of a running trajectory is saved incrementally, every
+checkpoint appends a ``<traj>.<n>.hist`` segment with the snapshots added since
+the previous one, so that checkpoints do not grow along the trajectory.
+
+States are copied on the propagating thread and serialized on a background
+thread, every file is written next to its target and renamed into place so
+that a preempted run never leaves a partial checkpoint behind.
+
+"""
+
+import glob
+import os
+import torch
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from solvent_dynamics.trajectory import TrajectoryHistory
+
+from typing import Any, Dict, List, Optional
+
+
+class Checkpointer:
+    """
+    Writes and reads per-trajectory checkpoints asynchronously.
+
+    """
+    def __init__(self, path: str, interval: int=100) -> None:
+        """
+        Opens a checkpoint directory.
+
+        Args:
+            path (str): Directory of the checkpoints, created if missing.
+            interval (int): The number of steps between two checkpoints of a
+                trajectory.
+
+        Returns:
+            None
+
+        """
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._interval = interval
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: List[Future] = []
+        # per trajectory, the number of history segments and the iteration
+        # of the last saved snapshot
+        self._segments: Dict[int, int] = {}
+        self._saved: Dict[int, int] = {}
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def interval(self) -> int:
+        return self._interval
+
+    def due(self, iteration: int) -> bool:
+        return iteration > 0 and iteration % self._interval == 0
+
+    def save(
+        self,
+        traj: int,
+        state_dict: Dict[str, Any],
+        history: Optional[TrajectoryHistory]=None
+    ) -> None:
+        """
+        Queues the latest state of a trajectory to be written, the state
+        must not be modified afterwards.
+
+        Args:
+            traj (int): Index of the trajectory.
+            state_dict (dict): A propagator state.
+            history (TrajectoryHistory | None): The history of the trajectory,
+                only the snapshots added since the last save are written.
+
+        Returns:
+            None
+
+        """
+        self._check_pending()
+        nsegments = self._segments.get(traj, 0)
+        if history is not None:
+            segment = history.state_dict(since=self._saved.get(traj))
+            if segment['iterations'].numel() > 0:
+                # queued before the state, which only then refers to it
+                self._pending.append(self._executor.submit(self._write, self._file(traj, f'{nsegments}.hist'), segment))
+                nsegments += 1
+                self._segments[traj] = nsegments
+                self._saved[traj] = int(segment['iterations'][-1])
+        state_dict = {**state_dict, 'history_segments': nsegments}
+        self._pending.append(self._executor.submit(self._write, self._file(traj, 'ckpt'), state_dict))
+
+    def load(self, traj: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns the latest state of a trajectory, None if it has none. The
+        history segments saved along with it are joined under 'history', the
+        next saves of the trajectory append to them.
+
+        """
+        state_dict = self._read(self._file(traj, 'ckpt'))
+        if state_dict is None:
+            return None
+        nsegments = state_dict.pop('history_segments', 0)
+        self._segments[traj] = nsegments
+        self._saved.pop(traj, None)
+        if nsegments > 0:
+            segments = [self._read(self._file(traj, f'{i}.hist')) for i in range(nsegments)]
+            state_dict['history'] = {
+                name: torch.cat([segment[name] for segment in segments]) for name in segments[0] # type: ignore
+            }
+            self._saved[traj] = int(state_dict['history']['iterations'][-1])
+        return state_dict
+
+    def save_result(self, traj: int, result: Dict[str, Any]) -> None:
+        """
+        Marks a trajectory as finished, replacing its latest state with its
+        result. Blocks until the result is on disk.
+
+        Args:
+            traj (int): Index of the trajectory.
+            result (dict): The result of the trajectory.
+
+        Returns:
+            None
+
+        """
+        self.wait()
+        self._write(self._file(traj, 'done'), result)
+        if os.path.exists(self._file(traj, 'ckpt')):
+            os.remove(self._file(traj, 'ckpt'))
+        self._remove_history(traj)
+
+    def load_result(self, traj: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns the result of a finished trajectory, None if it is not done.
+
+        """
+        return self._read(self._file(traj, 'done'))
+
+    def clear(self, traj: int) -> None:
+        """
+        Removes every checkpoint of a trajectory, to start it over.
+
+        """
+        self.wait()
+        for ext in ['ckpt', 'done']:
+            if os.path.exists(self._file(traj, ext)):
+                os.remove(self._file(traj, ext))
+        self._remove_history(traj)
+
+    def wait(self) -> None:
+        """
+        Blocks until every queued state is on disk.
+
+        """
+        for f in self._pending:
+            f.result()
+        self._pending.clear()
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
+
+    def _check_pending(self) -> None:
+        # surfaces write errors on the next save instead of losing them
+        done = [f for f in self._pending if f.done()]
+        for f in done:
+            f.result()
+        self._pending = [f for f in self._pending if not f.done()]
+
+    def _file(self, traj: int, ext: str) -> str:
+        return os.path.join(self._path, f'{traj}.{ext}')
+
+    def _remove_history(self, traj: int) -> None:
+        for file in glob.glob(self._file(traj, '*.hist')):
+            os.remove(file)
+        self._segments.pop(traj, None)
+        self._saved.pop(traj, None)
+
+    @staticmethod
+    def _write(file: str, obj: Dict[str, Any]) -> None:
+        tmp = f'{file}.tmp'
+        torch.save(obj, tmp)
+        os.replace(tmp, file)
+
+    @staticmethod
+    def _read(file: str) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(file):
+            return None
+        return torch.load(file, weights_only=True)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import computer
+    from solvent_dynamics.trajectory import TrajectoryPropagator, TrajectoryStore
+
+    ntests = 1
+    ntests_passed = 0
+
+    _NATOMS = 8
+    _NSTATES = 3
+    _NSTEPS = 30
+
+    class _ToyModel(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, _NSTATES)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            return torch.tanh(self._lin(structure.pos)).sum(dim=0)
+
+    class _Propagator(TrajectoryPropagator):
+        # surface hopping only draws its random number
+        def _surface_hopping(self) -> None:
+            torch.rand(1, generator=self._rng)
+
+    torch.manual_seed(0)
+    model = _ToyModel()
+    topology = computer.SystemTopology.build(torch.rand(_NATOMS) + 1.0, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    coords = torch.rand(_NATOMS, 3)
+    ef = computer.ml_energies_forces(model, None, Data(pos=coords.clone()), 0.0, 1.0)
+
+    def _propagator(store=None) -> _Propagator:
+        zeros = torch.zeros(_NSTATES, _NSTATES)
+        return _Propagator(
+            model, None, 0, topology, coords.clone(), torch.rand(_NATOMS, 3, generator=torch.Generator().manual_seed(1)),
+            ef.forces.clone(), ef.energies.clone(), zeros, zeros, zeros, 0.05, store=store, store_idx=0, seed=3
+        )
+
+    reference = _propagator()
+    for _ in range(_NSTEPS):
+        reference.propagate()
+
+    # preempted at step 25, resumed from the checkpoint of step 20
+    with tempfile.TemporaryDirectory() as tmp:
+        store = TrajectoryStore(os.path.join(tmp, 'store'), 1, _NSTEPS, _NATOMS, _NSTATES, chunk_size=8)
+        checkpointer = Checkpointer(os.path.join(tmp, 'ckpt'), interval=10)
+        preempted = _propagator(store)
+        for _ in range(25):
+            preempted.propagate()
+            if checkpointer.due(preempted.iteration):
+                store.flush(0)
+                checkpointer.save(0, preempted.state_dict(), preempted.history())
+        store.flush(0)
+        checkpointer.close()
+        # every checkpoint only holds the snapshots since the previous one
+        assert 'history' not in torch.load(os.path.join(tmp, 'ckpt', '0.ckpt'), weights_only=True)
+        segments = [torch.load(os.path.join(tmp, 'ckpt', f'0.{i}.hist'), weights_only=True) for i in range(2)]
+        assert [int(segment['iterations'].numel()) for segment in segments] == [10, 10]
+
+        store = TrajectoryStore.open(os.path.join(tmp, 'store'))
+        resumed = _propagator(store)
+        resumed.load_state_dict(Checkpointer(os.path.join(tmp, 'ckpt')).load(0)) # type: ignore
+        assert resumed.iteration == 20
+        while resumed.iteration < _NSTEPS:
+            resumed.propagate()
+        store.close()
+
+        assert torch.equal(resumed._coords.cur, reference._coords.cur)
+        assert torch.equal(resumed._rng.get_state(), reference._rng.get_state())
+        assert all(torch.equal(a, b) for a, b in zip(resumed.history().all_info(), reference.history().all_info()))
+        assert int(store._lengths[0]) == _NSTEPS
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
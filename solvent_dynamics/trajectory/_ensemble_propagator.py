@@ -0,0 +1,798 @@
+"""
+STATUS: DEV
+
+Propagates B trajectories of the same molecular system in lock step. Every
+per-trajectory quantity carries a leading batch dimension so that a step costs
+one batched model evaluation instead of B single-structure evaluations.
+
+"""
+
+import time
+import torch
+from torch_geometric.data import Batch
+from torch_geometric.data.data import Data
+
+from solvent_dynamics import computer, constants
+from solvent_dynamics.logger import TrajectoryLogger
+from solvent_dynamics.trajectory import TrajectoryHistory, TrajectoryStore
+from solvent_dynamics.trajectory._model_input import ModelInput
+from solvent_dynamics.trajectory._ring_window import RingWindow
+from solvent_dynamics.trajectory._trajectory_propagator import _new_traj_idx
+
+from typing import List, Optional, Union
+
+
+class EnsemblePropagator:
+    def __init__(
+            self,
+            model: torch.nn.Module,
+            res_model: Optional[torch.nn.Module],
+            state: Union[int, torch.Tensor],
+            topology: computer.SystemTopology,
+            init_coords: torch.Tensor,
+            init_velo: torch.Tensor,
+            init_forces: torch.Tensor,
+            init_energies: torch.Tensor,
+            init_a: torch.Tensor,
+            init_h: torch.Tensor,
+            init_d: torch.Tensor,
+            delta_t: float,
+            state_mult: Optional[torch.Tensor]=None,
+            soc: Optional[torch.Tensor]=None,
+            max_hop: int=1,
+            force_mode: str='SINGLE_PASS',
+            force_gap_window: Optional[float]=None,
+            neighbor_skin: Optional[float]=None,
+            neighbor_cutoff: float=constants.NEIGHBOR_RADIUS,
+            store: Optional[TrajectoryStore]=None,
+            store_idx: Optional[int]=None,
+            history_length: Optional[int]=None,
+            seed: Optional[int]=None,
+            step_mode: str='EAGER',
+            compile_cache_dir: Optional[str]=None,
+            precision: Optional[Union[str, computer.PrecisionPolicy]]=None,
+            termination: Optional[computer.TerminationCriteria]=None,
+            logger: Optional[TrajectoryLogger]=None
+        ) -> None:
+        """
+        Initializes an ensemble of B trajectories of the same molecular system.
+
+        Args:
+            model (torch.nn.Module): A trained and loaded neural network
+                model that returns energies of size (B, K) for a batch of B
+                structures.
+            res_model (torch.nn.Module): A trained and loaded residual
+                block placed on top of the outputs of the standard model.
+            state (int | torch.Tensor): The electronic state populated by
+                every trajectory, or a tensor of size (B) with one state per
+                trajectory.
+            topology (SystemTopology): Topology of the molecular system,
+                shared with every other trajectory of the same system.
+            init_coords (torch.Tensor): Starting coordinates of size (B, N, 3).
+            init_velo (torch.Tensor): Starting velocities of size (B, N, 3).
+            init_forces (torch.Tensor): Starting forces of size (B, K, N, 3).
+            init_energies (torch.Tensor): Starting energies of size (B, K).
+            init_a (torch.Tensor): Starting state-density matrices, batched
+                along the first dimension.
+            init_h (torch.Tensor): Starting energy matrices, batched along
+                the first dimension.
+            init_d (torch.Tensor): Starting non-adiabatic matrices, batched
+                along the first dimension.
+            delta_t (float): The change in time from the previous snapshot
+                to this snapshot in atomic units of time, au.
+            state_mult (torch.Tensor | None): Spin multiplicity of size (K)
+                for every electronic state, all equal if not given.
+            soc (torch.Tensor | None): Spin-orbit couplings of size (K, K)
+                between every two states, in the units of the energies. No
+                intersystem crossing if not given.
+            max_hop (int): The max number of states a single hop may cross.
+            force_mode (str): one of "SINGLE_PASS" | "PER_STATE", how forces
+                of the K states are differentiated.
+            force_gap_window (float | None): If given, forces are only computed
+                for the populated state and states within this energy gap of
+                it, the rest are NaN. It has to cover the hopping gap
+                thresholds with a margin, see computer.check_gap_window.
+            neighbor_skin (float | None): If given, the edges within
+                ``neighbor_cutoff`` are kept in a neighbor list with this skin
+                and handed to the model as ``edge_index``, see NeighborList.
+                Otherwise the model builds its own graph every step.
+            neighbor_cutoff (float): The radius of the model input graph.
+            store (TrajectoryStore | None): An optional on-disk store that
+                every snapshot is streamed into.
+            store_idx (int | None): Index of the first trajectory of the
+                ensemble in ``store``, the rest follow contiguously, required
+                with a store. Otherwise defaults to ids unique among the
+                trajectories of the process.
+            history_length (int | None): An optional max length of the
+                in-memory history, to bound memory when streaming to a store.
+            seed (int | None): Seed of the surface hopping random numbers,
+                nondeterministic if not given.
+            step_mode (str): one of "EAGER" | "COMPILED", whether the step
+                arithmetic runs op by op or as graphs compiled by
+                torch.compile, with a fallback to eager mode.
+            compile_cache_dir (str | None): An optional directory to cache
+                the compiled step kernels in across runs.
+            precision (str | PrecisionPolicy | None): An optional precision
+                policy, or one of "FP64" | "FP32" | "MIXED", see
+                PrecisionPolicy. The starting conditions and masses are cast
+                to its integration type and the model input to its model
+                type, the model parameters have to be of the model type
+                already. The types of the starting conditions if not given.
+            termination (TerminationCriteria | None): Optional criteria that
+                stop trajectories early, checked by status every
+                ``termination.every`` steps for the whole ensemble at once.
+                Bonds are those of the starting coordinates of every
+                trajectory.
+            logger (TrajectoryLogger | None): An optional logger that every
+                step of every running trajectory is logged to, under the
+                indices of ``store``.
+
+        Returns:
+            None
+
+        """
+        self._model = model
+        self._res_model = res_model
+        self._precision = computer.precision_policy(precision) if precision is not None else None
+        if self._precision is not None:
+            topology = self._precision.cast_topology(topology)
+            init_coords, init_velo, init_forces, init_energies, init_a, init_h, init_d, soc = [
+                self._precision.cast(t)
+                for t in [init_coords, init_velo, init_forces, init_energies, init_a, init_h, init_d, soc]
+            ]
+
+        self._iter = 0
+        self._time = 0.0
+        self._ntraj = init_coords.size(dim=0)
+        self._trajs = [
+            TrajectoryHistory(history_length, topology=topology) for _ in range(self._ntraj)
+        ]
+        self._topology = topology
+        self._nstates = init_energies.size(dim=-1)
+        self._state_mult = state_mult if state_mult is not None else torch.ones(self._nstates)
+        self._soc = soc
+        self._max_hop = max_hop
+        self._force_mode = force_mode
+        if force_gap_window is not None:
+            computer.check_gap_window(force_gap_window)
+        self._force_gap_window = force_gap_window
+        self._neighbors = (
+            computer.NeighborList(neighbor_cutoff, neighbor_skin) if neighbor_skin is not None else None
+        )
+        self._model_dtype = self._precision.model if self._precision is not None else None
+        self._model_input = ModelInput(topology, self._ntraj, dtype=self._model_dtype)
+        self._step_mode = step_mode
+        self._compile_cache_dir = compile_cache_dir
+        if store_idx is None:
+            if store is not None:
+                raise ValueError('a store requires the store index of the first trajectory')
+            store_idx = _new_traj_idx(self._ntraj)
+        self._store = store
+        self._store_idx = store_idx
+        if isinstance(state, int):
+            state = torch.full((self._ntraj,), state, dtype=torch.long)
+        self._cur_state = state.clone()
+        self._prev_state = state.clone()
+
+        # nuclear window
+        self._coords = RingWindow(init_coords)
+        self._velo = RingWindow(init_velo)
+        self._forces = RingWindow(init_forces)
+        self._energies = RingWindow(init_energies)
+
+        # electronic window
+        self._a = RingWindow(init_a)
+        self._h = RingWindow(init_h)
+        self._d = RingWindow(init_d)
+        self._hop_type = torch.zeros(self._ntraj, dtype=torch.long)
+        self._hop_p = torch.zeros_like(init_energies)
+
+        self._kinetic_energy = torch.zeros(self._ntraj)
+
+        self._delta_t = delta_t
+
+        self._termination = termination
+        self._bonds = None
+        if termination is not None and termination.max_bond_length is not None:
+            self._bonds = computer.find_bonds(init_coords, termination.bond_cutoff)
+        self._e_total_ref: Optional[torch.Tensor] = None
+        self._ground_time = torch.zeros(self._ntraj, dtype=torch.float64)
+        self._reason = torch.zeros(self._ntraj, dtype=torch.long)
+        # indices of the running trajectories once any has terminated, the
+        # model, Verlet steps and surface hopping only see these rows
+        self._running: Optional[torch.Tensor] = None
+        self._logger = logger
+
+        self._rng = torch.Generator()
+        if seed is not None:
+            self._rng.manual_seed(seed)
+        else:
+            self._rng.seed()
+
+    @property
+    def ntraj(self) -> int:
+        return self._ntraj
+
+    @property
+    def iteration(self) -> int:
+        return self._iter
+
+    @property
+    def time(self) -> float:
+        """
+        The simulated time in atomic units of time, au.
+
+        """
+        return self._time
+
+    def history(self, traj: int) -> TrajectoryHistory:
+        """
+        Returns the running history of a single trajectory.
+
+        Args:
+            traj (int): Index of the trajectory within the ensemble.
+
+        Returns:
+            (TrajectoryHistory)
+
+        """
+        return self._trajs[traj]
+
+    def neighbor_list_stats(self) -> Optional[computer.NeighborListStats]:
+        """
+        Returns the rebuild statistics of the neighbor list shared by the
+        ensemble, None without one.
+
+        """
+        return self._neighbors.stats() if self._neighbors is not None else None
+
+    def propagate(self) -> None:
+        """
+        Propagates every trajectory in the ensemble by one step.
+
+        """
+        start = time.perf_counter()
+        with computer.step_mode(self._step_mode, self._compile_cache_dir):
+            with computer.profile_phase('save_snapshot'):
+                self._save_snapshot()
+            with computer.profile_phase('shift'):
+                self._shift(mode='NUCLEAR')
+            with computer.profile_phase('nuclear'):
+                self._nuclear()
+            with computer.profile_phase('shift'):
+                self._shift(mode='ELECTRONIC')
+            with computer.profile_phase('surface_hopping'):
+                self._surface_hopping()
+        if self._e_total_ref is None:
+            self._e_total_ref = computer.total_energy(
+                self._topology, self._cur_state, self._velo.cur, self._energies.cur
+            )
+        # the first step only sets up the windows
+        elapsed = self._delta_t if self._iter > 0 else 0.0
+        self._time += elapsed
+        self._ground_time = torch.where(self._cur_state == 0, self._ground_time + elapsed, 0.0)
+        if self._logger is not None:
+            with computer.profile_phase('log'):
+                self.log()
+        self._iter += 1
+        # the filter only runs with an active profiler
+        running = (self._store_idx + b for b in range(self._ntraj) if not self._reason[b])
+        computer.profile_steps(running, elapsed, start)
+
+    def _nuclear(self) -> None:
+        """
+        Propagates the nuclei of every trajectory by one step with a single
+        batched model evaluation.
+
+        """
+        # FIXME: check if needed, mirrors TrajectoryPropagator
+        if self._iter == 0:
+            self._kinetic_energy = computer.kinetic_energy(
+                topology=self._topology,
+                velo=self._velo.cur
+            )
+            return
+
+        if self._running is not None:
+            self._nuclear_running()
+            return
+
+        # the window was just shifted, step from prev into the cur slots
+        step = computer.velocity_verlet(
+            state=self._cur_state,
+            coords=self._coords.prev,
+            topology=self._topology,
+            velo=self._velo.prev,
+            forces=self._forces.prev,
+            delta_t=self._delta_t,
+            energies_forces=self._energies_forces,
+            out_coords=self._coords.cur,
+            out_velo=self._velo.cur
+        )
+        self._energies.cur.copy_(step.energies)
+        self._forces.cur.copy_(step.forces)
+        self._kinetic_energy = step.ke
+
+    def _nuclear_running(self) -> None:
+        """
+        Propagates the nuclei of the running trajectories only, terminated
+        trajectories stay at their last step.
+
+        """
+        for window in [self._coords, self._velo, self._forces, self._energies]:
+            window.cur.copy_(window.prev)
+        idx = self._running
+        if idx.numel() == 0:
+            return
+        step = computer.velocity_verlet(
+            state=self._cur_state[idx],
+            coords=self._coords.prev[idx],
+            topology=self._topology,
+            velo=self._velo.prev[idx],
+            forces=self._forces.prev[idx],
+            delta_t=self._delta_t,
+            energies_forces=self._energies_forces
+        )
+        self._coords.cur[idx] = step.coords
+        self._velo.cur[idx] = step.velo
+        self._energies.cur[idx] = step.energies
+        self._forces.cur[idx] = step.forces
+        self._kinetic_energy = self._kinetic_energy.index_put((idx,), step.ke.to(self._kinetic_energy.dtype))
+
+    def _energies_forces(self, coords: torch.Tensor) -> computer.EnergiesForces:
+        return computer.ml_energies_forces(
+            model=self._model,
+            res_model=self._res_model,
+            structure=self._gen_data_structure(coords),
+            u_energy_evs=constants.U_ENERGY_EVS,
+            rms_force_evs=constants.RMS_FORCE_EVS,
+            force_mode=self._force_mode,
+            state=self._rows(self._cur_state),
+            gap_window=self._force_gap_window,
+            out_dtype=self._precision.integration if self._precision is not None else None
+        )
+
+    def _surface_hopping(self) -> None:
+        """
+        Hops every running trajectory of the ensemble in one batched call.
+
+        """
+        if self._running is not None:
+            # terminated trajectories keep their last electronic window
+            for window in [self._a, self._h, self._d]:
+                window.cur.copy_(window.prev)
+            self._hop_type = torch.zeros_like(self._hop_type)
+            self._hop_p = torch.zeros_like(self._hop_p)
+            if self._running.numel() == 0:
+                return
+        rows = self._rows
+        a, h, d, v, hop_type, state, hop_p = computer.surface_hopping(
+            state=rows(self._cur_state),
+            state_mult=self._state_mult,
+            topology=self._topology,
+            coord=rows(self._coords.cur),
+            coord_prev=rows(self._coords.prev),
+            coord_prev_prev=rows(self._coords.prev_prev),
+            velo=rows(self._velo.cur),
+            energies=rows(self._energies.cur),
+            energies_prev=rows(self._energies.prev),
+            energies_prev_prev=rows(self._energies.prev_prev),
+            forces=rows(self._forces.cur),
+            forces_prev=rows(self._forces.prev),
+            forces_prev_prev=rows(self._forces.prev_prev),
+            ke=rows(self._kinetic_energy),
+            ic_e_thresh=constants.INTERNAL_CONVERSION_ENERGY_GAP,
+            isc_e_thresh=constants.INTERSYSTEM_CROSSING_ENERGY_GAP,
+            max_hop=self._max_hop,
+            soc=self._soc,
+            generator=self._rng
+        )
+        # velocities of hopped trajectories were rescaled to pay for the energy gap
+        ke = computer.kinetic_energy(self._topology, v).to(self._kinetic_energy.dtype)
+        if self._running is None:
+            self._a.cur.copy_(a)
+            self._h.cur.copy_(h)
+            self._d.cur.copy_(d)
+            self._velo.cur.copy_(v)
+            self._hop_type = hop_type
+            self._hop_p = hop_p
+            self._cur_state = state
+            self._kinetic_energy = ke
+            return
+        idx = self._running
+        self._a.cur[idx] = a
+        self._h.cur[idx] = h
+        self._d.cur[idx] = d
+        self._velo.cur[idx] = v
+        self._hop_type[idx] = hop_type
+        self._hop_p[idx] = hop_p.to(self._hop_p.dtype)
+        self._cur_state = self._cur_state.index_put((idx,), state)
+        self._kinetic_energy = self._kinetic_energy.index_put((idx,), ke)
+
+    def _rows(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Selects the rows of the running trajectories, every row while all run.
+
+        """
+        return tensor if self._running is None else tensor[self._running]
+
+    def _compact(self) -> None:
+        """
+        Restricts the model evaluations, Verlet steps and surface hopping to
+        the running trajectories, after a check terminated any of them.
+
+        """
+        running = (self._reason == 0).nonzero().flatten()
+        if self._running is not None and running.numel() == self._running.numel():
+            return
+        self._running = running
+        if running.numel() > 0:
+            self._model_input = ModelInput(self._topology, running.numel(), dtype=self._model_dtype)
+
+    def hop_types(self) -> List[str]:
+        """
+        Returns the hop type of the last step of every trajectory, one of
+        "NO HOP" | "HOP" | "FRUSTRATED".
+
+        """
+        return [computer.HOP_TYPES[i] for i in self._hop_type.tolist()]
+
+    def log(self) -> None:
+        """
+        Logs the last step of every running trajectory, called by propagate
+        with a logger. The records are written in the background.
+
+        """
+        running = (self._reason == 0).nonzero().flatten()
+        if running.numel() == 0:
+            return
+        self._logger.log(
+            traj=(running + self._store_idx).tolist(),
+            step=self._iter,
+            time=self._iter * self._delta_t,
+            state=self._cur_state[running],
+            energies=self._energies.cur[running],
+            kinetic_energy=self._kinetic_energy[running],
+            hop_type=self._hop_type[running],
+            hop_p=self._hop_p[running]
+        )
+
+    def status(self) -> torch.Tensor:
+        """
+        Determines which trajectories should be propagated further. The
+        termination criteria are checked every ``termination.every`` steps,
+        a terminated trajectory stays terminated and its history ends.
+
+        Args:
+            None
+
+        Returns:
+            running (torch.Tensor): A boolean tensor of size (B).
+
+        """
+        if self._termination is not None and self._iter % self._termination.every == 0:
+            assert self._e_total_ref is not None
+            with computer.profile_phase('termination'):
+                reason = computer.termination_reasons(
+                    criteria=self._termination,
+                    topology=self._topology,
+                    state=self._cur_state,
+                    coords=self._coords.cur,
+                    velo=self._velo.cur,
+                    velo_prev=self._velo.prev,
+                    energies=self._energies.cur,
+                    forces=self._forces.cur,
+                    e_total_ref=self._e_total_ref,
+                    ground_time=self._ground_time,
+                    bonds=self._bonds
+                )
+            self._reason = torch.where(self._reason == 0, reason, self._reason)
+            if bool(self._reason.any()):
+                self._compact()
+
+        return self._reason == 0
+
+    def termination_reasons(self) -> List[str]:
+        """
+        Returns the termination reason of every trajectory, one of
+        TERMINATION_REASONS, "NONE" while a trajectory runs.
+
+        """
+        return [computer.TERMINATION_REASONS[i] for i in self._reason.tolist()]
+
+    def _gen_data_structure(self, coords: Optional[torch.Tensor]=None) -> Batch:
+        """
+        Generates a batch of B structures for ml inference. The batch is
+        built once and its positions are updated in place every step, it is
+        rebuilt with the running trajectories only whenever any terminates.
+
+        Args:
+            coords (torch.Tensor | None): Coordinates of size (B, N, 3) to place
+                in the batch, the current coordinates of the running
+                trajectories if not given.
+
+        Returns:
+            structure (Batch): A batch of structures with the same keys as
+                TrajectoryPropagator._gen_data_structure.
+
+        """
+        if coords is None:
+            coords = self._rows(self._coords.cur)
+        with computer.profile_phase('model_input'):
+            # one neighbor list for the whole batch, in the node numbering of the batch
+            edge_index = self._neighbors.update(coords) if self._neighbors is not None else None
+            return self._model_input.update(coords, edge_index)
+
+    def _save_snapshot(self) -> None:
+        """
+        Saves the current molecular system data of every trajectory to its
+        running history.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        reasons = self._reason.tolist()
+        for b in range(self._ntraj):
+            if reasons[b]:
+                continue
+            state = int(self._cur_state[b])
+            self._trajs[b].add(
+                iteration=self._iter,
+                state=state,
+                coords=self._coords.cur[b],
+                energy=self._energies.cur[b, state],
+                forces=self._forces.cur[b, state]
+            )
+            if self._store is not None:
+                self._store.add(
+                    traj=self._store_idx + b,
+                    iteration=self._iter,
+                    state=state,
+                    coords=self._coords.cur[b],
+                    velo=self._velo.cur[b],
+                    energies=self._energies.cur[b],
+                    forces=self._forces.cur[b]
+                )
+
+    def _shift(self, mode: str) -> None:
+        """
+        Shifts prev -> prev-prev, cur -> prev
+
+        Args:
+            mode (str): one of "NUCLEAR" | "ELECTRONIC"
+
+        Returns:
+            None
+
+        """
+        if mode == 'NUCLEAR':
+            # the first step does not overwrite the cur slots
+            carry = self._iter == 0
+            self._coords.rotate(carry)
+            self._velo.rotate(carry)
+            self._forces.rotate(carry)
+            self._energies.rotate(carry)
+        else:
+            self._a.rotate()
+            self._h.rotate()
+            self._d.rotate()
+            self._prev_state = self._cur_state.clone()
+
+
+if __name__ == '__main__':
+    import tempfile
+    import warnings
+
+    from solvent_dynamics.computer._neighbor_list import _radius_pairs
+    from solvent_dynamics.trajectory import TrajectoryPropagator
+
+    class _ToyModel(torch.nn.Module):
+        def __init__(self, nstates: int) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, nstates)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = torch.tanh(self._lin(structure.pos))
+            if structure.batch is None:
+                return e.sum(dim=0)
+            return torch.zeros(structure.num_graphs, e.size(dim=-1)).index_add(0, structure.batch, e)
+
+    class _PairModel(torch.nn.Module):
+        # reads the edges of the structure, searches them itself otherwise
+        def __init__(self, nstates: int) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(1, nstates)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            edge_index = structure.edge_index
+            if edge_index is None:
+                edge_index = _radius_pairs(structure.pos.view(structure.num_graphs, -1, 3), constants.NEIGHBOR_RADIUS)
+            src, dst = edge_index
+            d = (structure.pos[src] - structure.pos[dst]).pow(2).sum(dim=-1, keepdim=True).sqrt()
+            e = torch.tanh(self._lin(d)) * (1.0 - d / constants.NEIGHBOR_RADIUS).pow(2)
+            return torch.zeros(structure.num_graphs, e.size(dim=-1)).index_add(0, structure.batch[src], e)
+
+    ntests = 5
+    ntests_passed = 0
+
+    _NTRAJ = 4
+    _NATOMS = 51
+    _NSTATES = 3
+    _NSTEPS = 5
+
+    torch.manual_seed(0)
+    model = _ToyModel(_NSTATES)
+    mass = torch.rand(_NATOMS) + 1.0
+    atom_types = torch.eye(3)[torch.randint(3, (_NATOMS,))]
+    key = {'H': torch.tensor([1., 0., 0.]), 'C': torch.tensor([0., 1., 0.]), 'O': torch.tensor([0., 0., 1.])}
+    topology = computer.SystemTopology.build(mass, atom_types, key)
+    coords = torch.rand(_NTRAJ, _NATOMS, 3)
+    velo = torch.rand(_NTRAJ, _NATOMS, 3) * 0.01
+    energies, forces = computer.ml_energies_forces(
+        model=model,
+        res_model=None,
+        structure=Batch.from_data_list([Data(x=atom_types, pos=coords[b].clone(), z=mass) for b in range(_NTRAJ)]),
+        u_energy_evs=constants.U_ENERGY_EVS,
+        rms_force_evs=constants.RMS_FORCE_EVS
+    )
+    energies, forces = energies.detach(), forces.detach()
+    state = torch.tensor([0, 1, 2, 1])
+    zeros = torch.zeros(_NTRAJ, _NSTATES, _NSTATES)
+
+    ensemble = EnsemblePropagator(
+        model, None, state, topology, coords.clone(), velo.clone(),
+        forces.clone(), energies.clone(), zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.05
+    )
+    trajs = [
+        TrajectoryPropagator(
+            model, None, int(state[b]), topology, coords[b].clone(), velo[b].clone(),
+            forces[b].clone(), energies[b].clone(), zeros[b].clone(), zeros[b].clone(), zeros[b].clone(), delta_t=0.05
+        ) for b in range(_NTRAJ)
+    ]
+
+    for _ in range(_NSTEPS):
+        ensemble.propagate()
+        for traj in trajs:
+            traj.propagate()
+
+    for b, traj in enumerate(trajs):
+        assert torch.allclose(ensemble._coords.cur[b], traj._coords.cur, atol=1e-5)
+        assert torch.allclose(ensemble._coords.prev_prev[b], traj._coords.prev_prev, atol=1e-5)
+        assert torch.allclose(ensemble._velo.cur[b], traj._velo.cur, atol=1e-5)
+        assert torch.allclose(ensemble._forces.cur[b], traj._forces.cur, atol=1e-5)
+        assert torch.allclose(ensemble._kinetic_energy[b], traj._kinetic_energy, atol=1e-4)
+        assert int(ensemble._cur_state[b]) == traj._cur_state
+        assert ensemble.hop_types()[b] == traj._hoped
+        assert torch.equal(ensemble.history(b).all_info().states, traj.history().all_info().states)
+    ntests_passed += 1
+
+    # the compiled step mode follows the eager ensemble
+    with tempfile.TemporaryDirectory() as cache_dir, warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        compiled = EnsemblePropagator(
+            model, None, state, topology, coords.clone(), velo.clone(), forces.clone(), energies.clone(),
+            zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.05, step_mode='COMPILED',
+            compile_cache_dir=cache_dir
+        )
+        for _ in range(_NSTEPS):
+            compiled.propagate()
+    assert torch.allclose(compiled._coords.cur, ensemble._coords.cur, atol=1e-5)
+    assert torch.allclose(compiled._velo.cur, ensemble._velo.cur, atol=1e-5)
+    assert torch.equal(compiled._cur_state, ensemble._cur_state)
+    ntests_passed += 1
+
+    # a neighbor list hands the model the same edges it would search itself
+    pair_model = _PairModel(_NSTATES)
+    pair_coords = torch.rand(_NTRAJ, _NATOMS, 3) * 8.0
+    pair_velo = 0.2 * torch.randn(_NTRAJ, _NATOMS, 3)
+    energies, forces = computer.ml_energies_forces(
+        model=pair_model,
+        res_model=None,
+        structure=Batch.from_data_list([Data(x=atom_types, pos=pair_coords[b].clone(), z=mass) for b in range(_NTRAJ)]),
+        u_energy_evs=constants.U_ENERGY_EVS,
+        rms_force_evs=constants.RMS_FORCE_EVS
+    )
+    pair_ensembles = [
+        EnsemblePropagator(
+            pair_model, None, state, topology, pair_coords.clone(), pair_velo.clone(), forces.clone(),
+            energies.clone(), zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.05, neighbor_skin=skin
+        ) for skin in [None, 0.5]
+    ]
+    for _ in range(4 * _NSTEPS):
+        for pair_ensemble in pair_ensembles:
+            pair_ensemble.propagate()
+    searched, listed = pair_ensembles
+    assert torch.allclose(listed._coords.cur, searched._coords.cur, atol=1e-5)
+    assert torch.allclose(listed._forces.cur, searched._forces.cur, atol=1e-5)
+    stats = listed.neighbor_list_stats()
+    assert searched.neighbor_list_stats() is None
+    assert stats is not None and stats.updates == 4 * _NSTEPS - 1 and 0 < stats.rebuilds < stats.updates
+    ntests_passed += 1
+
+    # termination is checked every other step, in batch and per trajectory
+    termination = computer.TerminationCriteria(every=2, ground_state_duration=2.5 * 0.05)
+    energies, forces = computer.ml_energies_forces(
+        model=model,
+        res_model=None,
+        structure=Batch.from_data_list([Data(x=atom_types, pos=coords[b].clone(), z=mass) for b in range(_NTRAJ)]),
+        u_energy_evs=constants.U_ENERGY_EVS,
+        rms_force_evs=constants.RMS_FORCE_EVS
+    )
+    ensemble = EnsemblePropagator(
+        model, None, state, topology, coords.clone(), velo.clone(), forces.clone(), energies.clone(),
+        zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.05, termination=termination
+    )
+    trajs = [
+        TrajectoryPropagator(
+            model, None, int(state[b]), topology, coords[b].clone(), velo[b].clone(), forces[b].clone(),
+            energies[b].clone(), zeros[b].clone(), zeros[b].clone(), zeros[b].clone(), delta_t=0.05,
+            termination=termination
+        ) for b in range(_NTRAJ)
+    ]
+    running = [True] * _NTRAJ
+    for i in range(_NSTEPS):
+        ensemble.propagate()
+        ensemble_running = ensemble.status().tolist()
+        for b, traj in enumerate(trajs):
+            if running[b]:
+                traj.propagate()
+                running[b] = traj.status()
+        assert ensemble_running == running
+        # the ground state time passes the limit after 4 steps, the first one
+        # does not move, and is caught at the check of that step
+        assert running[0] == (i + 1 < 4)
+    assert ensemble.termination_reasons() == [traj.termination_reason for traj in trajs]
+    assert ensemble.termination_reasons()[0] == 'GROUND_STATE' and trajs[0].iteration == 4
+    assert len(ensemble.history(0)) == trajs[0].iteration == 4 and len(ensemble.history(1)) == _NSTEPS
+    nan_coords = ensemble._coords.cur.clone()
+    nan_coords[1, 0, 0] = float('nan')
+    ensemble._coords.cur.copy_(nan_coords)
+    ensemble._iter += 1
+    assert ensemble.termination_reasons()[1] == 'NONE' and not ensemble.status()[1]
+    assert ensemble.termination_reasons()[1] == 'NONFINITE'
+    ntests_passed += 1
+
+    # terminated trajectories cost no model evaluations, the others carry on
+    # as in a full batch
+    class _CountingModel(torch.nn.Module):
+        def __init__(self, model: torch.nn.Module) -> None:
+            super().__init__()
+            self._model = model
+            self.nstructures = []
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            self.nstructures.append(structure.num_graphs)
+            return self._model(structure)
+
+    counting_model = _CountingModel(model)
+    nonfinite = computer.TerminationCriteria(every=1)
+    ensembles = [
+        EnsemblePropagator(
+            m, None, state, topology, coords.clone(), velo.clone(), forces.clone(), energies.clone(),
+            zeros.clone(), zeros.clone(), zeros.clone(), delta_t=0.05, termination=nonfinite, seed=0
+        ) for m in [counting_model, model]
+    ]
+    blown_up, reference = ensembles
+    for i in range(2 * _NSTEPS):
+        if i == 2:
+            blown_up._coords.cur[2, 3, 1] = float('nan')
+        for e in ensembles:
+            e.propagate()
+            e.status()
+    assert blown_up.termination_reasons() == ['NONE', 'NONE', 'NONFINITE', 'NONE']
+    # the first step evaluates nothing, the NaN is caught at the check of step 2
+    assert counting_model.nstructures == [_NTRAJ] * 2 + [_NTRAJ - 1] * (2 * _NSTEPS - 3)
+    frozen = blown_up._coords.cur[2]
+    assert torch.equal(frozen.isnan(), blown_up._coords.prev[2].isnan()) and len(blown_up.history(2)) == 3
+    running = torch.tensor([0, 1, 3])
+    assert torch.allclose(blown_up._coords.cur[running], reference._coords.cur[running], atol=1e-5)
+    assert torch.allclose(blown_up._forces.cur[running], reference._forces.cur[running], atol=1e-5)
+    assert torch.equal(blown_up._cur_state[running], reference._cur_state[running])
+    assert blown_up._kinetic_energy[running].isfinite().all()
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
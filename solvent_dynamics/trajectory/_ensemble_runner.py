@@ -0,0 +1,680 @@
+"""
+STATUS: DEV
+
+Spreads the trajectories of an ensemble across worker processes.
+
+The model, the residual model, the topology and the initial conditions are
+moved to shared memory once and handed to every worker when it starts, so
+tasks only carry trajectory indices. Workers pull batches of consecutive
+trajectories from a queue until it is empty, which balances trajectories that
+terminate early, and propagate every batch with one EnsemblePropagator, one
+batched model evaluation per step.
+
+A spawned worker imports torch and this package anew before its first step,
+several seconds per worker, so a run of a few short trajectories is faster
+inline. At most one worker per batch is started, a larger batch size spreads
+that cost over more trajectories.
+
+With a checkpoint directory, every trajectory is checkpointed periodically
+and a resumed run continues every trajectory from its latest checkpoint and
+skips the finished ones.
+
+"""
+
+import math
+import queue
+import torch
+import traceback
+import torch.multiprocessing as mp
+
+from solvent_dynamics import computer
+from solvent_dynamics.trajectory import (
+    EnsemblePropagator,
+    InitialConditions,
+    TrajectoryPropagator,
+    TrajectoryStore
+)
+from solvent_dynamics.trajectory._checkpointer import Checkpointer
+from solvent_dynamics.trajectory._trajectory_history import AllInfo
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+
+# seconds between two checks of the workers while waiting for a result
+_POLL_INTERVAL = 1.0
+
+# arguments of TrajectoryPropagator that EnsemblePropagator does not take, a
+# batch is propagated one trajectory at a time with any of them
+_TRAJECTORY_ONLY_KWARGS = ('broker', 'time_step')
+
+
+class TrajectoryResult(NamedTuple):
+    """
+    traj: index of the trajectory
+    nsteps: the number of steps propagated
+    info: the history of the trajectory
+    reason: one of TERMINATION_REASONS, "NONE" if the trajectory ran for
+        the max number of steps or the max duration
+    time: the simulated time in atomic units of time, au
+
+    """
+    traj: int
+    nsteps: int
+    info: AllInfo
+    reason: str = 'NONE'
+    time: float = 0.0
+
+
+def _result_to_dict(result: TrajectoryResult) -> Dict[str, Any]:
+    return {
+        'traj': result.traj,
+        'nsteps': result.nsteps,
+        'info': result.info._asdict(),
+        'reason': result.reason,
+        'time': result.time
+    }
+
+
+def _result_from_dict(result: Dict[str, Any]) -> TrajectoryResult:
+    return TrajectoryResult(
+        result['traj'], result['nsteps'], AllInfo(**result['info']), result['reason'], result['time']
+    )
+
+
+class _WorkerError(NamedTuple):
+    trajs: List[int]
+    trace: str
+
+
+def _batches(trajs: List[int], batch_size: int) -> List[List[int]]:
+    """
+    Splits trajectory indices into batches of up to ``batch_size``
+    consecutive indices, the rows of a store written by one ensemble.
+
+    """
+    batches: List[List[int]] = []
+    for traj in trajs:
+        if batches and len(batches[-1]) < batch_size and batches[-1][-1] + 1 == traj:
+            batches[-1].append(traj)
+        else:
+            batches.append([traj])
+
+    return batches
+
+
+def _propagate_trajectory(
+        traj: int,
+        model: torch.nn.Module,
+        res_model: Optional[torch.nn.Module],
+        topology: computer.SystemTopology,
+        init: InitialConditions,
+        nsteps: Optional[int],
+        duration: Optional[float],
+        delta_t: float,
+        store: Optional[TrajectoryStore],
+        checkpointer: Optional[Checkpointer],
+        seed: int,
+        propagator_kwargs: Dict[str, Any]
+    ) -> TrajectoryResult:
+    nstates = init.energies.size(dim=-1)
+    zeros = torch.zeros(nstates, nstates)
+    propagator = TrajectoryPropagator(
+        model=model,
+        res_model=res_model,
+        state=int(init.state[traj]),
+        topology=topology,
+        init_coords=init.coords[traj].clone(),
+        init_velo=init.velo[traj].clone(),
+        init_forces=init.forces[traj].clone(),
+        init_energies=init.energies[traj].clone(),
+        init_a=zeros.clone(),
+        init_h=zeros.clone(),
+        init_d=zeros.clone(),
+        delta_t=delta_t,
+        store=store,
+        store_idx=traj,
+        seed=seed + traj,
+        **propagator_kwargs
+    )
+    if checkpointer is not None:
+        state_dict = checkpointer.load(traj)
+        if state_dict is not None:
+            propagator.load_state_dict(state_dict)
+
+    while (
+            (nsteps is None or propagator.iteration < nsteps)
+            and (duration is None or propagator.time < duration)
+        ):
+        propagator.propagate()
+        if not propagator.status():
+            break
+        if checkpointer is not None and checkpointer.due(propagator.iteration):
+            # the checkpoint must not be ahead of the store
+            if store is not None:
+                store.flush(traj)
+            checkpointer.save(traj, propagator.state_dict(), propagator.history())
+    if store is not None:
+        store.flush(traj)
+
+    info = AllInfo(*[t.clone() for t in propagator.history().all_info()])
+    result = TrajectoryResult(traj, propagator.iteration, info, propagator.termination_reason, propagator.time)
+    if checkpointer is not None:
+        checkpointer.save_result(traj, _result_to_dict(result))
+
+    return result
+
+
+def _propagate_ensemble(
+        batch: List[int],
+        model: torch.nn.Module,
+        res_model: Optional[torch.nn.Module],
+        topology: computer.SystemTopology,
+        init: InitialConditions,
+        nsteps: Optional[int],
+        duration: Optional[float],
+        delta_t: float,
+        store: Optional[TrajectoryStore],
+        seed: int,
+        propagator_kwargs: Dict[str, Any]
+    ) -> Iterator[TrajectoryResult]:
+    rows = torch.tensor(batch)
+    nstates = init.energies.size(dim=-1)
+    zeros = torch.zeros(len(batch), nstates, nstates)
+    propagator = EnsemblePropagator(
+        model=model,
+        res_model=res_model,
+        state=init.state[rows],
+        topology=topology,
+        init_coords=init.coords[rows],
+        init_velo=init.velo[rows],
+        init_forces=init.forces[rows],
+        init_energies=init.energies[rows],
+        init_a=zeros.clone(),
+        init_h=zeros.clone(),
+        init_d=zeros.clone(),
+        delta_t=delta_t,
+        store=store,
+        store_idx=batch[0],
+        seed=seed + batch[0],
+        **propagator_kwargs
+    )
+
+    pending = list(range(len(batch)))
+    while pending:
+        if (
+                (nsteps is not None and propagator.iteration >= nsteps)
+                or (duration is not None and propagator.time >= duration)
+            ):
+            finished = pending
+        else:
+            propagator.propagate()
+            running = propagator.status().tolist()
+            finished = [b for b in pending if not running[b]]
+        reasons = propagator.termination_reasons()
+        for b in finished:
+            if store is not None:
+                store.flush(batch[b])
+            info = AllInfo(*[t.clone() for t in propagator.history(b).all_info()])
+            yield TrajectoryResult(batch[b], propagator.iteration, info, reasons[b], propagator.time)
+        pending = [b for b in pending if b not in finished]
+
+
+def _propagate_batch(
+        batch: List[int],
+        model: torch.nn.Module,
+        res_model: Optional[torch.nn.Module],
+        topology: computer.SystemTopology,
+        init: InitialConditions,
+        nsteps: Optional[int],
+        duration: Optional[float],
+        delta_t: float,
+        store: Optional[TrajectoryStore],
+        checkpointer: Optional[Checkpointer],
+        seed: int,
+        propagator_kwargs: Dict[str, Any]
+    ) -> Iterator[TrajectoryResult]:
+    """
+    Propagates a batch of trajectories with one EnsemblePropagator, yielding
+    every result as soon as its trajectory finishes. Only TrajectoryPropagator
+    checkpoints and takes adaptive time steps, with either the trajectories
+    are propagated one at a time.
+
+    """
+    if (
+            len(batch) == 1
+            or checkpointer is not None
+            or any(propagator_kwargs.get(k) is not None for k in _TRAJECTORY_ONLY_KWARGS)
+        ):
+        for traj in batch:
+            yield _propagate_trajectory(
+                traj, model, res_model, topology, init, nsteps, duration, delta_t, store, checkpointer, seed,
+                propagator_kwargs
+            )
+        return
+    propagator_kwargs = {k: v for k, v in propagator_kwargs.items() if k not in _TRAJECTORY_ONLY_KWARGS}
+    yield from _propagate_ensemble(
+        batch, model, res_model, topology, init, nsteps, duration, delta_t, store, seed, propagator_kwargs
+    )
+
+
+def _collect_results(results: Any, workers: List[Any], trajs: List[int]) -> Iterator[TrajectoryResult]:
+    """
+    Yields the result of every trajectory from the result queue. Workers are
+    checked between polls, a worker that died without sending anything, e.g.
+    from a segfault or the OOM killer, raises instead of blocking forever.
+
+    """
+    pending = set(trajs)
+    while pending:
+        try:
+            result = results.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            crashed = [w for w in workers if w.exitcode not in [None, 0]]
+            if crashed or not any(w.is_alive() for w in workers):
+                exitcodes = ', '.join(str(w.exitcode) for w in crashed) or 'none'
+                raise RuntimeError(
+                    f'workers exited with trajectories {sorted(pending)} unaccounted for, '
+                    f'non-zero exit codes: {exitcodes}'
+                )
+            continue
+        if isinstance(result, _WorkerError):
+            raise RuntimeError(f'trajectories {result.trajs} failed in a worker:\n{result.trace}')
+        pending.discard(result.traj)
+        yield result
+
+
+def _worker(
+        tasks: Any,
+        results: Any,
+        collected: Any,
+        model: torch.nn.Module,
+        res_model: Optional[torch.nn.Module],
+        topology: computer.SystemTopology,
+        init: InitialConditions,
+        nsteps: Optional[int],
+        duration: Optional[float],
+        delta_t: float,
+        store_path: Optional[str],
+        checkpoint_path: Optional[str],
+        checkpoint_every: int,
+        seed: int,
+        propagator_kwargs: Dict[str, Any],
+        nthreads: int
+    ) -> None:
+    torch.set_num_threads(nthreads)
+    store = TrajectoryStore.open(store_path) if store_path is not None else None
+    checkpointer = Checkpointer(checkpoint_path, checkpoint_every) if checkpoint_path is not None else None
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            break
+        try:
+            for result in _propagate_batch(
+                    batch, model, res_model, topology, init, nsteps, duration, delta_t, store, checkpointer, seed,
+                    propagator_kwargs
+                ):
+                results.put(result)
+        except Exception:
+            results.put(_WorkerError(batch, traceback.format_exc()))
+    if store is not None:
+        store.close()
+    if checkpointer is not None:
+        checkpointer.close()
+    # result tensors are shared by file descriptor, the worker has to
+    # outlive their transfer to the parent
+    collected.wait()
+
+
+class EnsembleRunner:
+    """
+    Propagates independent trajectories in a pool of worker processes.
+
+    """
+    def __init__(
+            self,
+            model: torch.nn.Module,
+            res_model: Optional[torch.nn.Module],
+            topology: computer.SystemTopology,
+            delta_t: float,
+            nworkers: int,
+            nthreads: int=1,
+            seed: int=0,
+            checkpoint_dir: Optional[str]=None,
+            checkpoint_every: int=100,
+            batch_size: int=1,
+            **propagator_kwargs
+        ) -> None:
+        """
+        Initializes a runner.
+
+        Args:
+            model (torch.nn.Module): A trained and loaded neural network
+                model, its class must be importable by the workers.
+            res_model (torch.nn.Module): A trained and loaded residual
+                block placed on top of the outputs of the standard model.
+            topology (SystemTopology): Topology of the molecular system.
+            delta_t (float): The change in time between steps in atomic
+                units of time, au.
+            nworkers (int): The number of worker processes, 0 propagates
+                every trajectory in the calling process.
+            nthreads (int): The torch intra-op thread budget of every worker.
+            seed (int): Seed of the ensemble, trajectory i is seeded with
+                ``seed + i``, a batch with the seed of its first trajectory.
+            checkpoint_dir (str | None): An optional directory to checkpoint
+                every trajectory into, see Checkpointer.
+            checkpoint_every (int): The number of steps between two
+                checkpoints of a trajectory.
+            batch_size (int): The max number of consecutive trajectories
+                propagated together by one EnsemblePropagator. With a
+                checkpoint directory or a ``time_step`` policy, the
+                trajectories of a batch are propagated one at a time.
+            **propagator_kwargs: Further arguments of TrajectoryPropagator,
+                those shared with EnsemblePropagator for batches.
+
+        Returns:
+            None
+
+        """
+        self._model = model
+        self._res_model = res_model
+        self._topology = topology
+        self._delta_t = delta_t
+        self._nworkers = nworkers
+        self._nthreads = nthreads
+        self._seed = seed
+        self._checkpoint_dir = checkpoint_dir
+        self._checkpoint_every = checkpoint_every
+        self._batch_size = batch_size
+        self._propagator_kwargs = propagator_kwargs
+
+    def max_steps(self, nsteps: Optional[int]=None, duration: Optional[float]=None) -> int:
+        """
+        Bounds the number of steps of a trajectory, e.g. to size its store.
+        Every step after the first advances the time by at least the
+        smallest step of the ``time_step`` policy, or by ``delta_t``.
+
+        Args:
+            nsteps (int | None): The max number of steps per trajectory.
+            duration (float | None): The max simulated time per trajectory
+                in atomic units of time, au.
+
+        Returns:
+            (int)
+
+        """
+        if nsteps is None and duration is None:
+            raise ValueError('either a max number of steps or a max duration is required')
+        bounds = [nsteps] if nsteps is not None else []
+        if duration is not None:
+            time_step = self._propagator_kwargs.get('time_step')
+            min_delta_t = time_step.min_delta_t if time_step is not None else self._delta_t
+            # the first step only sets up the windows
+            bounds.append(math.ceil(duration / min_delta_t) + 1)
+
+        return min(bounds)
+
+    def run(
+            self,
+            init: InitialConditions,
+            nsteps: Optional[int]=None,
+            trajs: Optional[List[int]]=None,
+            store: Optional[TrajectoryStore]=None,
+            resume: bool=False,
+            duration: Optional[float]=None
+        ) -> Iterator[TrajectoryResult]:
+        """
+        Propagates trajectories, yielding each result as soon as its
+        trajectory finishes, in completion order.
+
+        Args:
+            init (InitialConditions): Initial conditions of every trajectory.
+            nsteps (int | None): The max number of steps per trajectory.
+            trajs (list(int) | None): Indices of the trajectories to run, all
+                if not given.
+            store (TrajectoryStore | None): An optional on-disk store, every
+                worker streams its trajectories into it, with room for
+                max_steps steps per trajectory. Open the store of the
+                interrupted run with TrajectoryStore.open to resume.
+            resume (bool): Continue every trajectory from its latest
+                checkpoint, finished trajectories are read from their
+                checkpoint instead of being propagated again. Otherwise the
+                checkpoints of ``trajs`` are cleared.
+            duration (float | None): The max simulated time per trajectory in
+                atomic units of time, au, the budget of adaptive time steps.
+                At least one of ``nsteps`` and ``duration`` is required.
+
+        Returns:
+            (Iterator[TrajectoryResult])
+
+        """
+        max_steps = self.max_steps(nsteps, duration)
+        if store is not None and store.nsteps < max_steps:
+            # checked up front, a full store fails a worker halfway through
+            raise ValueError(f'the store holds {store.nsteps} steps per trajectory, up to {max_steps} may be taken')
+        if trajs is None:
+            trajs = list(range(init.coords.size(dim=0)))
+
+        checkpointer = None
+        if self._checkpoint_dir is not None:
+            checkpointer = Checkpointer(self._checkpoint_dir, self._checkpoint_every)
+            unfinished = []
+            for traj in trajs:
+                result = checkpointer.load_result(traj) if resume else None
+                if result is not None:
+                    yield _result_from_dict(result)
+                    continue
+                if not resume:
+                    checkpointer.clear(traj)
+                unfinished.append(traj)
+            trajs = unfinished
+            if not trajs:
+                return
+
+        batches = _batches(trajs, self._batch_size)
+        if self._nworkers == 0:
+            try:
+                for batch in batches:
+                    yield from _propagate_batch(
+                        batch,
+                        self._model,
+                        self._res_model,
+                        self._topology,
+                        init,
+                        nsteps,
+                        duration,
+                        self._delta_t,
+                        store,
+                        checkpointer,
+                        self._seed,
+                        self._propagator_kwargs
+                    )
+            finally:
+                if checkpointer is not None:
+                    checkpointer.close()
+            return
+        if checkpointer is not None:
+            checkpointer.close()
+
+        # shared once here, workers then map the same storage
+        self._model.share_memory()
+        if self._res_model is not None:
+            self._res_model.share_memory()
+        init.share_memory_()
+        topology = self._topology._replace(**{
+            k: v.share_memory_() for k, v in self._topology._asdict().items() if isinstance(v, torch.Tensor)
+        })
+
+        ctx = mp.get_context('spawn')
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+        collected = ctx.Event()
+        for batch in batches:
+            tasks.put(batch)
+        nworkers = min(self._nworkers, len(batches))
+        for _ in range(nworkers):
+            tasks.put(None)
+        workers = [
+            ctx.Process(
+                target=_worker,
+                args=(
+                    tasks,
+                    results,
+                    collected,
+                    self._model,
+                    self._res_model,
+                    topology,
+                    init,
+                    nsteps,
+                    duration,
+                    self._delta_t,
+                    store.path if store is not None else None,
+                    self._checkpoint_dir,
+                    self._checkpoint_every,
+                    self._seed,
+                    self._propagator_kwargs,
+                    self._nthreads
+                ),
+                daemon=True
+            ) for _ in range(nworkers)
+        ]
+        for w in workers:
+            w.start()
+
+        finished = False
+        try:
+            yield from _collect_results(results, workers, trajs)
+            finished = True
+        finally:
+            collected.set()
+            for w in workers:
+                if not finished:
+                    w.terminate()
+                w.join()
+
+
+if __name__ == '__main__':
+    import os
+    import time
+
+    import tempfile
+
+    from torch_geometric.data.data import Data
+
+    from solvent_dynamics import constants
+    from solvent_dynamics.trajectory import TrajectoryStoreReader
+
+    ntests = 3
+    ntests_passed = 0
+
+    # a worker killed without a word raises instead of blocking the parent
+    _POLL_INTERVAL = 0.1
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    for target in [os.abort, time.sleep]:
+        workers = [ctx.Process(target=target, args=() if target is os.abort else (0.0,), daemon=True)]
+        workers[0].start()
+        try:
+            next(_collect_results(results, workers, [0, 1]))
+            assert False
+        except RuntimeError as e:
+            assert '[0, 1]' in str(e)
+            assert (workers[0].exitcode != 0) == (target is os.abort)
+        workers[0].join()
+    ntests_passed += 1
+
+    # adaptive steps fit a store sized for the duration, a smaller store is
+    # refused before anything is propagated
+    class _ToyModel(torch.nn.Module):
+        def __init__(self, nstates: int) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, nstates)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            return torch.tanh(self._lin(structure.pos)).sum(dim=0)
+
+    _NTRAJ = 2
+    _NATOMS = 8
+    _NSTATES = 2
+    _DURATION = 20.0
+
+    torch.manual_seed(0)
+    model = _ToyModel(_NSTATES).double()
+    topology = computer.SystemTopology.build(
+        torch.rand(_NATOMS, dtype=torch.float64) + 1.0, torch.ones(_NATOMS, 1), {'C': torch.tensor([1.])}
+    )
+    coords = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    velo = 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    energies, forces = zip(*[
+        computer.ml_energies_forces(model, None, Data(pos=c.clone()), constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS)
+        for c in coords
+    ])
+    init = InitialConditions(
+        torch.zeros(_NTRAJ, dtype=torch.long), coords, velo, torch.stack(forces), torch.stack(energies)
+    )
+    time_step = computer.TimeStepPolicy(min_delta_t=0.1, max_delta_t=2.0, gap_window=0.02, max_displacement=0.5)
+    runner = EnsembleRunner(model, None, topology, 0.1, nworkers=0, time_step=time_step)
+    assert runner.max_steps(duration=_DURATION) == 201 and runner.max_steps(50, _DURATION) == 50
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = TrajectoryStore(os.path.join(tmp_dir, 'small'), _NTRAJ, 20, _NATOMS, _NSTATES, chunk_size=8)
+        try:
+            next(runner.run(init, duration=_DURATION, store=store))
+            assert False
+        except ValueError:
+            pass
+        store = TrajectoryStore(
+            os.path.join(tmp_dir, 'store'), _NTRAJ, runner.max_steps(duration=_DURATION), _NATOMS, _NSTATES,
+            chunk_size=8
+        )
+        results = list(runner.run(init, duration=_DURATION, store=store))
+        store.close()
+        lengths = TrajectoryStoreReader(os.path.join(tmp_dir, 'store')).lengths()
+        assert [r.nsteps for r in results] == lengths.tolist()
+        assert all(r.time >= _DURATION for r in results)
+        # the steps grew past the smallest one
+        assert all(r.nsteps < runner.max_steps(duration=_DURATION) // 2 for r in results)
+    ntests_passed += 1
+
+    # workers stream batches into the store and return the inline results, the
+    # model is traced so that the spawned workers rebuild it from its code
+    class _BatchToyModel(_ToyModel):
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = torch.tanh(self._lin(structure.pos.view(-1, _NATOMS, 3))).sum(dim=1)
+            return e.squeeze(0)
+
+    _NTRAJ = 6
+    _NSTEPS = 20
+
+    traced = torch.fx.symbolic_trace(_BatchToyModel(_NSTATES).double())
+    coords = torch.rand(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    velo = 0.01 * torch.randn(_NTRAJ, _NATOMS, 3, dtype=torch.float64)
+    energies, forces = zip(*[
+        computer.ml_energies_forces(traced, None, Data(pos=c.clone()), constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS)
+        for c in coords
+    ])
+    init = InitialConditions(
+        torch.zeros(_NTRAJ, dtype=torch.long), coords, velo, torch.stack(forces), torch.stack(energies)
+    )
+    trajs = [0, 1, 2, 4, 5]
+    assert _batches(trajs, 2) == [[0, 1], [2], [4, 5]]
+    runs = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for nworkers in [0, 2]:
+            path = os.path.join(tmp_dir, str(nworkers))
+            store = TrajectoryStore(path, _NTRAJ, _NSTEPS, _NATOMS, _NSTATES, chunk_size=8)
+            runner = EnsembleRunner(traced, None, topology, 0.1, nworkers=nworkers, batch_size=2)
+            results = sorted(runner.run(init, nsteps=_NSTEPS, trajs=trajs, store=store), key=lambda r: r.traj)
+            store.close()
+            reader = TrajectoryStoreReader(path)
+            runs[nworkers] = (results, reader.lengths(), reader.read('coords', trajs))
+    (inline, inline_lengths, inline_coords), (parallel, lengths, stored_coords) = runs[0], runs[2]
+    assert [r.traj for r in parallel] == trajs
+    for a, b in zip(inline, parallel):
+        assert (a.nsteps, a.reason) == (b.nsteps, b.reason) == (_NSTEPS, 'NONE')
+        assert a.time == b.time
+        assert all(torch.allclose(x, y) for x, y in zip(a.info, b.info))
+    assert lengths.tolist() == inline_lengths.tolist() == [_NSTEPS, _NSTEPS, _NSTEPS, 0, _NSTEPS, _NSTEPS]
+    assert torch.allclose(stored_coords, inline_coords)
+    assert torch.allclose(stored_coords[:, -1], torch.stack([r.info.coords[-1] for r in parallel]).to(stored_coords))
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
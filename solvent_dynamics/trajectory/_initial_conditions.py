@@ -0,0 +1,253 @@
+"""
+STATUS: DEV
+
+Initial conditions of an ensemble of trajectories.
+
+Sampled initial conditions can be cached on disk, a cache entry is a
+directory named after a hash of everything the samples depend on, with one
+``.npy`` file per field that is memory-mapped on load.
+
+"""
+
+import os
+import torch
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from torch_geometric.data import Batch
+from torch_geometric.data.data import Data
+
+from solvent_dynamics import computer, constants
+
+from typing import NamedTuple, Optional
+
+
+class InitialConditions(NamedTuple):
+    """
+    Starting conditions of T trajectories of the same molecular system.
+
+    state: populated electronic state of size (T)
+    coords: coordinates of size (T, N, 3) in angstrom
+    velo: velocities of size (T, N, 3) in angstrom per atomic unit of time
+    forces: forces of every electronic state of size (T, K, N, 3)
+    energies: energies of every electronic state of size (T, K)
+
+    """
+    state: torch.Tensor
+    coords: torch.Tensor
+    velo: torch.Tensor
+    forces: torch.Tensor
+    energies: torch.Tensor
+
+    def share_memory_(self) -> 'InitialConditions':
+        """
+        Moves every tensor to shared memory so that worker processes map it
+        instead of receiving a copy.
+
+        """
+        for t in self:
+            t.share_memory_()
+        return self
+
+
+def _cache_key(
+        model: torch.nn.Module,
+        res_model: Optional[torch.nn.Module],
+        topology: computer.SystemTopology,
+        modes: computer.NormalModes,
+        ntraj: int,
+        state: int,
+        temp: float,
+        seed: int
+    ) -> str:
+    h = hashlib.sha1()
+    # entries of the samples in bohr, before the conversion, must miss
+    h.update(f'wigner:angstrom:{ntraj}:{state}:{temp!r}:{seed}'.encode())
+    tensors = [topology.mass, topology.one_hot, *modes]
+    # the cached energies and forces are only valid for the weights they came from
+    for m in [model, res_model]:
+        if m is not None:
+            tensors += list(m.state_dict().values())
+    for t in tensors:
+        h.update(t.detach().cpu().contiguous().numpy().tobytes())
+
+    return h.hexdigest()
+
+
+def _load_cached(path: str) -> InitialConditions:
+    # copy-on-write maps, pages are only read from disk when touched
+    return InitialConditions(*[
+        torch.from_numpy(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c'))
+        for name in InitialConditions._fields
+    ])
+
+
+def _save_cached(path: str, init: InitialConditions) -> None:
+    # written next to the cache entry and renamed into place, so that an
+    # interrupted run never leaves a partial entry behind
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, t in zip(InitialConditions._fields, init):
+            np.save(os.path.join(tmp, f'{name}.npy'), t.cpu().numpy())
+        os.rename(tmp, path)
+    except OSError:
+        # another process filled the entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def wigner_initial_conditions(
+        model: torch.nn.Module,
+        res_model: Optional[torch.nn.Module],
+        topology: computer.SystemTopology,
+        modes: computer.NormalModes,
+        ntraj: int,
+        state: int,
+        temp: float,
+        seed: int,
+        batch_size: int=64,
+        cache_dir: Optional[str]=None
+    ) -> InitialConditions:
+    """
+    Samples the initial conditions of T trajectories from the Wigner
+    distribution of the normal modes and evaluates the model on every sample.
+
+    Coordinates and velocities are drawn in a single batched call, the model
+    is evaluated on batches of ``batch_size`` structures. The normal modes are
+    in atomic units, the samples are converted from bohr to the angstrom of
+    the model and the propagators, time stays in atomic units.
+
+    Args:
+        model (torch.nn.Module): A trained and loaded neural network model.
+        res_model (torch.nn.Module | None): A trained and loaded residual
+            block placed on top of the outputs of the standard model.
+        topology (SystemTopology): Topology of the molecular system.
+        modes (NormalModes): Normal modes of the molecular system, in
+            atomic units.
+        ntraj (int): The number of trajectories T.
+        state (int): The initially populated electronic state.
+        temp (float): Temperature in Kelvin.
+        seed (int): Seed of the sampler.
+        batch_size (int): The number of structures per model evaluation.
+        cache_dir (str | None): If given, the initial conditions are cached
+            in this directory, keyed by the system, the normal modes, the
+            model weights, T, the state, the temperature and the seed.
+
+    Returns:
+        (InitialConditions)
+
+    """
+    path = None
+    if cache_dir is not None:
+        key = _cache_key(model, res_model, topology, modes, ntraj, state, temp, seed)
+        path = os.path.join(cache_dir, key)
+        if os.path.isdir(path):
+            return _load_cached(path)
+
+    g = torch.Generator(device=modes.freqs.device).manual_seed(seed)
+    coords, velo = computer.wigner_sample(
+        topology=topology,
+        modes=modes,
+        nsamples=ntraj,
+        temp=temp,
+        boltzmann=constants.BOLTZMANN_AU,
+        generator=g
+    )
+    coords, velo = computer.bohr_to_angstrom(coords), computer.bohr_to_angstrom(velo)
+    energies, forces = [], []
+    for start in range(0, ntraj, batch_size):
+        structure = Batch.from_data_list([
+            Data(x=topology.one_hot, pos=c, z=topology.mass) for c in coords[start:start + batch_size]
+        ])
+        ef = computer.ml_energies_forces(
+            model=model,
+            res_model=res_model,
+            structure=structure,
+            u_energy_evs=constants.U_ENERGY_EVS,
+            rms_force_evs=constants.RMS_FORCE_EVS
+        )
+        energies.append(ef.energies)
+        forces.append(ef.forces)
+
+    init = InitialConditions(
+        state=torch.full((ntraj,), state, dtype=torch.long),
+        coords=coords,
+        velo=velo,
+        forces=torch.cat(forces, dim=0),
+        energies=torch.cat(energies, dim=0)
+    )
+    if path is not None:
+        _save_cached(path, init)
+
+    return init
+
+
+if __name__ == '__main__':
+    import time
+
+    ntests = 2
+    ntests_passed = 0
+
+    _NATOMS = 12
+    _NSTATES = 3
+    _NTRAJ = 100
+
+    class _ToyModel(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, _NSTATES, dtype=torch.float64)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            e = torch.tanh(self._lin(structure.pos))
+            if structure.batch is None:
+                return e.sum(dim=0)
+            return e.new_zeros(structure.num_graphs, _NSTATES).index_add(0, structure.batch, e)
+
+    torch.manual_seed(0)
+    model = _ToyModel()
+    mass = torch.rand(_NATOMS, dtype=torch.float64) * 20000.0 + 1000.0
+    topology = computer.SystemTopology.build(mass, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+    basis, _ = torch.linalg.qr(torch.rand(_NATOMS * 3, _NATOMS * 3, dtype=torch.float64))
+    modes = computer.NormalModes(
+        eq_coords=torch.rand(_NATOMS, 3, dtype=torch.float64),
+        freqs=torch.linspace(0.001, 0.02, _NATOMS * 3 - 6, dtype=torch.float64),
+        modes=basis[:_NATOMS * 3 - 6].reshape(-1, _NATOMS, 3)
+    )
+
+    # batched model evaluation agrees with single structures
+    init = wigner_initial_conditions(model, None, topology, modes, _NTRAJ, 1, 300.0, seed=1, batch_size=16)
+    assert init.coords.size() == torch.Size([_NTRAJ, _NATOMS, 3])
+    assert init.forces.size() == torch.Size([_NTRAJ, _NSTATES, _NATOMS, 3])
+    single = computer.ml_energies_forces(
+        model, None, Data(x=topology.one_hot, pos=init.coords[37].clone(), z=mass),
+        constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS
+    )
+    assert torch.allclose(single.energies, init.energies[37]) and torch.allclose(single.forces, init.forces[37])
+    # the samples of the modes in bohr come out in angstrom
+    sample = computer.wigner_sample(
+        topology, modes, _NTRAJ, 300.0, constants.BOLTZMANN_AU, generator=torch.Generator().manual_seed(1)
+    )
+    assert torch.allclose(init.coords, sample.coords * constants.BOHR_ANGSTROM)
+    assert torch.allclose(init.velo, sample.velo * constants.BOHR_ANGSTROM)
+    ntests_passed += 1
+
+    # a rerun with the same key is read from the cache, any change misses it
+    with tempfile.TemporaryDirectory() as cache_dir:
+        t = time.perf_counter()
+        first = wigner_initial_conditions(model, None, topology, modes, _NTRAJ, 1, 300.0, 1, cache_dir=cache_dir)
+        elapsed = time.perf_counter() - t
+        t = time.perf_counter()
+        cached = wigner_initial_conditions(model, None, topology, modes, _NTRAJ, 1, 300.0, 1, cache_dir=cache_dir)
+        elapsed_cached = time.perf_counter() - t
+        assert all(torch.equal(a, b) for a, b in zip(first, cached))
+        assert all(torch.equal(a, b) for a, b in zip(init, cached))
+        wigner_initial_conditions(model, None, topology, modes, _NTRAJ, 1, 300.0, 2, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+    print(f'{_NTRAJ} initial conditions: sampled {elapsed * 1e3:.1f}ms, cached {elapsed_cached * 1e3:.1f}ms')
@@ -0,0 +1,162 @@
+"""
+STATUS: DEV
+
+"""
+
+import torch
+from torch_geometric.data import Batch
+from torch_geometric.data.data import Data
+
+from solvent_dynamics import computer
+
+from typing import Optional, Union
+
+
+class ModelInput:
+    """
+    The model input structure of a trajectory, or the batch of an ensemble,
+    built once and updated in place every step.
+
+    Positions live in a persistent autograd leaf that forces are
+    differentiated against. Coordinates are copied into it, so the autograd
+    state of the propagator windows is never touched.
+
+    """
+    def __init__(
+            self,
+            topology: computer.SystemTopology,
+            ntraj: Optional[int]=None,
+            dtype: Optional[torch.dtype]=None
+        ) -> None:
+        """
+        Initializes an input of a single structure, or of a batch of
+        ``ntraj`` structures. The structure is built on the first update,
+        with the device of the coordinates.
+
+        Args:
+            topology (SystemTopology): Topology of the molecular system.
+            ntraj (int | None): The number of structures of a batch, a single
+                structure if not given.
+            dtype (torch.dtype | None): The floating point type of the model,
+                coordinates are cast to it on copy, see PrecisionPolicy. The
+                dtype of the coordinates if not given.
+
+        Returns:
+            None
+
+        """
+        self._topology = topology
+        self._ntraj = ntraj
+        self._dtype = dtype
+        self._structure: Optional[Union[Data, Batch]] = None
+        self._keys = set()
+
+    def update(self, coords: torch.Tensor, edge_index: Optional[torch.Tensor]=None) -> Union[Data, Batch]:
+        """
+        Copies coordinates into the structure.
+
+        Args:
+            coords (torch.Tensor): Coordinates of size (N, 3), or (B, N, 3)
+                for a batch.
+            edge_index (torch.Tensor | None): Optional edges of the structure,
+                see NeighborList.
+
+        Returns:
+            structure (Data | Batch): The persistent structure, see
+                TrajectoryPropagator._gen_data_structure for its keys.
+
+        """
+        dtype = self._dtype or coords.dtype
+        if self._structure is None or self._structure.pos.dtype != dtype:
+            self._structure = self._build(coords, dtype)
+            self._keys = set(self._structure.keys())
+
+        structure = self._structure
+        # keys a model attached during the previous step are stale
+        for key in set(structure.keys()) - self._keys:
+            del structure[key]
+        with torch.no_grad():
+            structure.pos.copy_(coords.reshape(-1, 3))
+        if edge_index is not None:
+            structure.edge_index = edge_index
+
+        return structure
+
+    def _build(self, coords: torch.Tensor, dtype: torch.dtype) -> Union[Data, Batch]:
+        def data() -> Data:
+            return Data(
+                x=self._topology.one_hot.to(dtype),
+                pos=coords.new_zeros(self._topology.natoms, 3, dtype=dtype),
+                z=self._topology.mass.to(dtype)
+            )
+
+        if self._ntraj is None:
+            structure = data()
+        else:
+            structure = Batch.from_data_list([data() for _ in range(self._ntraj)])
+        structure.pos.requires_grad_(True)
+
+        return structure
+
+
+if __name__ == '__main__':
+    from solvent_dynamics import constants
+
+    ntests = 2
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NSTATES = 3
+    _NTRAJ = 4
+
+    class _ToyModel(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self._lin = torch.nn.Linear(3, _NSTATES)
+
+        def forward(self, structure: Data) -> torch.Tensor:
+            # a model that caches a derived quantity on its input
+            structure.pos_sq = structure.pos.pow(2)
+            e = torch.tanh(self._lin(structure.pos)) + structure.pos_sq.sum(dim=-1, keepdim=True)
+            if structure.batch is None:
+                return e.sum(dim=0)
+            return torch.zeros(structure.num_graphs, _NSTATES).index_add(0, structure.batch, e)
+
+    torch.manual_seed(0)
+    model = _ToyModel()
+    topology = computer.SystemTopology.build(torch.rand(_NATOMS) + 1.0, torch.ones(_NATOMS), {'C': torch.tensor(1.)})
+
+    def _fresh(coords: torch.Tensor) -> computer.EnergiesForces:
+        if coords.dim() == 2:
+            structure = Data(x=topology.one_hot, pos=coords, z=topology.mass)
+        else:
+            structure = Batch.from_data_list([Data(x=topology.one_hot, pos=c, z=topology.mass) for c in coords])
+        return computer.ml_energies_forces(model, None, structure, constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS)
+
+    # one structure serves every step, the coordinates never require grad
+    for ntraj in [None, _NTRAJ]:
+        model_input = ModelInput(topology, ntraj)
+        pos = None
+        for _ in range(3):
+            coords = torch.rand(_NATOMS, 3) if ntraj is None else torch.rand(ntraj, _NATOMS, 3)
+            structure = model_input.update(coords)
+            assert 'pos_sq' not in structure
+            pos = structure.pos if pos is None else pos
+            assert structure.pos is pos and structure.pos.is_leaf
+            ef = computer.ml_energies_forces(
+                model, None, structure, constants.U_ENERGY_EVS, constants.RMS_FORCE_EVS
+            )
+            assert not coords.requires_grad and structure.pos is pos
+            ref = _fresh(coords)
+            assert torch.allclose(ef.energies, ref.energies) and torch.allclose(ef.forces, ref.forces, atol=1e-6)
+    ntests_passed += 1
+
+    # create_graph no longer flags the coordinates of the caller
+    coords = torch.rand(_NATOMS, 3)
+    computer.ml_energies_forces(
+        model, None, Data(x=topology.one_hot, pos=coords, z=topology.mass), 0.0, 1.0, create_graph=True
+    )
+    assert not coords.requires_grad
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
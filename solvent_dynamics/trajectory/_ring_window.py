@@ -0,0 +1,78 @@
+"""
+STATUS: SYNTAX PASS
+
+"""
+
+import torch
+
+from typing import Any, Dict, Tuple
+
+
+class RingWindow:
+    """
+    A current, previous and previous-previous window over a preallocated
+    ring buffer of depth 3. Shifting the window rotates an index instead of
+    copying data.
+
+    """
+    def __init__(self, init: torch.Tensor) -> None:
+        """
+        Initializes a window whose current slot holds ``init`` and whose
+        previous slots are zero.
+
+        Args:
+            init (torch.Tensor): The initial value of the current slot.
+
+        Returns:
+            None
+
+        """
+        self._buf = init.new_zeros(3, *init.shape)
+        self._buf[0] = init
+        self._slots: Tuple[torch.Tensor, ...] = self._buf.unbind(dim=0)
+        self._head = 0
+
+    @property
+    def cur(self) -> torch.Tensor:
+        return self._slots[self._head]
+
+    @property
+    def prev(self) -> torch.Tensor:
+        return self._slots[(self._head - 1) % 3]
+
+    @property
+    def prev_prev(self) -> torch.Tensor:
+        return self._slots[(self._head - 2) % 3]
+
+    def rotate(self, carry: bool=False) -> None:
+        """
+        Shifts prev -> prev-prev, cur -> prev. The new current slot reuses
+        the storage of the old previous-previous slot.
+
+        Args:
+            carry (bool): Copy the previous values into the new current slot,
+                for steps on which the current slot is not overwritten.
+
+        Returns:
+            None
+
+        """
+        self._head = (self._head + 1) % 3
+        if carry:
+            self.cur.copy_(self.prev)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Returns a copy of the buffer and the position of the window in it.
+
+        """
+        return {'buf': self._buf.clone(), 'head': self._head}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Restores a window saved by RingWindow.state_dict, in place so that
+        views of the slots stay valid.
+
+        """
+        self._buf.copy_(state_dict['buf'])
+        self._head = state_dict['head']
@@ -10,13 +10,14 @@ class Snapshot():
         self,
         iteration: int,
         state: int,
-        one_hot: torch.Tensor,
-        one_hot_key: Dict,
+        one_hot: Optional[torch.Tensor],
+        one_hot_key: Optional[Dict],
         coords: torch.Tensor,
         energy: torch.Tensor,
         forces: torch.Tensor,
         nacs: Optional[torch.Tensor]=None,
-        socs: Optional[torch.Tensor]=None
+        socs: Optional[torch.Tensor]=None,
+        atom_types: Optional[List[str]]=None
     ) -> None:
         """
         Stores information about a molecular system at a moment in time.
@@ -32,6 +33,8 @@ class Snapshot():
                 in the molecular system.
             nacs (torch.Tensor): NOT IMPLEMENTED
             socs (torch.Tensor): NOT IMPLEMENTED
+            atom_types (list(str) | None): Already decoded atom types, the
+                one-hot tensor is decoded if not given.
         
         Returns:
             None
@@ -39,7 +42,9 @@ class Snapshot():
         """
         self._iter: int = iteration
         self._state: int = state
-        self._atom_types: List[str] = computer.one_hot_to_atom_type(one_hot, one_hot_key)
+        if atom_types is None:
+            atom_types = computer.one_hot_to_atom_type(one_hot, one_hot_key)
+        self._atom_types: List[str] = atom_types
         self._coords: List[List[float]] = coords.tolist()
         self._energy: float = energy.item()
         self._forces: List[List[float]] = forces.tolist()
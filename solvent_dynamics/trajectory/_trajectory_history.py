@@ -3,93 +3,315 @@ STATUS: DEV
 
 """
 
+import torch
 import warnings
 
+from solvent_dynamics.computer import SystemTopology
 from solvent_dynamics.trajectory import Snapshot
-from typing import List, Optional, NamedTuple
+from typing import Any, Dict, List, Optional, NamedTuple
 
 
 class SparseInfo(NamedTuple):
-    atom_types: List[List[str]]
-    coords: List[List[List[float]]]
+    atom_types: List[str]
+    coords: torch.Tensor
+
+
+class AllInfo(NamedTuple):
+    iterations: torch.Tensor
+    states: torch.Tensor
+    coords: torch.Tensor
+    energies: torch.Tensor
+    forces: torch.Tensor
+
+
+_INIT_CAPACITY = 64
 
 
 class TrajectoryHistory:
     """
-    A queue of molecular system snapshots with an optional max length.
+    A columnar queue of molecular system snapshots with an optional max length.
+    Every field is kept in one preallocated tensor with the snapshot along the
+    first dimension, snapshots are only built on request.
 
     """
     def __init__(
         self,
-        max_length: Optional[int]=None
+        max_length: Optional[int]=None,
+        topology: Optional[SystemTopology]=None
     ) -> None:
         """
         Initializes an empty history of molecular system snapshots.
 
         Args:
             max_length (int | None): An optional max length to save memory.
+            topology (SystemTopology | None): Topology of the molecular
+                system shared by every snapshot, required to build snapshots.
 
         Returns:
             None
 
         """
-        if max_length:
-            self._max_len = max_length
+        self._max_len = max_length
+        self._topology = topology
+        self._start = 0
         self._len = 0
-        self._data: List[Snapshot] = []
+        self._capacity = 0
+
+        self._iterations = torch.empty(0, dtype=torch.long)
+        self._states = torch.empty(0, dtype=torch.long)
+        self._coords = torch.empty(0)
+        self._energies = torch.empty(0)
+        self._forces = torch.empty(0)
 
-    def add(self, s: Snapshot) -> None:
+    def __len__(self) -> int:
+        return self._len
+
+    def add(
+        self,
+        iteration: int,
+        state: int,
+        coords: torch.Tensor,
+        energy: torch.Tensor,
+        forces: torch.Tensor
+    ) -> None:
         """
-        Adds a snapshot to the end of the history queue.
+        Adds a snapshot to the end of the history queue. The tensors are copied
+        into the history, amortized O(1).
 
         Args:
-            s (Snapshot): A molecular system snapshot.
+            iteration (int): Iteration number within its trajectory.
+            state (int): Electronic state of which the molecular system is
+                populating.
+            coords (torch.Tensor): Positions of atomic coordinates of size
+                (N, 3).
+            energy (torch.Tensor): The potential energy of the populated state.
+            forces (torch.Tensor): Forces of the populated state of size (N, 3).
 
         Returns:
             None
 
         """
-        self._data.append(s)
+        if self._capacity == 0:
+            self._alloc(coords, energy, forces)
+        end = self._start + self._len
+        if end == self._capacity:
+            self._compact()
+            end = self._start + self._len
+
+        self._iterations[end] = iteration
+        self._states[end] = state
+        self._coords[end].copy_(coords)
+        self._energies[end].copy_(energy)
+        self._forces[end].copy_(forces)
+
         if self._max_len and self._len >= self._max_len:
-            self._data.pop(0)
+            self._start += 1
         else:
             self._len += 1
 
     def sparse_info(self) -> SparseInfo:
         """
-        Returns atom type and coordinate data at corresponding indexes.
+        Returns the atom types and a view of the coordinates of every snapshot.
 
         Args:
             None
 
         Returns:
-            atom_types (list(list(float))),
-            coords (list(list(list(float)))): Of shape (N, K, 3) where N is the
-                number of snapshots, K is the number of atoms per system, and 3
-                for x, y, and z
+            atom_types (list(str)): Atom types shared by every snapshot.
+            coords (torch.Tensor): Of shape (T, N, 3) where T is the number of
+                snapshots, N is the number of atoms per system, and 3 for x, y,
+                and z
 
         """
         if self._max_len:
             warnings.warn(f'max length of {self._max_len} is enforced, only returning last {self._len} snapshots.')
-        atom_types = []
-        coords = []
-        for s in self._data:
-            atom_types.extend([s.info_atom_types()])
-            coords.extend([s.info_coords()])
 
-        return SparseInfo(atom_types, coords)
+        return SparseInfo(self.atom_types(), self._window(self._coords))
 
-    def all_info(self) -> List[Snapshot]:
+    def all_info(self) -> AllInfo:
         """
-        Returns the complete information per snapshot.
+        Returns views of every field of every snapshot.
 
         Args:
             None
-        
+
         Returns:
-            (list(Snapshot)): A list of molecular system snapshots.
+            iterations, states, coords, energies, forces (AllInfo): Tensors of
+                size (T), (T), (T, N, 3), (T) and (T, N, 3) where T is the
+                number of snapshots.
 
         """
         if self._max_len:
             warnings.warn(f'max length of {self._max_len} is enforced, only returning last {self._len} snapshots.')
-        return self._data
+
+        return AllInfo(
+            self._window(self._iterations),
+            self._window(self._states),
+            self._window(self._coords),
+            self._window(self._energies),
+            self._window(self._forces)
+        )
+
+    def snapshot(self, idx: int) -> Snapshot:
+        """
+        Builds the snapshot at the given position in the history.
+
+        Args:
+            idx (int): Position in the history, negative values count from
+                the end.
+
+        Returns:
+            (Snapshot): A molecular system snapshot.
+
+        """
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError(f'snapshot index {idx} out of range for length {self._len}')
+        i = self._start + idx
+
+        return Snapshot(
+            iteration=int(self._iterations[i]),
+            state=int(self._states[i]),
+            one_hot=None,
+            one_hot_key=None,
+            coords=self._coords[i],
+            energy=self._energies[i],
+            forces=self._forces[i],
+            atom_types=self.atom_types()
+        )
+
+    def snapshots(self) -> List[Snapshot]:
+        """
+        Builds every snapshot in the history.
+
+        Args:
+            None
+
+        Returns:
+            (list(Snapshot)): A list of molecular system snapshots.
+
+        """
+        return [self.snapshot(i) for i in range(self._len)]
+
+    def atom_types(self) -> List[str]:
+        """
+        Returns the atom types shared by every snapshot.
+
+        """
+        assert self._topology is not None, 'atom types require a topology'
+        return list(self._topology.atom_types)
+
+    def state_dict(self, since: Optional[int]=None) -> Dict[str, Any]:
+        """
+        Returns a copy of the live snapshots, compact for a bounded history.
+
+        Args:
+            since (int | None): Only copies the snapshots of later iterations,
+                to save a history incrementally.
+
+        Returns:
+            (dict): Columns of the snapshots, see AllInfo.
+
+        """
+        start = 0
+        if since is not None and self._len > 0:
+            # iterations only increase along a history
+            start = int((self._window(self._iterations) <= since).sum())
+        return {
+            name: self._window(getattr(self, f'_{name}'))[start:].clone() for name in AllInfo._fields
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Replaces the snapshots with those saved by TrajectoryHistory.state_dict.
+
+        """
+        info = AllInfo(*[state_dict[name] for name in AllInfo._fields])
+        n = info.iterations.size(dim=0)
+        if self._max_len and n > self._max_len:
+            info = AllInfo(*[t[-self._max_len:] for t in info])
+            n = self._max_len
+        self._start = 0
+        self._len = n
+        self._capacity = 0
+        if n == 0:
+            return
+        self._capacity = 2 * self._max_len if self._max_len else max(_INIT_CAPACITY, 2 * n)
+        for name, t in zip(AllInfo._fields, info):
+            col = t.new_empty(self._capacity, *t.shape[1:])
+            col[:n] = t
+            setattr(self, f'_{name}', col)
+
+    def _window(self, col: torch.Tensor) -> torch.Tensor:
+        return col[self._start:self._start + self._len]
+
+    def _alloc(
+        self,
+        coords: torch.Tensor,
+        energy: torch.Tensor,
+        forces: torch.Tensor
+    ) -> None:
+        # a bounded history keeps twice its max length so that dropping the
+        # oldest snapshots is a single block move every max length additions
+        self._capacity = 2 * self._max_len if self._max_len else _INIT_CAPACITY
+        self._iterations = torch.empty(self._capacity, dtype=torch.long)
+        self._states = torch.empty(self._capacity, dtype=torch.long)
+        self._coords = coords.new_empty(self._capacity, *coords.shape)
+        self._energies = energy.new_empty(self._capacity, *energy.shape)
+        self._forces = forces.new_empty(self._capacity, *forces.shape)
+
+    def _compact(self) -> None:
+        """
+        Makes room at the end of the columns, by moving the live snapshots to
+        the front for a bounded history and by doubling the capacity otherwise.
+
+        """
+        if self._max_len:
+            for name in ['_iterations', '_states', '_coords', '_energies', '_forces']:
+                col = getattr(self, name)
+                col[:self._len] = self._window(col).clone()
+            self._start = 0
+            return
+
+        self._capacity *= 2
+        for name in ['_iterations', '_states', '_coords', '_energies', '_forces']:
+            col = getattr(self, name)
+            grown = col.new_empty(self._capacity, *col.shape[1:])
+            grown[:self._len] = col[:self._len]
+            setattr(self, name, grown)
+
+
+if __name__ == '__main__':
+    ntests = 2
+    ntests_passed = 0
+
+    _NATOMS = 51
+    _NSTEPS = 300
+
+    from solvent_dynamics import computer
+
+    one_hot = torch.eye(3)[torch.randint(3, (_NATOMS,))]
+    key = {'H': torch.tensor([1., 0., 0.]), 'C': torch.tensor([0., 1., 0.]), 'O': torch.tensor([0., 0., 1.])}
+    coords = torch.rand(_NSTEPS, _NATOMS, 3)
+
+    history = TrajectoryHistory(topology=SystemTopology.build(torch.rand(_NATOMS), one_hot, key))
+    for i in range(_NSTEPS):
+        history.add(i, i % 3, coords[i], coords[i, 0, 0], coords[i])
+    info = history.all_info()
+    assert len(history) == _NSTEPS and torch.equal(info.coords, coords)
+    assert torch.equal(info.iterations, torch.arange(_NSTEPS))
+    assert history.snapshot(-1).info_coords() == coords[-1].tolist()
+    assert history.sparse_info().atom_types == computer.one_hot_to_atom_type(one_hot, key)
+    ntests_passed += 1
+
+    bounded = TrajectoryHistory(max_length=50)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for i in range(_NSTEPS):
+            bounded.add(i, 0, coords[i], coords[i, 0, 0], coords[i])
+            assert torch.equal(bounded.all_info().iterations, torch.arange(max(0, i - 49), i + 1))
+        assert torch.equal(bounded.all_info().coords, coords[-50:])
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
@@ -3,13 +3,33 @@ STATUS: DEV
 
 """
 
+import time
 import torch
+import itertools
 from torch_geometric.data.data import Data
 
 from solvent_dynamics import computer, constants
-from solvent_dynamics.trajectory import TrajectoryHistory, Snapshot
+from solvent_dynamics.logger import TrajectoryLogger
+from solvent_dynamics.trajectory import TrajectoryHistory, TrajectoryStore
+from solvent_dynamics.trajectory._model_input import ModelInput
+from solvent_dynamics.trajectory._ring_window import RingWindow
 
-from typing import Dict, Optional
+from typing import Any, Dict, Optional, Union
+
+
+# ids of the trajectories that were not given a store index, unique per process
+_traj_ids = itertools.count()
+
+
+def _new_traj_idx(n: int=1) -> int:
+    """
+    Reserves n consecutive trajectory ids and returns the first one.
+
+    """
+    first = next(_traj_ids)
+    for _ in range(n - 1):
+        next(_traj_ids)
+    return first
 
 
 class TrajectoryPropagator:
@@ -18,9 +38,7 @@ class TrajectoryPropagator:
             model: torch.nn.Module,
             res_model: Optional[torch.nn.Module],
             state: int,
-            mass: torch.Tensor,
-            atom_types: torch.Tensor,
-            one_hot_key: Dict,
+            topology: computer.SystemTopology,
             init_coords: torch.Tensor,
             init_velo: torch.Tensor,
             init_forces: torch.Tensor,
@@ -28,7 +46,25 @@ class TrajectoryPropagator:
             init_a: torch.Tensor,
             init_h: torch.Tensor,
             init_d: torch.Tensor,
-            delta_t: float
+            delta_t: float,
+            state_mult: Optional[torch.Tensor]=None,
+            soc: Optional[torch.Tensor]=None,
+            max_hop: int=1,
+            force_mode: str='SINGLE_PASS',
+            force_gap_window: Optional[float]=None,
+            neighbor_skin: Optional[float]=None,
+            neighbor_cutoff: float=constants.NEIGHBOR_RADIUS,
+            broker: Optional[computer.InferenceBroker]=None,
+            store: Optional[TrajectoryStore]=None,
+            store_idx: Optional[int]=None,
+            history_length: Optional[int]=None,
+            seed: Optional[int]=None,
+            step_mode: str='EAGER',
+            compile_cache_dir: Optional[str]=None,
+            precision: Optional[Union[str, computer.PrecisionPolicy]]=None,
+            termination: Optional[computer.TerminationCriteria]=None,
+            time_step: Optional[computer.TimeStepPolicy]=None,
+            logger: Optional[TrajectoryLogger]=None
         ) -> None:
         """
         Initializes a trajectory propagator.
@@ -40,11 +76,8 @@ class TrajectoryPropagator:
                 block placed on top of the outputs of the standard model.
             state (int): The current electronic state that is currently
                 being populated.
-            mass (torch.Tensor): Atomic mass tensor of size (N) where N is
-                the number of atoms.
-            atom_types (torch.Tensor): A one-hot tensor representing atom
-                types.
-            one_hot_key (torch.Tensor): The key to the one-hot tensor.
+            topology (SystemTopology): Topology of the molecular system,
+                shared with every other trajectory of the same system.
             init_coords (torch.Tensor): Starting conditions: coordinates.
             init_velo (torch.Tensor): Starting conditions: velocities.
             init_forces (torch.Tensor): Starting conditions: forces.
@@ -53,7 +86,60 @@ class TrajectoryPropagator:
             init_h (torch.Tensor): Starting conditions: energy matrix.
             init_d (torch.Tensor): Starting conditions: non-adiabatic matrix.
             delta_t (float): The change in time from the previous snapshot
-                to this snapshot in atomic units of time, au.
+                to this snapshot in atomic units of time, au. The first step
+                with ``time_step``.
+            state_mult (torch.Tensor | None): Spin multiplicity of size (K)
+                for every electronic state, all equal if not given.
+            soc (torch.Tensor | None): Spin-orbit couplings of size (K, K)
+                between every two states, in the units of the energies. No
+                intersystem crossing if not given.
+            max_hop (int): The max number of states a single hop may cross.
+            force_mode (str): one of "SINGLE_PASS" | "PER_STATE", how forces
+                of the K states are differentiated.
+            force_gap_window (float | None): If given, forces are only computed
+                for the populated state and states within this energy gap of
+                it, the rest are NaN. It has to cover the hopping gap
+                thresholds with a margin, see computer.check_gap_window.
+            neighbor_skin (float | None): If given, the edges within
+                ``neighbor_cutoff`` are kept in a neighbor list with this skin
+                and handed to the model as ``edge_index``, see NeighborList.
+                Otherwise the model builds its own graph every step.
+            neighbor_cutoff (float): The radius of the model input graph.
+            broker (InferenceBroker | None): An optional broker that batches
+                the model evaluations of this trajectory with those of other
+                trajectories running concurrently in the same process. The
+                force mode and gap window of the broker apply.
+            store (TrajectoryStore | None): An optional on-disk store that
+                every snapshot is streamed into.
+            store_idx (int | None): Index of this trajectory in ``store``,
+                required with a store. Otherwise defaults to an id unique
+                among the trajectories of the process, so that their logs
+                and profiles stay apart.
+            history_length (int | None): An optional max length of the
+                in-memory history, to bound memory when streaming to a store.
+            seed (int | None): Seed of the surface hopping random numbers,
+                nondeterministic if not given.
+            step_mode (str): one of "EAGER" | "COMPILED", whether the step
+                arithmetic runs op by op or as graphs compiled by
+                torch.compile, with a fallback to eager mode.
+            compile_cache_dir (str | None): An optional directory to cache
+                the compiled step kernels in across runs.
+            precision (str | PrecisionPolicy | None): An optional precision
+                policy, or one of "FP64" | "FP32" | "MIXED", see
+                PrecisionPolicy. The starting conditions and masses are cast
+                to its integration type and the model input to its model
+                type, the model parameters have to be of the model type
+                already. The types of the starting conditions if not given.
+            termination (TerminationCriteria | None): Optional criteria that
+                stop the trajectory early, checked by status every
+                ``termination.every`` steps. Bonds are read from the
+                starting coordinates.
+            time_step (TimeStepPolicy | None): An optional adaptive time step
+                policy, the step after every step is chosen from the energy
+                gaps, velocities and forces, see adaptive_delta_t. Fixed
+                steps of ``delta_t`` if not given.
+            logger (TrajectoryLogger | None): An optional logger that every
+                step is logged to, under ``store_idx``.
 
         Returns:
             None
@@ -61,45 +147,220 @@ class TrajectoryPropagator:
         """
         self._model = model
         self._res_model = res_model
+        self._precision = computer.precision_policy(precision) if precision is not None else None
+        if self._precision is not None:
+            topology = self._precision.cast_topology(topology)
+            init_coords, init_velo, init_forces, init_energies, init_a, init_h, init_d, soc = [
+                self._precision.cast(t)
+                for t in [init_coords, init_velo, init_forces, init_energies, init_a, init_h, init_d, soc]
+            ]
 
         self._iter = 0
-        self._traj = TrajectoryHistory()
-        self._mass = mass
-        self._atom_types = atom_types
-        self._one_hot_key = one_hot_key
+        self._traj = TrajectoryHistory(history_length, topology=topology)
+        self._topology = topology
         self._cur_state = self._prev_state = state
         self._nstates = init_energies.size(dim=0)
-        self._cur_coords = init_coords
-        self._cur_velo = init_velo
-        self._cur_forces = init_forces
-        self._cur_energies = init_energies
-        self._cur_a = init_a
-        self._cur_h = init_h
-        self._cur_d = init_d
-
-        self._prev_coords = self._prev_prev_coords = torch.zeros_like(init_coords)
-        self._prev_velo = self._prev_prev_velo = torch.zeros_like(init_velo)
-        self._prev_forces = self._prev_prev_forces = torch.zeros_like(init_forces)
-        self._prev_energies = self._prev_prev_energies = torch.zeros_like(init_energies)
-        self._prev_a = self._prev_prev_a = torch.zeros_like(init_a)
-        self._prev_h = self._prev_prev_h = torch.zeros_like(init_h)
-        self._prev_d = self._prev_prev_d = torch.zeros_like(init_d)
+        self._state_mult = state_mult if state_mult is not None else torch.ones(self._nstates)
+        self._soc = soc
+        self._max_hop = max_hop
+        self._force_mode = force_mode
+        if force_gap_window is not None:
+            computer.check_gap_window(force_gap_window)
+        self._force_gap_window = force_gap_window
+        self._neighbors = (
+            computer.NeighborList(neighbor_cutoff, neighbor_skin) if neighbor_skin is not None else None
+        )
+        self._broker = broker
+        self._model_input = ModelInput(
+            topology, dtype=self._precision.model if self._precision is not None else None
+        )
+        self._step_mode = step_mode
+        self._compile_cache_dir = compile_cache_dir
+        if store_idx is None:
+            if store is not None:
+                raise ValueError('a store requires the store index of the trajectory')
+            store_idx = _new_traj_idx()
+        self._store = store
+        self._store_idx = store_idx
+
+        # nuclear window
+        self._coords = RingWindow(init_coords)
+        self._velo = RingWindow(init_velo)
+        self._forces = RingWindow(init_forces)
+        self._energies = RingWindow(init_energies)
+
+        # electronic window
+        self._a = RingWindow(init_a)
+        self._h = RingWindow(init_h)
+        self._d = RingWindow(init_d)
         self._hoped = 'NO HOP'
+        self._hop_p = torch.zeros_like(init_energies)
 
-        self._kinetic_energy = torch.Tensor(0.0)
+        self._kinetic_energy = torch.tensor(0.0)
 
         self._delta_t = delta_t
+        self._time_step = time_step
+        self._time = 0.0
+
+        self._termination = termination
+        self._bonds = None
+        if termination is not None and termination.max_bond_length is not None:
+            self._bonds = computer.find_bonds(init_coords, termination.bond_cutoff)
+        self._e_total_ref: Optional[torch.Tensor] = None
+        self._ground_time = 0.0
+        self._reason = computer.TERMINATION_REASONS[0]
+        self._logger = logger
+
+        self._rng = torch.Generator()
+        if seed is not None:
+            self._rng.manual_seed(seed)
+        else:
+            self._rng.seed()
+
+    @property
+    def iteration(self) -> int:
+        return self._iter
+
+    @property
+    def time(self) -> float:
+        """
+        The simulated time in atomic units of time, au.
+
+        """
+        return self._time
+
+    @property
+    def delta_t(self) -> float:
+        """
+        The time step of the next step in atomic units of time, au.
+
+        """
+        return self._delta_t
+
+    @property
+    def termination_reason(self) -> str:
+        """
+        One of TERMINATION_REASONS, "NONE" while the trajectory runs.
+
+        """
+        return self._reason
+
+    def history(self) -> TrajectoryHistory:
+        """
+        Returns the running history of the trajectory.
+
+        """
+        return self._traj
+
+    def neighbor_list_stats(self) -> Optional[computer.NeighborListStats]:
+        """
+        Returns the rebuild statistics of the neighbor list, None without one.
+
+        """
+        return self._neighbors.stats() if self._neighbors is not None else None
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Returns a copy of the full propagation state: the nuclear and
+        electronic windows, the populated states, the iteration counter, the
+        surface hopping random number generator and the history length.
+
+        Past snapshots are not part of the state so that it does not grow
+        along the trajectory: flush the store before taking a state to be
+        resumed from, and save the history incrementally with
+        TrajectoryHistory.state_dict(since=...).
+
+        """
+        return {
+            'iter': self._iter,
+            'time': self._time,
+            'delta_t': self._delta_t,
+            'cur_state': self._cur_state,
+            'prev_state': self._prev_state,
+            'hoped': self._hoped,
+            'kinetic_energy': self._kinetic_energy.clone(),
+            'e_total_ref': self._e_total_ref.clone() if self._e_total_ref is not None else None,
+            'ground_time': self._ground_time,
+            'reason': self._reason,
+            'rng': self._rng.get_state(),
+            'windows': {
+                name: getattr(self, f'_{name}').state_dict()
+                for name in ['coords', 'velo', 'forces', 'energies', 'a', 'h', 'd']
+            },
+            'history_len': len(self._traj)
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        """
+        Restores a state saved by TrajectoryPropagator.state_dict. Steps
+        streamed to the store after the state was taken are dropped. The
+        history is restored from the snapshots under 'history', if any, and
+        must then hold as many snapshots as when the state was taken.
+
+        """
+        self._iter = state_dict['iter']
+        self._time = state_dict['time']
+        self._delta_t = state_dict['delta_t']
+        self._cur_state = state_dict['cur_state']
+        self._prev_state = state_dict['prev_state']
+        self._hoped = state_dict['hoped']
+        self._kinetic_energy = state_dict['kinetic_energy'].clone()
+        e_total_ref = state_dict['e_total_ref']
+        self._e_total_ref = e_total_ref.clone() if e_total_ref is not None else None
+        self._ground_time = state_dict['ground_time']
+        self._reason = state_dict['reason']
+        self._rng.set_state(state_dict['rng'])
+        for name, window in state_dict['windows'].items():
+            getattr(self, f'_{name}').load_state_dict(window)
+        history = state_dict.get('history')
+        if history is not None:
+            self._traj.load_state_dict(history)
+            if len(self._traj) != state_dict['history_len']:
+                raise ValueError(f'history of {len(self._traj)} snapshots does not match the state ({state_dict["history_len"]} snapshots)')
+        if self._store is not None:
+            # one snapshot is saved per iteration
+            self._store.truncate(self._store_idx, self._iter)
 
     def propagate(self) -> None:
         """
         Propagates a trajectory by one step, by one snapshot.
 
         """
-        self._save_snapshot()
-        self._shift(mode='NUCLEAR')
-        self._nuclear()
-        self._shift(mode='ELECTRONIC')
-        self._surface_hopping()
+        start = time.perf_counter()
+        sim_time = self._time
+        with computer.step_mode(self._step_mode, self._compile_cache_dir):
+            with computer.profile_phase('save_snapshot'):
+                self._save_snapshot()
+            with computer.profile_phase('shift'):
+                self._shift(mode='NUCLEAR')
+            with computer.profile_phase('nuclear'):
+                self._nuclear()
+            with computer.profile_phase('shift'):
+                self._shift(mode='ELECTRONIC')
+            with computer.profile_phase('surface_hopping'):
+                self._surface_hopping()
+        if self._e_total_ref is None:
+            self._e_total_ref = computer.total_energy(
+                self._topology, torch.tensor(self._cur_state), self._velo.cur, self._energies.cur
+            )
+        self._ground_time = self._ground_time + self._time - sim_time if self._cur_state == 0 else 0.0
+        if self._time_step is not None:
+            with computer.profile_phase('time_step'):
+                self._delta_t = float(computer.adaptive_delta_t(
+                    policy=self._time_step,
+                    topology=self._topology,
+                    state=self._cur_state,
+                    delta_t=self._delta_t,
+                    velo=self._velo.cur,
+                    forces=self._forces.cur,
+                    energies=self._energies.cur,
+                    energies_prev=self._energies.prev
+                ))
+        if self._logger is not None:
+            with computer.profile_phase('log'):
+                self.log()
+        self._iter += 1
+        computer.profile_steps(self._store_idx, self._time - sim_time, start)
 
     def _nuclear(self) -> None:
         """
@@ -111,74 +372,94 @@ class TrajectoryPropagator:
             self._scale_kinetic_energy()
             return
 
-        self._cur_coords = computer.verlet_coords(
+        # the window was just shifted, step from prev into the cur slots
+        step = computer.velocity_verlet(
             state=self._cur_state,
-            coords=self._cur_coords,
-            mass=self._mass,
-            velo=self._cur_velo,
-            forces=self._cur_forces.clone(),
-            delta_t=self._delta_t
+            coords=self._coords.prev,
+            topology=self._topology,
+            velo=self._velo.prev,
+            forces=self._forces.prev,
+            delta_t=self._delta_t,
+            energies_forces=self._energies_forces,
+            out_coords=self._coords.cur,
+            out_velo=self._velo.cur
         )
-
-        self._cur_energies, self._cur_forces = computer.ml_energies_forces(
+        self._energies.cur.copy_(step.energies)
+        self._forces.cur.copy_(step.forces)
+        self._kinetic_energy = step.ke
+        self._time += self._delta_t
+
+    def _energies_forces(self, coords: torch.Tensor) -> computer.EnergiesForces:
+        if self._broker is not None:
+            return self._broker.energies_forces(self._gen_data_structure(coords), self._cur_state)
+        return computer.ml_energies_forces(
             model=self._model,
             res_model=self._res_model,
-            structure=self._gen_data_structure(),
+            structure=self._gen_data_structure(coords),
             u_energy_evs=constants.U_ENERGY_EVS,
-            rms_force_evs=constants.RMS_FORCE_EVS
-        )
-
-        self._cur_velo = computer.verlet_velo(
+            rms_force_evs=constants.RMS_FORCE_EVS,
+            force_mode=self._force_mode,
             state=self._cur_state,
-            coords=self._cur_coords,
-            mass=self._mass,
-            velo=self._cur_velo,
-            forces=self._cur_forces.clone(),
-            forces_prev=self._prev_forces.clone(),
-            delta_t=self._delta_t
-        )
-
-        self._kinetic_energy = computer.kinetic_energy(
-            mass=self._mass,
-            velo=self._cur_velo
+            gap_window=self._force_gap_window,
+            out_dtype=self._precision.integration if self._precision is not None else None
         )
 
     def _surface_hopping(self) -> None:
-        a, h, d, v, hoped, state = computer.surface_hopping(
+        a, h, d, v, hoped, state, hop_p = computer.surface_hopping(
             state=self._cur_state,
-            nstates=self._nstates,
-            mass=self._mass,
-            coord=self._cur_coords,
-            coord_prev=self._prev_coords,
-            coord_prev_prev=self._prev_prev_coords,
-            velo=self._cur_velo,
-            energies=self._cur_energies,
-            energies_prev=self._prev_energies,
-            energies_prev_prev=self._prev_prev_energies,
-            forces=self._cur_forces,
-            forces_prev=self._prev_forces,
-            forces_prev_prev=self._prev_prev_forces,
+            state_mult=self._state_mult,
+            topology=self._topology,
+            coord=self._coords.cur,
+            coord_prev=self._coords.prev,
+            coord_prev_prev=self._coords.prev_prev,
+            velo=self._velo.cur,
+            energies=self._energies.cur,
+            energies_prev=self._energies.prev,
+            energies_prev_prev=self._energies.prev_prev,
+            forces=self._forces.cur,
+            forces_prev=self._forces.prev,
+            forces_prev_prev=self._forces.prev_prev,
             ke=self._kinetic_energy,
             ic_e_thresh=constants.INTERNAL_CONVERSION_ENERGY_GAP,
-            isc_e_thresh=constants.INTERSYSTEM_CROSSING_ENERGY_GAP
+            isc_e_thresh=constants.INTERSYSTEM_CROSSING_ENERGY_GAP,
+            max_hop=self._max_hop,
+            soc=self._soc,
+            generator=self._rng
         )
-        self._cur_a = a
-        self._cur_h = h
-        self._cur_d = d
-        self._cur_velo = v
-        self._hoped = hoped
-        self._cur_state = state
+        self._a.cur.copy_(a)
+        self._h.cur.copy_(h)
+        self._d.cur.copy_(d)
+        self._velo.cur.copy_(v)
+        self._hoped = computer.HOP_TYPES[int(hoped)]
+        self._hop_p = hop_p
+        self._cur_state = int(state)
+        if self._hoped == 'HOP':
+            # velocities were rescaled to pay for the energy gap
+            self._kinetic_energy = computer.kinetic_energy(self._topology, self._velo.cur)
  
     def log(self) -> None:
         """
-        Logs the trajectory.
+        Logs the last step of the trajectory, called by propagate with a
+        logger. The record is written in the background.
 
         """
-        NotImplemented()
+        self._logger.log(
+            traj=self._store_idx,
+            step=self._iter,
+            time=self._time,
+            state=self._cur_state,
+            energies=self._energies.cur,
+            kinetic_energy=self._kinetic_energy,
+            hop_type=computer.HOP_TYPES.index(self._hoped),
+            hop_p=self._hop_p
+        )
 
-    def status(self) -> bool: # type: ignore
+    def status(self) -> bool:
         """
         Determines if the current trajectory should be propagated further.
+        The termination criteria are checked every ``termination.every``
+        steps, the reason of a terminated trajectory is kept in
+        termination_reason.
 
         Args:
             None
@@ -187,14 +468,37 @@ class TrajectoryPropagator:
             (bool)
 
         """
-        NotImplemented()
-
-    def _gen_data_structure(self) -> Data:
+        if self._reason != computer.TERMINATION_REASONS[0]:
+            return False
+        if self._termination is None or self._iter % self._termination.every != 0:
+            return True
+        assert self._e_total_ref is not None
+        with computer.profile_phase('termination'):
+            reason = computer.termination_reasons(
+                criteria=self._termination,
+                topology=self._topology,
+                state=self._cur_state,
+                coords=self._coords.cur,
+                velo=self._velo.cur,
+                velo_prev=self._velo.prev,
+                energies=self._energies.cur,
+                forces=self._forces.cur,
+                e_total_ref=self._e_total_ref,
+                ground_time=self._ground_time,
+                bonds=self._bonds
+            )
+        self._reason = computer.TERMINATION_REASONS[int(reason)]
+
+        return self._reason == computer.TERMINATION_REASONS[0]
+
+    def _gen_data_structure(self, coords: Optional[torch.Tensor]=None) -> Data:
         """
-        Generates a data structure for ml inference.
+        Generates a data structure for ml inference. The structure is built
+        once and its positions are updated in place every step.
 
         Args:
-            None
+            coords (torch.Tensor | None): Coordinates to place in the structure,
+                the current coordinates if not given.
 
         Returns:
             structure (Data): A structure to be sent to pretrained models for
@@ -203,23 +507,27 @@ class TrajectoryPropagator:
                     ``x``: one-hot encoding of atom types
                     ``pos``: coordinate positions
                     ``z``: atomic masses
+                    ``edge_index``: edges within the neighbor cutoff, only
+                        with a neighbor list
 
         """
-        structure = Data(
-            x=self._atom_types,
-            pos=self._cur_coords,
-            z=self._mass,
-        )
-
-        return structure
+        if coords is None:
+            coords = self._coords.cur
+        with computer.profile_phase('model_input'):
+            edge_index = self._neighbors.update(coords) if self._neighbors is not None else None
+            return self._model_input.update(coords, edge_index)
 
     # FIXME: check if needed
     def _scale_kinetic_energy(self) -> None:
         """
-        Add or scale kinetic energy on initial step.
+        Add or scale kinetic energy on initial step. The initial velocities
+        are kept as sampled, only their kinetic energy is computed.
 
         """
-        NotImplemented()
+        self._kinetic_energy = computer.kinetic_energy(
+            topology=self._topology,
+            velo=self._velo.cur
+        )
 
     def _save_snapshot(self) -> None:
         """
@@ -233,16 +541,23 @@ class TrajectoryPropagator:
             None
 
         """
-        snapshot = Snapshot(
+        self._traj.add(
             iteration=self._iter,
             state=self._cur_state,
-            one_hot=self._atom_types,
-            one_hot_key=self._one_hot_key,
-            coords=self._cur_coords.clone(),
-            energy=self._cur_energies[self._cur_state].clone(),
-            forces=self._cur_forces[self._cur_state].clone(),
+            coords=self._coords.cur,
+            energy=self._energies.cur[self._cur_state],
+            forces=self._forces.cur[self._cur_state]
         )
-        self._traj.add(snapshot)
+        if self._store is not None:
+            self._store.add(
+                traj=self._store_idx,
+                iteration=self._iter,
+                state=self._cur_state,
+                coords=self._coords.cur,
+                velo=self._velo.cur,
+                energies=self._energies.cur,
+                forces=self._forces.cur
+            )
 
     def _shift(self, mode: str) -> None:
         """
@@ -256,17 +571,14 @@ class TrajectoryPropagator:
 
         """
         if mode == 'NUCLEAR':
-            self._prev_prev_coords = self._prev_coords.clone()
-            self._prev_prev_velo = self._prev_velo.clone()
-            self._prev_prev_forces = self._prev_forces.clone()
-            self._prev_prev_energies = self._prev_energies.clone()
-
-            self._prev_coords = self._cur_coords.clone()
-            self._prev_velo = self._cur_velo.clone()
-            self._prev_forces = self._cur_forces.clone()
-            self._prev_energies = self._cur_energies.clone()
+            # the first step does not overwrite the cur slots
+            carry = self._iter == 0
+            self._coords.rotate(carry)
+            self._velo.rotate(carry)
+            self._forces.rotate(carry)
+            self._energies.rotate(carry)
         else:
-            self._prev_prev_a = self._prev_a.clone()
-            self._prev_prev_h = self._prev_h.clone()
-            self._prev_prev_d = self._prev_d.clone()
+            self._a.rotate()
+            self._h.rotate()
+            self._d.rotate()
             self._prev_state = self._cur_state
@@ -0,0 +1,373 @@
+"""
+STATUS: DEV
+
+On-disk trajectory storage. A store is a directory with one ``.npy`` file per
+field of shape (T, S, ...) where T is the number of trajectories and S the
+max number of steps per trajectory, a ``lengths.npy`` file with the number of
+steps written per trajectory and a ``meta.json`` file.
+
+Writers buffer fixed-size chunks per trajectory in memory and flush them into
+the memory-mapped files, readers memory-map the files and only load the
+requested (trajectory, step) ranges.
+
+"""
+
+import os
+import json
+import torch
+import numpy as np
+
+from typing import Dict, List, NamedTuple, Optional, Union
+
+
+_FIELDS = ['iterations', 'states', 'coords', 'velo', 'energies', 'forces']
+
+
+class StoreSlice(NamedTuple):
+    iterations: torch.Tensor
+    states: torch.Tensor
+    coords: torch.Tensor
+    velo: torch.Tensor
+    energies: torch.Tensor
+    forces: torch.Tensor
+
+
+def _field_shapes(natoms: int, nstates: int) -> Dict[str, tuple]:
+    return {
+        'iterations': (),
+        'states': (),
+        'coords': (natoms, 3),
+        'velo': (natoms, 3),
+        'energies': (nstates,),
+        'forces': (nstates, natoms, 3)
+    }
+
+
+class TrajectoryStore:
+    """
+    Streams trajectory snapshots to disk in fixed-size chunks.
+
+    """
+    def __init__(
+        self,
+        path: str,
+        ntraj: int,
+        nsteps: int,
+        natoms: int,
+        nstates: int,
+        chunk_size: int=256,
+        dtype: torch.dtype=torch.float32,
+        mode: str='w+'
+    ) -> None:
+        """
+        Creates an empty store, preallocating its files.
+
+        Args:
+            path (str): Directory of the store, created if missing.
+            ntraj (int): The number of trajectories.
+            nsteps (int): The max number of steps per trajectory.
+            natoms (int): The number of atoms per molecular system.
+            nstates (int): The number of electronic states.
+            chunk_size (int): The number of steps buffered per trajectory
+                before they are written to disk.
+            dtype (torch.dtype): The floating point type on disk.
+            mode (str): one of "w+" | "r+", create a new store or append to
+                the existing store at ``path``, see TrajectoryStore.open.
+
+        Returns:
+            None
+
+        """
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._ntraj = ntraj
+        self._nsteps = nsteps
+        self._chunk_size = chunk_size
+        self._dtype = dtype
+        self._shapes = _field_shapes(natoms, nstates)
+
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        self._files = {}
+        self._bufs: Dict[int, Dict[str, torch.Tensor]] = {}
+        self._fill: Dict[int, int] = {}
+        if mode == 'r+':
+            for name in _FIELDS + ['lengths']:
+                f = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='r+')
+                if name == 'lengths':
+                    self._lengths = f
+                else:
+                    self._files[name] = f
+            return
+
+        for name in _FIELDS:
+            file_dtype = np.int64 if name in ['iterations', 'states'] else np_dtype
+            self._files[name] = np.lib.format.open_memmap(
+                os.path.join(path, f'{name}.npy'),
+                mode='w+',
+                dtype=file_dtype,
+                shape=(ntraj, nsteps, *self._shapes[name])
+            )
+        self._lengths = np.lib.format.open_memmap(
+            os.path.join(path, 'lengths.npy'),
+            mode='w+',
+            dtype=np.int64,
+            shape=(ntraj,)
+        )
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'ntraj': ntraj,
+                'nsteps': nsteps,
+                'natoms': natoms,
+                'nstates': nstates,
+                'chunk_size': chunk_size,
+                'dtype': str(np_dtype)
+            }, f)
+
+    @classmethod
+    def open(cls, path: str) -> 'TrajectoryStore':
+        """
+        Opens an existing store for writing, e.g. from a worker process that
+        owns a subset of its trajectories.
+
+        Args:
+            path (str): Directory of the store.
+
+        Returns:
+            (TrajectoryStore)
+
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        return cls(
+            path=path,
+            ntraj=meta['ntraj'],
+            nsteps=meta['nsteps'],
+            natoms=meta['natoms'],
+            nstates=meta['nstates'],
+            chunk_size=meta['chunk_size'],
+            dtype=torch.from_numpy(np.empty(0, dtype=meta['dtype'])).dtype,
+            mode='r+'
+        )
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def nsteps(self) -> int:
+        return self._nsteps
+
+    def add(
+        self,
+        traj: int,
+        iteration: int,
+        state: int,
+        coords: torch.Tensor,
+        velo: torch.Tensor,
+        energies: torch.Tensor,
+        forces: torch.Tensor
+    ) -> None:
+        """
+        Buffers a snapshot of a trajectory, writing the buffer to disk once
+        it holds a full chunk.
+
+        Args:
+            traj (int): Index of the trajectory.
+            iteration (int): Iteration number within its trajectory.
+            state (int): Electronic state of which the molecular system is
+                populating.
+            coords (torch.Tensor): Coordinates of size (N, 3).
+            velo (torch.Tensor): Velocities of size (N, 3).
+            energies (torch.Tensor): Energies of every state of size (K).
+            forces (torch.Tensor): Forces of every state of size (K, N, 3).
+
+        Returns:
+            None
+
+        """
+        if traj not in self._bufs:
+            self._bufs[traj] = {
+                name: torch.empty(
+                    self._chunk_size,
+                    *shape,
+                    dtype=torch.long if name in ['iterations', 'states'] else self._dtype
+                ) for name, shape in self._shapes.items()
+            }
+            self._fill[traj] = 0
+        buf = self._bufs[traj]
+        i = self._fill[traj]
+        buf['iterations'][i] = iteration
+        buf['states'][i] = state
+        buf['coords'][i].copy_(coords)
+        buf['velo'][i].copy_(velo)
+        buf['energies'][i].copy_(energies)
+        buf['forces'][i].copy_(forces)
+
+        self._fill[traj] = i + 1
+        if self._fill[traj] == self._chunk_size:
+            self.flush(traj)
+
+    def flush(self, traj: Optional[int]=None) -> None:
+        """
+        Writes the buffered snapshots of one or every trajectory to disk.
+
+        Args:
+            traj (int | None): Index of the trajectory, every trajectory if
+                not given.
+
+        Returns:
+            None
+
+        """
+        trajs = [traj] if traj is not None else list(self._bufs)
+        for t in trajs:
+            n = self._fill.get(t, 0)
+            if n == 0:
+                continue
+            start = int(self._lengths[t])
+            if start + n > self._nsteps:
+                raise ValueError(f'trajectory {t} exceeds the {self._nsteps} steps of the store')
+            for name in _FIELDS:
+                self._files[name][t, start:start + n] = self._bufs[t][name][:n].numpy()
+            # lengths are updated last so that readers never see unwritten steps
+            self._lengths[t] = start + n
+            self._fill[t] = 0
+
+    def truncate(self, traj: int, length: int) -> None:
+        """
+        Drops every step of a trajectory from ``length`` on, buffered or on
+        disk, e.g. steps written after the checkpoint a run resumes from.
+
+        Args:
+            traj (int): Index of the trajectory.
+            length (int): The number of steps to keep.
+
+        Returns:
+            None
+
+        """
+        self._fill[traj] = 0
+        self._lengths[traj] = min(int(self._lengths[traj]), length)
+
+    def close(self) -> None:
+        """
+        Writes every buffered snapshot and syncs the files.
+
+        """
+        self.flush()
+        for f in self._files.values():
+            f.flush()
+        self._lengths.flush()
+        self._bufs.clear()
+
+
+class TrajectoryStoreReader:
+    """
+    Reads (trajectory, step) ranges of a store through memory maps.
+
+    """
+    def __init__(self, path: str) -> None:
+        """
+        Opens an existing store.
+
+        Args:
+            path (str): Directory of the store.
+
+        Returns:
+            None
+
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self._meta = json.load(f)
+        self._files = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in _FIELDS
+        }
+        self._path = path
+
+    @property
+    def ntraj(self) -> int:
+        return self._meta['ntraj']
+
+    def lengths(self) -> torch.Tensor:
+        """
+        Returns the number of steps written per trajectory, re-read from disk
+        so that a running store can be followed.
+
+        """
+        return torch.from_numpy(np.load(os.path.join(self._path, 'lengths.npy')))
+
+    def read(
+        self,
+        field: str,
+        traj: Union[int, slice, List[int]],
+        steps: Union[int, slice]=slice(None)
+    ) -> torch.Tensor:
+        """
+        Loads a (trajectory, step) range of a single field.
+
+        Args:
+            field (str): one of "iterations" | "states" | "coords" | "velo" |
+                "energies" | "forces"
+            traj (int | slice | list(int)): Trajectories to read.
+            steps (int | slice): Steps to read. Steps past the length of a
+                trajectory are not yet written and read as zeros.
+
+        Returns:
+            (torch.Tensor): Only the requested range is read from disk.
+
+        """
+        return torch.from_numpy(np.array(self._files[field][traj, steps]))
+
+    def read_all(
+        self,
+        traj: Union[int, slice, List[int]],
+        steps: Union[int, slice]=slice(None)
+    ) -> StoreSlice:
+        """
+        Loads a (trajectory, step) range of every field.
+
+        """
+        return StoreSlice(*[self.read(name, traj, steps) for name in _FIELDS])
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    ntests = 1
+    ntests_passed = 0
+
+    _NTRAJ = 3
+    _NSTEPS = 100
+    _NATOMS = 51
+    _NSTATES = 3
+
+    coords = torch.rand(_NTRAJ, _NSTEPS, _NATOMS, 3)
+    forces = torch.rand(_NTRAJ, _NSTEPS, _NSTATES, _NATOMS, 3)
+    with tempfile.TemporaryDirectory() as path:
+        store = TrajectoryStore(path, _NTRAJ, _NSTEPS, _NATOMS, _NSTATES, chunk_size=16)
+        reader = TrajectoryStoreReader(path)
+        for i in range(40):
+            for t in range(_NTRAJ):
+                store.add(t, i, t, coords[t, i], coords[t, i], forces[t, i, :, 0, 0], forces[t, i])
+        assert reader.lengths().tolist() == [32] * _NTRAJ
+        store.close()
+        assert reader.lengths().tolist() == [40] * _NTRAJ
+        assert torch.equal(reader.read('coords', 1, slice(5, 30)), coords[1, 5:30])
+        assert torch.equal(reader.read('forces', slice(0, 2), 39), forces[:2, 39])
+        assert torch.equal(reader.read_all(2, slice(0, 40)).states, torch.full((40,), 2))
+
+        appender = TrajectoryStore.open(path)
+        appender.add(0, 40, 0, coords[0, 40], coords[0, 40], forces[0, 40, :, 0, 0], forces[0, 40])
+        appender.close()
+        assert reader.lengths().tolist() == [41, 40, 40]
+        assert torch.equal(reader.read('coords', 0, 40), coords[0, 40])
+
+        appender = TrajectoryStore.open(path)
+        appender.add(1, 40, 1, coords[1, 40], coords[1, 40], forces[1, 40, :, 0, 0], forces[1, 40])
+        appender.truncate(1, 35)
+        appender.close()
+        assert reader.lengths().tolist() == [41, 35, 40]
+    ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
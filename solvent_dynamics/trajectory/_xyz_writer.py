@@ -0,0 +1,182 @@
+"""
+STATUS: DEV
+
+Streaming multi-frame XYZ and extended XYZ export.
+https://en.wikipedia.org/wiki/XYZ_file_format
+
+Every frame of a trajectory shares the same atoms, so a frame is formatted
+with a single %-template built once from the atom types.
+
+"""
+
+import torch
+
+from solvent_dynamics.trajectory import TrajectoryHistory
+
+from typing import List, Optional
+
+
+_BUFFER_SIZE = 1 << 22
+_CHUNK_FRAMES = 1024
+
+
+class XYZWriter:
+    """
+    Writes trajectory frames to a multi-frame XYZ file.
+
+    """
+    def __init__(
+        self,
+        path: str,
+        atom_types: List[str],
+        extended: bool=False,
+        precision: int=8,
+        buffer_size: int=_BUFFER_SIZE
+    ) -> None:
+        """
+        Opens an XYZ file for writing.
+
+        Args:
+            path (str): File to write to, overwritten if it exists.
+            atom_types (list(str)): Atom symbols shared by every frame.
+            extended (bool): Write extended XYZ, with energy and state in the
+                comment line and forces as extra columns.
+            precision (int): Number of decimals of coordinates and forces.
+            buffer_size (int): Size of the file buffer in bytes.
+
+        Returns:
+            None
+
+        """
+        self._natoms = len(atom_types)
+        self._extended = extended
+        self._file = open(path, 'w', buffering=buffer_size)
+
+        f = f'%.{precision}f'
+        if extended:
+            atom_lines = '\n'.join(f'{a} {f} {f} {f} {f} {f} {f}' for a in atom_types)
+            comment = 'Properties=species:S:1:pos:R:3:forces:R:3 energy=%.10f state=%d iteration=%d'
+        else:
+            atom_lines = '\n'.join(f'{a} {f} {f} {f}' for a in atom_types)
+            comment = 'iteration=%d'
+        self._template = f'{self._natoms}\n{comment}\n{atom_lines}\n'
+
+    def __enter__(self) -> 'XYZWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(
+        self,
+        coords: torch.Tensor,
+        energies: Optional[torch.Tensor]=None,
+        states: Optional[torch.Tensor]=None,
+        forces: Optional[torch.Tensor]=None,
+        iterations: Optional[torch.Tensor]=None
+    ) -> None:
+        """
+        Appends frames to the file.
+
+        Args:
+            coords (torch.Tensor): Coordinates of size (T, N, 3) or (N, 3) for
+                a single frame.
+            energies (torch.Tensor | None): Energies of size (T), required by
+                extended XYZ.
+            states (torch.Tensor | None): Populated states of size (T),
+                required by extended XYZ.
+            forces (torch.Tensor | None): Forces of size (T, N, 3), required
+                by extended XYZ.
+            iterations (torch.Tensor | None): Iteration numbers of size (T),
+                counted from 0 if not given.
+
+        Returns:
+            None
+
+        """
+        if coords.dim() == 2:
+            coords = coords.unsqueeze(0)
+            energies = energies.view(1) if energies is not None else None
+            states = states.view(1) if states is not None else None
+            forces = forces.unsqueeze(0) if forces is not None else None
+            iterations = iterations.view(1) if iterations is not None else None
+        nframes = coords.size(dim=0)
+        if iterations is None:
+            iterations = torch.arange(nframes)
+        if self._extended:
+            assert energies is not None and states is not None and forces is not None, \
+                'extended xyz requires energies, states and forces'
+
+        for start in range(0, nframes, _CHUNK_FRAMES):
+            end = min(start + _CHUNK_FRAMES, nframes)
+            if self._extended:
+                values = torch.cat([coords[start:end], forces[start:end]], dim=-1) # type: ignore
+                headers = zip(
+                    energies[start:end].tolist(), # type: ignore
+                    states[start:end].tolist(), # type: ignore
+                    iterations[start:end].tolist()
+                )
+            else:
+                values = coords[start:end]
+                headers = zip(iterations[start:end].tolist())
+            rows = values.reshape(end - start, -1).tolist()
+            self._file.write(''.join(
+                self._template % (*header, *row) for header, row in zip(headers, rows)
+            ))
+
+    def write_history(self, history: TrajectoryHistory) -> None:
+        """
+        Appends every snapshot of a trajectory history to the file.
+
+        """
+        iterations, states, coords, energies, forces = history.all_info()
+        self.write(coords, energies, states, forces, iterations)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import tempfile
+
+    ntests = 2
+    ntests_passed = 0
+
+    _NFRAMES = 10000
+    _NATOMS = 51
+
+    atom_types = ['C', 'H', 'O'] * (_NATOMS // 3)
+    coords = torch.rand(_NFRAMES, _NATOMS, 3, dtype=torch.float64)
+    forces = torch.rand(_NFRAMES, _NATOMS, 3, dtype=torch.float64)
+    energies = torch.rand(_NFRAMES, dtype=torch.float64)
+    states = torch.randint(3, (_NFRAMES,))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'traj.xyz')
+        t = time.perf_counter()
+        with XYZWriter(path, atom_types) as writer:
+            writer.write(coords)
+        elapsed = time.perf_counter() - t
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        assert len(lines) == _NFRAMES * (_NATOMS + 2)
+        assert lines[(_NATOMS + 2) * 7 + 1] == 'iteration=7'
+        x, y, z = map(float, lines[(_NATOMS + 2) * 7 + 2 + 4].split()[1:])
+        assert torch.allclose(torch.tensor([x, y, z], dtype=torch.float64), coords[7, 4], atol=1e-8)
+        ntests_passed += 1
+
+        path = os.path.join(tmp, 'traj.extxyz')
+        t = time.perf_counter()
+        with XYZWriter(path, atom_types, extended=True) as writer:
+            writer.write(coords, energies, states, forces)
+        elapsed_ext = time.perf_counter() - t
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        assert f'state={int(states[3])}' in lines[(_NATOMS + 2) * 3 + 1]
+        assert len(lines[2].split()) == 7
+        ntests_passed += 1
+
+    print(f'Passes {ntests_passed}/{ntests} tests!')
+    print(f'{_NFRAMES} frames of {_NATOMS} atoms: xyz {elapsed:.2f}s, extended xyz {elapsed_ext:.2f}s')